@@ -0,0 +1,151 @@
+import tempfile
+import numpy as np
+from PyQt5.QtGui import QImage
+from PIL import Image
+
+# Channel orders that can be mapped directly, with the matching QImage format
+CHANNEL_FORMATS = {
+    'L': (1, QImage.Format_Grayscale8),
+    'RGB': (3, QImage.Format_RGB888),
+    'BGR': (3, QImage.Format_BGR888),
+    'RGBA': (4, QImage.Format_RGBA8888),
+    'RGBX': (4, QImage.Format_RGBX8888),
+    'BGRA': (4, QImage.Format_ARGB32),
+    'BGRX': (4, QImage.Format_RGB32),
+}
+
+# Rows copied per band when streaming a view into a scratch image
+BAND_ROWS = 256
+
+
+class BackingStore:
+    """Pixel storage backed by a NumPy memmap instead of a heap QImage.
+
+    The OS pages pixel data in and out on demand, so documents larger than RAM
+    can be opened, cropped and saved. Geometric operations return new stores
+    that are views on the same map and never copy pixels.
+    """
+
+    def __init__(self, array, channel_order):
+        if channel_order not in CHANNEL_FORMATS:
+            raise ValueError(f"Unsupported channel order: {channel_order}")
+        if array.ndim == 2:
+            array = array[:, :, np.newaxis]
+        self.array = array
+        self.channel_order = channel_order
+
+    @classmethod
+    def open(cls, file_name):
+        """Map an uncompressed BMP or TIFF file; return None if it can't be mapped."""
+        with Image.open(file_name) as pil_img:
+            tiles = pil_img.tile
+            width, height = pil_img.size
+        if not tiles or any(tile[0] != 'raw' for tile in tiles):
+            return None
+        rawmode, stride, orientation = tiles[0][3]
+        if rawmode not in CHANNEL_FORMATS:
+            return None
+        channels = CHANNEL_FORMATS[rawmode][0]
+        stride = stride or width * channels
+        offset = tiles[0][2]
+        # Strips must cover full rows and follow each other in the file
+        for tile in tiles:
+            x0, y0, x1, y1 = tile[1]
+            if x0 != 0 or x1 != width or tile[2] != offset + y0 * stride:
+                return None
+        raw = np.memmap(file_name, dtype=np.uint8, mode='r', offset=offset, shape=(height, stride))
+        array = raw[:, :width * channels].reshape(height, width, channels)
+        if orientation < 0:
+            array = array[::-1]
+        return cls(array, rawmode)
+
+    @classmethod
+    def open_raw(cls, file_name, width, height, channel_order='RGB', offset=0):
+        """Map a headerless raw pixel dump."""
+        channels = CHANNEL_FORMATS[channel_order][0]
+        array = np.memmap(file_name, dtype=np.uint8, mode='r', offset=offset, shape=(height, width, channels))
+        return cls(array, channel_order)
+
+    @classmethod
+    def scratch(cls, width, height, channel_order='RGBA'):
+        """Create a writable store backed by an anonymous temporary file."""
+        channels = CHANNEL_FORMATS[channel_order][0]
+        array = np.memmap(tempfile.TemporaryFile(), dtype=np.uint8, mode='w+', shape=(height, width, channels))
+        return cls(array, channel_order)
+
+    def width(self):
+        return self.array.shape[1]
+
+    def height(self):
+        return self.array.shape[0]
+
+    def region(self, rect):
+        """Return a view of the pixels inside a QRect, clipped to the image."""
+        x0 = max(0, rect.x())
+        y0 = max(0, rect.y())
+        x1 = min(self.width(), rect.x() + rect.width())
+        y1 = min(self.height(), rect.y() + rect.height())
+        return self.array[y0:y1, x0:x1]
+
+    def crop(self, rect):
+        return BackingStore(self.region(rect), self.channel_order)
+
+    def flipped(self, horizontal=True):
+        return BackingStore(self.array[:, ::-1] if horizontal else self.array[::-1], self.channel_order)
+
+    def rotated(self, degrees):
+        """Rotate by a multiple of 90 degrees clockwise."""
+        return BackingStore(np.rot90(self.array, -(degrees // 90) % 4), self.channel_order)
+
+    def _qimage(self, array):
+        """Copy a (small) array into a QImage in the editor's working format."""
+        array = np.ascontiguousarray(array)
+        height, width, channels = array.shape
+        qformat = CHANNEL_FORMATS[self.channel_order][1]
+        if self.channel_order == 'L':
+            return QImage(array.data, width, height, width, qformat).copy()
+        target = QImage.Format_ARGB32 if self.channel_order.endswith('A') else QImage.Format_RGB32
+        return QImage(array.data, width, height, width * channels, qformat).convertToFormat(target)
+
+    def toImage(self, rect=None):
+        """Return the full image, or the region inside rect, as a heap QImage."""
+        return self._qimage(self.array if rect is None else self.region(rect))
+
+    def overview(self, max_pixels):
+        """Return a strided sample of the image with at most max_pixels pixels for display."""
+        step = max(1, int(np.ceil((self.width() * self.height() / max_pixels) ** 0.5)))
+        return self._qimage(self.array[::step, ::step])
+
+    def save(self, file_name):
+        """Save the store, streaming rows through a scratch map when needed."""
+        jpeg = file_name.lower().endswith(('.jpg', '.jpeg'))
+        if self.channel_order == 'L':
+            mode = 'L'
+        else:
+            mode = 'RGBX' if jpeg else 'RGBA'
+        if self.channel_order == mode and self.array.flags.c_contiguous:
+            buffer = self.array
+        else:
+            buffer = self._to_scratch(mode).array
+        pil_img = Image.frombuffer(mode, (self.width(), self.height()), buffer, 'raw', mode, 0, 1)
+        pil_img.save(file_name)
+        return True
+
+    def _to_scratch(self, channel_order):
+        """Copy the pixels band by band into a contiguous scratch store."""
+        target = BackingStore.scratch(self.width(), self.height(), channel_order)
+        source_order = self.channel_order
+        for y in range(0, self.height(), BAND_ROWS):
+            band = self.array[y:y + BAND_ROWS]
+            out = target.array[y:y + BAND_ROWS]
+            if channel_order == 'L':
+                out[:, :, 0] = band[:, :, 0]
+                continue
+            if source_order == 'L':
+                out[:, :, :3] = band
+            else:
+                for i, channel in enumerate('RGB'):
+                    out[:, :, i] = band[:, :, source_order.index(channel)]
+            out[:, :, 3] = band[:, :, 3] if source_order.endswith('A') else 255
+        target.array.flush()
+        return target
@@ -0,0 +1 @@
+"""Offscreen performance benchmarks for Simple Photo Editor."""
@@ -0,0 +1,184 @@
+"""
+Time every editing command's execute/undo/redo on synthetic images.
+
+Run from the repository root:
+    python -m benchmarks.bench_commands --sizes 2 12 --save-baseline baseline.json
+    python -m benchmarks.bench_commands --sizes 2 12 --baseline baseline.json
+"""
+
+import sys
+from PyQt5.QtCore import QRect, QRectF
+from benchmarks.common import (
+    parse_args, create_editor, reset_editor, synthetic_image, timed, result_key, finish
+)
+
+
+def centre_rect(editor):
+    image = editor.current_image
+    return QRect(image.width() // 4, image.height() // 4, image.width() // 2, image.height() // 2)
+
+
+def select(editor, rect):
+    editor.scene.selection_rect = editor.scene.addRect(QRectF(rect))
+
+
+def select_area(editor, size=500):
+    """Select a size x size square in the middle of the image."""
+    # Like a freshly opened file, the document then owns its pixels, so in-place edits don't copy them
+    editor.setImage(editor.current_image.copy())
+    image = editor.current_image
+    select(editor, QRect((image.width() - size) // 2, (image.height() - size) // 2, size, size))
+
+
+def put_region_on_clipboard(editor):
+    from clipboard import set_clipboard_image
+    set_clipboard_image(editor.current_image.copy(centre_rect(editor)))
+
+
+def paste_items(editor):
+    put_region_on_clipboard(editor)
+    editor.paste()
+
+
+def paste_stamps(editor, count=300, size=128):
+    """Paste count small tiles of the image as layers scattered over it, like stamps on a form scan."""
+    from PyQt5.QtCore import QPoint
+    from layers import Layer
+    from scene import MovableImageItem
+    image = editor.current_image
+    span_x, span_y = max(1, image.width() - size), max(1, image.height() - size)
+    editor.addLayers([MovableImageItem(Layer(image.copy(QRect(index, index, size, size)),
+                                             QPoint(index * 7919 % span_x, index * 104729 % span_y)))
+                      for index in range(count)])
+
+
+def run_crop(editor):
+    from commands import CropCommand
+    editor.executeCommand(CropCommand(editor, centre_rect(editor)))
+
+
+def run_adjustments(editor, autobalance=False, region=None):
+    from commands import AdjustmentsCommand
+    editor.executeCommand(AdjustmentsCommand(editor, 0.1, 0.1, 1.1, autobalance, region=region))
+
+
+def run_curves(editor, region=None):
+    from commands import CurvesCommand
+    from curves import Curves
+    curves = Curves()
+    curves.channels["rgb"].points = [(0, 0), (64, 48), (192, 210), (255, 255)]
+    curves.channels["blue"].in_black = 12
+    editor.executeCommand(CurvesCommand(editor, curves, region=region))
+
+
+def run_grade(editor, region=None):
+    from commands import ColorGradeCommand
+    from grading import ColorGrade
+    editor.executeCommand(ColorGradeCommand(editor, ColorGrade(temperature=20, hue=10, saturation=15, vibrance=30),
+                                            region=region))
+
+
+def run_convert_mode(editor, mode, **options):
+    from quantize import ModeConversion
+    editor.convertMode(ModeConversion(mode, **options))
+
+
+def skew_page(editor, degrees=2.5, spacing=40):
+    """Rule dark lines across the image, like lines of text, and tilt it by degrees."""
+    from imaging import image_array
+    from resampling import rotate_image
+    image = editor.current_image.copy()
+    pixels = image_array(image, writable=True)
+    pixels[::spacing, :, :3] //= 4
+    pixels[1::spacing, :, :3] //= 4
+    editor.setImage(rotate_image(image, degrees, "bilinear", "white"))
+
+
+def page_corners(editor):
+    """Return the corners of a quadrilateral inset unevenly from the image's, like a photographed page."""
+    width, height = editor.current_image.width(), editor.current_image.height()
+    return [(0.08 * width, 0.05 * height), (0.95 * width, 0.02 * height),
+            (0.9 * width, 0.97 * height), (0.03 * width, 0.92 * height)]
+
+
+def run_resize(editor):
+    image = editor.current_image
+    editor.resizeImage(image.width() // 2, image.height() // 2, False)
+
+
+# name: (untimed setup, timed execute)
+CASES = {
+    "crop": (None, run_crop),
+    "adjustments": (None, run_adjustments),
+    "adjustments_autobalance": (None, lambda editor: run_adjustments(editor, True)),
+    "rotate_90": (None, lambda editor: editor.rotateImage(90)),
+    "rotate_arbitrary": (None, lambda editor: editor.rotateImage(7)),
+    "flip": (None, lambda editor: editor.flipImage(True)),
+    "grayscale": (None, lambda editor: editor.convertToGrayscale()),
+    "adjustments_selection": (select_area, lambda editor: run_adjustments(editor, region=editor.selectionRect())),
+    "grayscale_selection": (select_area, lambda editor: editor.convertToGrayscale()),
+    "curves": (None, run_curves),
+    "curves_selection": (select_area, lambda editor: run_curves(editor, editor.selectionRect())),
+    "grade": (None, run_grade),
+    "grade_selection": (select_area, lambda editor: run_grade(editor, editor.selectionRect())),
+    "convert_palette": (None, lambda editor: run_convert_mode(editor, "palette")),
+    "convert_palette_dither": (None, lambda editor: run_convert_mode(editor, "palette", dither="bayer")),
+    "convert_mono": (None, lambda editor: run_convert_mode(editor, "mono")),
+    "resize": (None, run_resize),
+    "deskew": (skew_page, lambda editor: editor.deskew()),
+    "perspective": (None, lambda editor: editor.correctPerspective(page_corners(editor))),
+    "cut": (lambda editor: select(editor, centre_rect(editor)), lambda editor: editor.cut()),
+    "paste": (put_region_on_clipboard, lambda editor: editor.paste()),
+    "fix_paste": (paste_items, lambda editor: editor.flattenLayers()),
+    "fix_paste_many": (paste_stamps, lambda editor: editor.flattenLayers()),
+}
+
+
+def record(results, case, phase, megapixels, seconds, conversions=None):
+    entry = {"seconds": seconds, "mp_per_s": megapixels / seconds if seconds > 0 else float("inf")}
+    if conversions is not None:
+        entry["conversions"] = conversions
+    key = result_key(case, phase, megapixels)
+    if key not in results or seconds < results[key]["seconds"]:
+        results[key] = entry
+
+
+def benchmark_size(editor, megapixels, cases, repeat, results):
+    from imaging import conversion_stats, reset_conversion_stats
+    base = synthetic_image(megapixels)
+    for _ in range(repeat):
+        record(results, "set_image", "execute", megapixels, timed(editor.setImage, base))
+    for case in cases:
+        setup, run = CASES[case]
+        for _ in range(repeat):
+            reset_editor(editor, base)
+            if setup:
+                setup(editor)
+            reset_conversion_stats()
+            seconds = timed(run, editor)
+            record(results, case, "execute", megapixels, seconds, sum(conversion_stats().values()))
+            record(results, case, "undo", megapixels, timed(editor.undo))
+            record(results, case, "redo", megapixels, timed(editor.redo))
+    reset_editor(editor, base)
+
+
+def main():
+    args = parse_args("Benchmark editing commands on synthetic images.")
+    cases = args.cases or list(CASES)
+    unknown = [case for case in cases if case not in CASES]
+    if unknown:
+        print(f"Unknown cases: {', '.join(unknown)}; available: {', '.join(CASES)}")
+        return 2
+    window, editor = create_editor()
+    results = {}
+    for megapixels in args.sizes:
+        benchmark_size(editor, megapixels, cases, args.repeat, results)
+        print(f"--- {megapixels} MP ---")
+        for key, entry in sorted(results.items()):
+            if key.endswith(f"@{megapixels}MP"):
+                print(f"{key.split('@')[0]:<36} {entry['seconds'] * 1000:10.1f} ms {entry['mp_per_s']:10.1f} MP/s")
+    return finish(args, results)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,60 @@
+"""
+Time every filter of filters.FILTERS per image size and radius.
+
+Filters run on the synthetic images through filter_image(), in the same
+overlapping bands the editor uses, and report seconds and MP/s.
+
+Run from the repository root:
+    python -m benchmarks.bench_filters --sizes 12 45 --radii 1 4 16
+    python -m benchmarks.bench_filters --sizes 12 --baseline filters.json
+"""
+
+import sys
+from benchmarks.common import application, parse_args, synthetic_image, timed, result_key, finish
+
+DEFAULT_RADII = (1, 4, 16)
+
+# Slider defaults of the filter dialog
+AMOUNTS = {"unsharp_mask": 100, "bilateral": 30}
+
+
+def benchmark_size(megapixels, names, radii, repeat, results):
+    from filters import filter_image
+    image = synthetic_image(megapixels)
+    for name in names:
+        for radius in radii:
+            seconds = min(timed(filter_image, image, name, radius, AMOUNTS.get(name, 0)) for _ in range(repeat))
+            results[result_key(name, f"r{radius}", megapixels)] = {
+                "seconds": seconds,
+                "mp_per_second": megapixels / seconds if seconds else 0.0,
+            }
+
+
+def add_options(parser):
+    parser.add_argument("--radii", type=float, nargs="+", default=list(DEFAULT_RADII),
+                        help="filter radii in pixels")
+
+
+def main():
+    from filters import FILTERS
+    args = parse_args("Time the filters per megapixel and radius.", default_sizes=(2, 12, 45), extra=add_options)
+    args.radii = [int(radius) if float(radius).is_integer() else radius for radius in args.radii]
+    application()
+    names = args.cases or list(FILTERS)
+    unknown = [name for name in names if name not in FILTERS]
+    if unknown:
+        print(f"Unknown cases: {', '.join(unknown)}; available: {', '.join(FILTERS)}")
+        return 2
+    results = {}
+    for megapixels in args.sizes:
+        benchmark_size(megapixels, names, args.radii, args.repeat, results)
+        print(f"--- {megapixels} MP ---")
+        for name in names:
+            for radius in args.radii:
+                entry = results[result_key(name, f"r{radius}", megapixels)]
+                print(f"{name:<14} r={radius:<5} {entry['seconds'] * 1000:9.1f} ms  {entry['mp_per_second']:8.1f} MP/s")
+    return finish(args, results)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
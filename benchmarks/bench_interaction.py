@@ -0,0 +1,284 @@
+"""
+Replay scripted viewport interactions offscreen and report latency percentiles.
+
+Each case drives the editor's viewport with QTest presses/releases and
+synthetic move and wheel events, letting Qt paint after every step. The
+frame_timing instrumentation in ImageEditor, RulerWidget and
+ImageEditorScene records paint times and input-to-paint latency.
+
+Run from the repository root:
+    python -m benchmarks.bench_interaction --sizes 12 45
+    python -m benchmarks.bench_interaction --sizes 45 --baseline interaction.json
+    python -m benchmarks.bench_interaction --sizes 12 --monitor-profile display.icc
+"""
+
+import math
+import sys
+from PyQt5.QtCore import Qt, QPoint, QPointF, QEvent
+from PyQt5.QtGui import QMouseEvent, QWheelEvent
+from PyQt5.QtTest import QTest
+from PyQt5.QtWidgets import QApplication, QGraphicsView
+from benchmarks.common import parse_args, create_editor, reset_editor, synthetic_image, result_key, finish
+
+# Input events per interaction
+STEPS = 120
+
+
+def paint_now():
+    """Deliver pending events, including the paint the last input scheduled."""
+    QApplication.processEvents()
+
+
+def move(viewport, pos, buttons=Qt.LeftButton):
+    # QTest.mouseMove can't hold a button down, so drags are sent as raw move events
+    event = QMouseEvent(QEvent.MouseMove, QPointF(pos), Qt.NoButton, buttons, Qt.NoModifier)
+    QApplication.sendEvent(viewport, event)
+    paint_now()
+
+
+def drag(viewport, points):
+    QTest.mousePress(viewport, Qt.LeftButton, Qt.NoModifier, points[0])
+    paint_now()
+    for point in points[1:]:
+        move(viewport, point)
+    QTest.mouseRelease(viewport, Qt.LeftButton, Qt.NoModifier, points[-1])
+    paint_now()
+
+
+def circle(center, radius, steps=STEPS):
+    return [center + QPoint(int(radius * math.cos(2 * math.pi * i / steps)),
+                            int(radius * math.sin(2 * math.pi * i / steps))) for i in range(steps + 1)]
+
+
+def line(start, end, steps=STEPS):
+    return [start + (end - start) * i / steps for i in range(steps + 1)]
+
+
+def use_tool(editor, tool):
+    editor.scene.current_tool = tool
+    editor.setDragMode(QGraphicsView.ScrollHandDrag if tool == "pan" else QGraphicsView.NoDrag)
+
+
+def run_pan(editor):
+    """Hand-drag the image around at 100% zoom."""
+    use_tool(editor, "pan")
+    editor.actualSize()
+    paint_now()
+    viewport = editor.viewport()
+    drag(viewport, circle(viewport.rect().center(), min(viewport.width(), viewport.height()) // 3))
+
+
+def run_wheel(editor):
+    """Scroll with the mouse wheel at 100% zoom."""
+    editor.actualSize()
+    paint_now()
+    viewport = editor.viewport()
+    center = QPointF(viewport.rect().center())
+    for i in range(STEPS):
+        delta = -120 if (i // 20) % 2 == 0 else 120
+        event = QWheelEvent(center, QPointF(viewport.mapToGlobal(center.toPoint())), QPoint(), QPoint(0, delta),
+                            Qt.NoButton, Qt.NoModifier, Qt.NoScrollPhase, False)
+        QApplication.sendEvent(viewport, event)
+        paint_now()
+
+
+def run_zoom(editor):
+    """Zoom in and out step by step, as the zoom actions do."""
+    import frame_timing
+    for i in range(STEPS):
+        frame_timing.input_received()
+        if (i // 10) % 2 == 0:
+            editor.zoomIn()
+        else:
+            editor.zoomOut()
+        paint_now()
+
+
+def run_selection_drag(editor):
+    """Drag out a selection rectangle across the fitted image."""
+    use_tool(editor, "selection")
+    viewport = editor.viewport()
+    rect = viewport.rect()
+    drag(viewport, line(rect.topLeft() + QPoint(20, 20), rect.bottomRight() - QPoint(20, 20)))
+
+
+def select_for_resize(editor):
+    use_tool(editor, "selection")
+    viewport = editor.viewport()
+    rect = viewport.rect()
+    drag(viewport, line(rect.topLeft() + QPoint(40, 40), rect.center(), 4))
+
+
+def run_handle_resize(editor):
+    """Drag the bottom-right handle of an existing selection."""
+    viewport = editor.viewport()
+    corner = editor.mapFromScene(editor.scene.selection_rect.rect().bottomRight())
+    drag(viewport, line(corner, viewport.rect().bottomRight() - QPoint(30, 30)))
+
+
+def run_brush_stroke(editor):
+    """Paint a loop with a 50 pixel brush at 100% zoom."""
+    from brush import Brush
+    editor.window().brush = Brush(50, opacity=0.8)
+    use_tool(editor, "brush")
+    editor.actualSize()
+    paint_now()
+    viewport = editor.viewport()
+    drag(viewport, circle(viewport.rect().center(), min(viewport.width(), viewport.height()) // 3))
+
+
+def run_clone_stroke(editor):
+    """Clone from 150 pixels to the left along a loop at 100% zoom."""
+    from brush import Brush
+    editor.window().brush = Brush(50)
+    use_tool(editor, "clone")
+    editor.actualSize()
+    paint_now()
+    viewport = editor.viewport()
+    center = viewport.rect().center()
+    QTest.mouseClick(viewport, Qt.LeftButton, Qt.AltModifier, center - QPoint(150, 0))
+    drag(viewport, circle(center, min(viewport.width(), viewport.height()) // 3))
+
+
+def paste_layers(editor, count=36, size=256):
+    """Paste count overlapping tiles of the image as layers around its centre, in every blend mode."""
+    from PyQt5.QtCore import QRect
+    from layers import Layer, BLEND_MODES
+    from scene import MovableImageItem
+    image = editor.current_image
+    modes = list(BLEND_MODES)
+    columns = math.ceil(math.sqrt(count))
+    step = size * 3 // 4
+    left = image.width() // 2 - ((columns - 1) * step + size) // 2
+    top = image.height() // 2 - ((columns - 1) * step + size) // 2
+    items = []
+    for index in range(count):
+        x, y = left + (index % columns) * step, top + (index // columns) * step
+        layer = Layer(image.copy(QRect(index * 37 % max(1, image.width() - size), 0, size, size)), QPoint(x, y),
+                      0.5 + 0.5 * (index % 2), modes[index % len(modes)])
+        items.append(MovableImageItem(layer))
+    editor.addLayers(items)
+    editor.actualSize()
+    editor.centerOn(image.width() / 2, image.height() / 2)
+    paint_now()
+
+
+def run_layer_drag(editor):
+    """Drag the pasted layer nearest the centre of the view across the others."""
+    viewport = editor.viewport()
+    centre = editor.mapToScene(viewport.rect().center())
+    item = min(editor.pasted_items.values(), key=lambda item: (item.sceneBoundingRect().center() - centre).manhattanLength())
+    start = editor.mapFromScene(item.sceneBoundingRect().center())
+    drag(viewport, line(start, start + QPoint(200, 150)))
+
+
+def run_curves_drag(editor):
+    """Drag the middle of the RGB curve up and down with the curves dialog previewing on the fitted image."""
+    from widgets import CurvesDialog
+    dialog = CurvesDialog(editor, editor.window())
+    dialog.show()
+    paint_now()
+    widget = dialog.curve_widget
+    start = widget.toWidget((128, 128)).toPoint()
+    points = line(start, start + QPoint(0, -80), STEPS // 2) + line(start + QPoint(0, -80), start + QPoint(0, 80),
+                                                                     STEPS // 2)
+    drag(widget, points)
+    dialog.reject_dialog()
+    dialog.deleteLater()
+    paint_now()
+
+
+def run_grade_drag(editor):
+    """Drag the saturation slider of the colour grading dialog across its range, previewing on the fitted image."""
+    import frame_timing
+    from widgets import ColorGradeDialog
+    dialog = ColorGradeDialog(editor, editor.window())
+    dialog.show()
+    paint_now()
+    slider = dialog.sliders["saturation"]
+    y = slider.rect().center().y()
+    points = line(QPoint(slider.width() // 2, y), QPoint(slider.width() - 4, y))
+    QTest.mousePress(slider, Qt.LeftButton, Qt.NoModifier, points[0])
+    for point in points[1:]:
+        # QSlider isn't instrumented, so each move is marked as input here
+        frame_timing.input_received()
+        move(slider, point)
+    QTest.mouseRelease(slider, Qt.LeftButton, Qt.NoModifier, points[-1])
+    dialog.reject_dialog()
+    dialog.deleteLater()
+    paint_now()
+
+
+# name: (untimed setup, timed interaction)
+CASES = {
+    "pan": (None, run_pan),
+    "wheel": (None, run_wheel),
+    "zoom": (None, run_zoom),
+    "selection_drag": (None, run_selection_drag),
+    "handle_resize": (select_for_resize, run_handle_resize),
+    "brush_stroke": (None, run_brush_stroke),
+    "clone_stroke": (None, run_clone_stroke),
+    "layer_drag": (paste_layers, run_layer_drag),
+    "curves_drag": (None, run_curves_drag),
+    "grade_drag": (None, run_grade_drag),
+}
+
+# Histograms reported for every case
+METRICS = (
+    "input_to_paint", "ImageEditor.paint", "RulerWidget.paint", "ImageEditor.mouseMove",
+    "ImageEditorScene.mouseMove", "ImageEditor.wheel", "CurveWidget.mouseMove"
+)
+
+
+def benchmark_size(editor, megapixels, cases, repeat, results):
+    """Run every case repeat times; the histograms collect the samples of all runs."""
+    import frame_timing
+    base = synthetic_image(megapixels)
+    for case in cases:
+        setup, run = CASES[case]
+        frame_timing.reset()
+        for _ in range(repeat):
+            # Loading and setup are not part of the interaction
+            frame_timing.disable()
+            reset_editor(editor, base)
+            paint_now()
+            if setup:
+                setup(editor)
+            frame_timing.enable()
+            run(editor)
+        frame_timing.disable()
+        for metric in METRICS:
+            histogram = frame_timing.histograms.get(metric)
+            if histogram:
+                stats = histogram.percentiles()
+                stats["samples"] = len(histogram)
+                results[result_key(case, metric, megapixels)] = stats
+
+
+def add_options(parser):
+    parser.add_argument("--monitor-profile", help="show the document converted to this ICC profile")
+
+
+def main():
+    args = parse_args("Measure viewport latency for scripted interactions.", default_sizes=(12, 45),
+                      extra=add_options)
+    cases = args.cases or list(CASES)
+    unknown = [case for case in cases if case not in CASES]
+    if unknown:
+        print(f"Unknown cases: {', '.join(unknown)}; available: {', '.join(CASES)}")
+        return 2
+    window, editor = create_editor(args.monitor_profile)
+    editor.parent().toggleRulers(True)
+    results = {}
+    for megapixels in args.sizes:
+        benchmark_size(editor, megapixels, cases, args.repeat, results)
+        print(f"--- {megapixels} MP ---")
+        for key, entry in sorted(results.items()):
+            if key.endswith(f"@{megapixels}MP"):
+                print(f"{key.split('@')[0]:<44} n={entry['samples']:<4} p50={entry['p50']:7.2f} ms  "
+                      f"p95={entry['p95']:7.2f} ms  p99={entry['p99']:7.2f} ms")
+    return finish(args, results, key="p95", unit=" ms", minimum=args.min_seconds * 1000)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,248 @@
+"""
+Measure how much memory each editing operation allocates, in full frames.
+
+For every case the harness records the peak RSS above the level before the
+operation, the peak of Python/NumPy allocations traced by tracemalloc, and
+the image data the document keeps alive afterwards (current image, pixmap,
+history). Everything is expressed in frames: one frame is the size of the
+document in the 32-bit working format. A case fails when its peak exceeds
+its budget.
+
+Run from the repository root:
+    python -m benchmarks.bench_memory --sizes 45
+    python -m benchmarks.bench_memory --sizes 12 --budget rotate_arbitrary=6
+"""
+
+import ctypes
+import ctypes.util
+import gc
+import sys
+import tracemalloc
+from benchmarks.common import parse_args, create_editor, reset_editor, synthetic_image, result_key, finish
+from benchmarks.bench_commands import CASES as COMMAND_CASES
+
+# M_MMAP_THRESHOLD for mallopt()
+_M_MMAP_THRESHOLD = -3
+
+# Peak frames allowed per operation. Most commands copy the document for
+# their undo state and produce one new frame plus its display pixmap.
+BUDGETS = {
+    "set_image": 2.0,
+    "crop": 2.5,
+    "adjustments": 4.0,
+    "adjustments_autobalance": 4.0,
+    "curves": 4.0,
+    "grade": 4.0,
+    "rotate_90": 4.0,
+    "rotate_arbitrary": 4.5,
+    "flip": 4.0,
+    "grayscale": 2.5,
+    "resize": 2.5,
+    "cut": 4.0,
+    "paste": 2.0,
+    "fix_paste": 3.0,
+    "fix_paste_many": 3.0,
+    "adjustments_dialog_apply": 6.0,
+    "adjustments_dialog_cancel": 5.0,
+    "curves_dialog_apply": 4.5,
+    # Images that fit the window are previewed whole: the preview and its
+    # pixmap are a frame each, however little of them the dialog keeps
+    "curves_dialog_cancel": 2.5,
+    # The grade preview also indexes the colours it shows, a frame of int32
+    "grade_dialog_apply": 5.5,
+    "grade_dialog_cancel": 5.0,
+    "rotation_dialog_apply": 7.5,
+    "rotation_dialog_cancel": 4.5,
+}
+
+
+def _libc():
+    name = ctypes.util.find_library("c")
+    try:
+        return ctypes.CDLL(name) if name else None
+    except OSError:
+        return None
+
+
+_LIBC = _libc()
+
+
+def pin_mmap_threshold():
+    """Stop glibc from raising its mmap threshold after large frees.
+
+    Otherwise freed frames are kept on the heap and reused, and later
+    operations look cheaper than they are.
+    """
+    if _LIBC is not None and hasattr(_LIBC, "mallopt"):
+        _LIBC.mallopt(_M_MMAP_THRESHOLD, 1 << 20)
+
+
+def trim_heap():
+    gc.collect()
+    if _LIBC is not None and hasattr(_LIBC, "malloc_trim"):
+        _LIBC.malloc_trim(0)
+
+
+def adjustments_dialog(editor, accept):
+    from widgets import AdjustmentsDialog
+    dialog = AdjustmentsDialog(editor)
+    # Each slider move renders a preview
+    dialog.brightness_slider.setValue(10)
+    dialog.contrast_slider.setValue(10)
+    if accept:
+        dialog.applyAdjustments()
+    else:
+        dialog.reject_dialog()
+    dialog.deleteLater()
+
+
+def curves_dialog(editor, accept):
+    from widgets import CurvesDialog
+    dialog = CurvesDialog(editor)
+    # Each change renders a preview of the visible area
+    dialog.curve_widget.setPoints([(0, 0), (128, 160), (255, 255)])
+    dialog.curve_widget.pointsChanged.emit()
+    dialog.in_black.setValue(8)
+    if accept:
+        dialog.applyCurves()
+    else:
+        dialog.reject_dialog()
+    dialog.deleteLater()
+
+
+def grade_dialog(editor, accept):
+    from widgets import ColorGradeDialog
+    dialog = ColorGradeDialog(editor)
+    # Each slider move renders a preview of the visible area
+    dialog.sliders["temperature"].setValue(20)
+    dialog.sliders["saturation"].setValue(15)
+    if accept:
+        dialog.applyGrade()
+    else:
+        dialog.reject_dialog()
+    dialog.deleteLater()
+
+
+def rotation_dialog(editor, accept):
+    from widgets import RotationDialog
+    dialog = RotationDialog(editor)
+    dialog.angle_slider.setValue(15)
+    dialog.live_preview_rotation(15)
+    if accept:
+        dialog.accept()
+        editor.apply_rotation(dialog.get_angle(), dialog.get_interpolation(), dialog.get_fill())
+    else:
+        dialog.reject_dialog()
+    dialog.deleteLater()
+
+
+CASES = dict(COMMAND_CASES)
+CASES.update({
+    "adjustments_dialog_apply": (None, lambda editor: adjustments_dialog(editor, True)),
+    "adjustments_dialog_cancel": (None, lambda editor: adjustments_dialog(editor, False)),
+    "curves_dialog_apply": (None, lambda editor: curves_dialog(editor, True)),
+    "curves_dialog_cancel": (None, lambda editor: curves_dialog(editor, False)),
+    "grade_dialog_apply": (None, lambda editor: grade_dialog(editor, True)),
+    "grade_dialog_cancel": (None, lambda editor: grade_dialog(editor, False)),
+    "rotation_dialog_apply": (None, lambda editor: rotation_dialog(editor, True)),
+    "rotation_dialog_cancel": (None, lambda editor: rotation_dialog(editor, False)),
+})
+
+
+def measure(editor, run, frame):
+    """Run run(editor) and return its memory use in frames."""
+    from memory_usage import current_rss, peak_rss, reset_peak_rss, document_memory
+    trim_heap()
+    retained_before = sum(document_memory(editor).values())
+    rss_before = current_rss()
+    exact_peak = reset_peak_rss()
+    tracemalloc.reset_peak()
+    traced_before = tracemalloc.get_traced_memory()[0]
+    run(editor)
+    traced_peak = tracemalloc.get_traced_memory()[1] - traced_before
+    peak = max(0, peak_rss() - rss_before)
+    retained = sum(document_memory(editor).values()) - retained_before
+    return {
+        "peak_frames": peak / frame,
+        "traced_frames": traced_peak / frame,
+        # What tracemalloc can't see: pixel buffers allocated by Qt itself
+        "native_frames": max(0, peak - traced_peak) / frame,
+        "retained_frames": retained / frame,
+        "exact_peak": exact_peak,
+    }
+
+
+def record(results, case, megapixels, entry):
+    key = result_key(case, "execute", megapixels)
+    if key not in results or entry["peak_frames"] < results[key]["peak_frames"]:
+        results[key] = entry
+
+
+def benchmark_size(editor, megapixels, cases, repeat, results):
+    from memory_usage import frame_bytes
+    base = synthetic_image(megapixels)
+    frame = frame_bytes(base)
+    for _ in range(repeat):
+        reset_editor(editor, base)
+        record(results, "set_image", megapixels, measure(editor, lambda e: e.setImage(base), frame))
+    for case in cases:
+        setup, run = CASES[case]
+        for _ in range(repeat):
+            reset_editor(editor, base)
+            if setup:
+                setup(editor)
+            record(results, case, megapixels, measure(editor, run, frame))
+    reset_editor(editor, base)
+
+
+def parse_budgets(items):
+    budgets = dict(BUDGETS)
+    for item in items:
+        case, _, frames = item.partition("=")
+        budgets[case] = float(frames)
+    return budgets
+
+
+def check_budgets(results, budgets):
+    """Return (name, peak, budget) for every result over its budget."""
+    failures = []
+    for name, entry in sorted(results.items()):
+        budget = budgets.get(name.split(".")[0])
+        if budget is not None and entry["peak_frames"] > budget:
+            failures.append((name, entry["peak_frames"], budget))
+    return failures
+
+
+def main():
+    args = parse_args("Measure peak memory of editing operations in frames.", default_sizes=(12, 45),
+                      extra=lambda parser: parser.add_argument(
+                          "--budget", action="append", default=[], metavar="CASE=FRAMES",
+                          help="override the peak budget of one case"))
+    cases = args.cases or list(CASES)
+    unknown = [case for case in cases if case not in CASES]
+    if unknown:
+        print(f"Unknown cases: {', '.join(unknown)}; available: {', '.join(CASES)}")
+        return 2
+    pin_mmap_threshold()
+    tracemalloc.start()
+    window, editor = create_editor()
+    results = {}
+    for megapixels in args.sizes:
+        benchmark_size(editor, megapixels, cases, args.repeat, results)
+        print(f"--- {megapixels} MP (frames per operation) ---")
+        print(f"{'':<36} {'peak':>7} {'traced':>7} {'native':>7} {'kept':>7}")
+        for key, entry in sorted(results.items()):
+            if key.endswith(f"@{megapixels}MP"):
+                print(f"{key.split('@')[0]:<36} {entry['peak_frames']:7.2f} {entry['traced_frames']:7.2f} "
+                      f"{entry['native_frames']:7.2f} {entry['retained_frames']:7.2f}")
+    if not all(entry["exact_peak"] for entry in results.values()):
+        print("Warning: the peak RSS can't be reset on this system; peaks are upper bounds")
+    failures = check_budgets(results, parse_budgets(args.budget))
+    for name, peak, budget in failures:
+        print(f"OVER BUDGET {name}: {peak:.2f} frames (budget {budget:.2f})")
+    status = finish(args, results, key="peak_frames", unit=" frames")
+    return 1 if failures else status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
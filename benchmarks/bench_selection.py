@@ -0,0 +1,78 @@
+"""
+Time building and using lasso, polygon and magic wand selections.
+
+polygon and lasso rasterize a 12-point polygon and a 5000-point wavy loop
+over most of the image, wand floods from the centre, outline traces the
+lasso's marching ants and masked_adjustments applies an adjustment through
+the lasso mask. Reports seconds and MP/s of the image.
+
+Run from the repository root:
+    python -m benchmarks.bench_selection --sizes 12 45
+    python -m benchmarks.bench_selection --sizes 12 --baseline selection.json
+"""
+
+import sys
+import numpy as np
+from benchmarks.common import (
+    application, parse_args, create_editor, reset_editor, synthetic_image, timed, result_key, finish
+)
+
+CASES = ("polygon", "lasso", "wand", "outline", "masked_adjustments")
+
+
+def polygon_points(image, count, wobble=0.0):
+    """Return count points on a loop around the image centre, reaching 45% of its size."""
+    angles = np.linspace(0, 2 * np.pi, count, endpoint=False)
+    radius = 0.45 * (1 + wobble * np.sin(37 * angles)) / (1 + wobble)
+    return np.stack([image.width() * (0.5 + radius * np.cos(angles)),
+                     image.height() * (0.5 + radius * np.sin(angles))], axis=1)
+
+
+def benchmark_size(editor, megapixels, names, repeat, results):
+    from selection_mask import SelectionMask, magic_wand, mask_outline
+    from commands import AdjustmentsCommand
+    image = synthetic_image(megapixels)
+    reset_editor(editor, image)
+    polygon = polygon_points(image, 12)
+    lasso = polygon_points(image, 5000, wobble=0.1)
+    mask = SelectionMask.from_polygon(lasso, image.rect())
+    cases = {
+        "polygon": lambda: SelectionMask.from_polygon(polygon, image.rect()),
+        "lasso": lambda: SelectionMask.from_polygon(lasso, image.rect()),
+        "wand": lambda: magic_wand(image, image.width() // 2, image.height() // 2),
+        "outline": lambda: mask_outline(mask),
+    }
+
+    def adjust():
+        editor.executeCommand(AdjustmentsCommand(editor, 0.2, 0.1, 1.0, region=mask.rect, mask=mask))
+        editor.undo()
+    cases["masked_adjustments"] = adjust
+    for name in names:
+        seconds = min(timed(cases[name]) for _ in range(repeat))
+        results[result_key(name, "build" if name != "masked_adjustments" else "execute", megapixels)] = {
+            "seconds": seconds,
+            "mp_per_second": megapixels / seconds if seconds else 0.0,
+        }
+
+
+def main():
+    args = parse_args("Time lasso, polygon and magic wand selections.", default_sizes=(2, 12, 45))
+    application()
+    names = args.cases or list(CASES)
+    unknown = [name for name in names if name not in CASES]
+    if unknown:
+        print(f"Unknown cases: {', '.join(unknown)}; available: {', '.join(CASES)}")
+        return 2
+    window, editor = create_editor()
+    results = {}
+    for megapixels in args.sizes:
+        benchmark_size(editor, megapixels, names, args.repeat, results)
+        print(f"--- {megapixels} MP ---")
+        for key, entry in results.items():
+            if key.endswith(f"@{megapixels}MP"):
+                print(f"{key.split('.')[0]:<20} {entry['seconds'] * 1000:9.1f} ms  {entry['mp_per_second']:8.1f} MP/s")
+    return finish(args, results)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,163 @@
+"""
+Shared helpers for the offscreen benchmarks: Qt setup, synthetic images,
+timing and comparison against a stored baseline.
+"""
+
+import os
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import argparse
+import configparser
+import json
+import time
+import numpy as np
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtGui import QImage
+
+# Synthetic image sizes in megapixels
+DEFAULT_SIZES = (2, 12, 45, 100)
+
+_app = None
+
+
+def application():
+    """Return the QApplication, creating an offscreen one if needed."""
+    global _app
+    _app = QApplication.instance() or QApplication([])
+    return _app
+
+
+def synthetic_image(megapixels, image_format=QImage.Format_RGB32):
+    """Build a 4:3 test image with gradients and noise (so nothing compresses to a constant)."""
+    height = int((megapixels * 1e6 * 3 / 4) ** 0.5)
+    width = int(megapixels * 1e6 / height)
+    # Fractional sizes are allowed; the seed must be an int
+    rng = np.random.default_rng(round(megapixels * 1000))
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, np.newaxis]
+    pixels = np.empty((height, width, 4), dtype=np.uint8)
+    pixels[:, :, 0] = x
+    pixels[:, :, 1] = y
+    pixels[:, :, 2] = (x + y) / 2
+    pixels[:, :, :3] ^= rng.integers(0, 16, (1, width, 1), dtype=np.uint8)
+    pixels[:, :, 3] = 255
+    image = QImage(pixels.data, width, height, width * 4, QImage.Format_RGB32).copy()
+    return image if image_format == QImage.Format_RGB32 else image.convertToFormat(image_format)
+
+
+def create_editor(monitor_profile=None):
+    """Create a main window with one MDI document and return (window, editor).
+
+    monitor_profile is the path of an ICC profile to show documents in;
+    without one they are shown unconverted.
+    """
+    from main_window import MainWindow
+    from widgets import CustomMdiSubWindow
+    application()
+    config = configparser.ConfigParser()
+    config.read_dict({"Editor": {"monitor_profile": monitor_profile or ""}})
+    window = MainWindow(config)
+    sub_window = CustomMdiSubWindow(window)
+    window.mdi_area.addSubWindow(sub_window)
+    window.resize(1280, 960)
+    window.show()
+    sub_window.showMaximized()
+    editor = sub_window.editor_container.editor
+    # Time the edits themselves, not a hand-off to a worker thread
+    editor.background_min_pixels = None
+    return window, editor
+
+
+def reset_editor(editor, image):
+    """Load image into editor with empty history and no selection or pasted items."""
+    scene = editor.scene
+    editor.removeLayers(editor.layerItems())
+    if scene.selection_rect:
+        scene.removeItem(scene.selection_rect)
+        scene.selection_rect = None
+    for handle in scene.handles:
+        scene.removeItem(handle)
+    scene.handles.clear()
+    editor.setImage(image)
+    editor.undo_stack.clear()
+    editor.redo_stack.clear()
+    editor.image_before_preview = None
+
+
+def timed(function, *args):
+    """Run function once and return the elapsed wall time in seconds."""
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def result_key(case, phase, megapixels):
+    return f"{case}.{phase}@{megapixels}MP"
+
+
+def parse_args(description, default_sizes=DEFAULT_SIZES, extra=None):
+    """Parse the options shared by all benchmarks; extra(parser) may add more."""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--sizes", type=float, nargs="+", default=list(default_sizes),
+                        help="image sizes in megapixels")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement; the best one is kept")
+    parser.add_argument("--cases", nargs="+", help="only run these cases")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--baseline", help="compare against results stored in this JSON file")
+    parser.add_argument("--save-baseline", help="store the results as a new baseline in this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="allowed slowdown against the baseline (0.25 = 25%%)")
+    parser.add_argument("--case-threshold", action="append", default=[], metavar="CASE=RATIO",
+                        help="override the threshold for one case, e.g. rotate_arbitrary=0.5")
+    parser.add_argument("--min-seconds", type=float, default=0.005,
+                        help="ignore baseline timings shorter than this (they are mostly noise)")
+    if extra:
+        extra(parser)
+    args = parser.parse_args()
+    args.sizes = [int(size) if float(size).is_integer() else size for size in args.sizes]
+    args.case_thresholds = {}
+    for item in args.case_threshold:
+        case, _, ratio = item.partition("=")
+        args.case_thresholds[case] = float(ratio)
+    return args
+
+
+def compare_with_baseline(results, baseline, threshold, case_thresholds=None, key="seconds", minimum=0.0):
+    """Return a list of (name, baseline, current, ratio) for results that regressed."""
+    case_thresholds = case_thresholds or {}
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        previous = baseline[name][key]
+        current = result[key]
+        if previous <= 0 or previous < minimum:
+            continue
+        ratio = current / previous
+        limit = case_thresholds.get(name.split(".")[0], threshold)
+        if ratio > 1.0 + limit:
+            regressions.append((name, previous, current, ratio))
+    return regressions
+
+
+def finish(args, results, key="seconds", unit="s", minimum=None):
+    """Write, store and compare results; return the process exit code."""
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"Baseline saved to {args.save_baseline}")
+    if not args.baseline:
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if minimum is None:
+        minimum = args.min_seconds if key == "seconds" else 0.0
+    regressions = compare_with_baseline(results, baseline, args.threshold, args.case_thresholds, key, minimum)
+    for name, previous, current, ratio in regressions:
+        print(f"REGRESSION {name}: {previous:.4g}{unit} -> {current:.4g}{unit} ({ratio:.2f}x)")
+    if not regressions:
+        print(f"No regressions against {args.baseline}")
+    return 1 if regressions else 0
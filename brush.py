@@ -0,0 +1,186 @@
+import math
+from collections import OrderedDict
+import numpy as np
+from PyQt5.QtGui import QImage, QColor, qGray
+from PyQt5.QtCore import Qt, QRect
+from imaging import image_array, array_to_image
+
+DEFAULT_BRUSH_SIZE = 20
+DEFAULT_HARDNESS = 0.8
+DEFAULT_OPACITY = 1.0
+
+# Distance between dabs along a stroke, in brush diameters
+DAB_SPACING = 0.25
+
+# Side of the tiles a stroke saves the original pixels and its coverage in
+TILE_SIZE = 128
+
+# Dab masks kept for reuse, by (diameter, hardness, opacity)
+DAB_CACHE_SIZE = 32
+_dab_cache = OrderedDict()
+
+STROKE_MODES = ("brush", "eraser", "clone")
+
+
+def dab_mask(diameter, hardness=DEFAULT_HARDNESS, opacity=DEFAULT_OPACITY):
+    """Return the coverage (0-255) of a round dab: full inside hardness, smooth falloff to the edge.
+
+    Masks are cached, so a stroke only builds one when the brush changes.
+    """
+    key = (diameter, round(hardness, 3), round(opacity, 3))
+    mask = _dab_cache.get(key)
+    if mask is not None:
+        _dab_cache.move_to_end(key)
+        return mask
+    centres = np.arange(diameter, dtype=np.float32) + 0.5 - diameter / 2
+    distance = np.hypot(centres[:, np.newaxis], centres) / (diameter / 2)
+    falloff = np.clip((1 - distance) / max(1 - hardness, 1e-3), 0, 1)
+    falloff = falloff * falloff * (3 - 2 * falloff)
+    mask = np.round(falloff * (255 * opacity)).astype(np.uint8)
+    mask.setflags(write=False)
+    _dab_cache[key] = mask
+    if len(_dab_cache) > DAB_CACHE_SIZE:
+        _dab_cache.popitem(last=False)
+    return mask
+
+
+class Brush:
+    """Size (diameter in pixels), hardness (0-1), opacity (0-1) and colour of the painting tools."""
+
+    def __init__(self, size=DEFAULT_BRUSH_SIZE, hardness=DEFAULT_HARDNESS, opacity=DEFAULT_OPACITY, color=None):
+        self.size = size
+        self.hardness = hardness
+        self.opacity = opacity
+        self.color = QColor(color) if color is not None else QColor(Qt.black)
+
+    def copy(self):
+        return Brush(self.size, self.hardness, self.opacity, self.color)
+
+
+def can_paint(image):
+    """Return True if strokes can be painted straight into image's pixels."""
+    return image.format() in (QImage.Format_RGB32, QImage.Format_ARGB32_Premultiplied, QImage.Format_Grayscale8)
+
+
+def _paint_value(image, mode, color):
+    """Return the pixel value brush and eraser strokes paint, in image's memory layout."""
+    if image.format() == QImage.Format_Grayscale8:
+        return np.uint8(255 if mode == "eraser" else qGray(color.rgb()))
+    if mode == "eraser":
+        # Transparent where there is alpha, white paper otherwise
+        value = (0, 0, 0, 0) if image.format() == QImage.Format_ARGB32_Premultiplied else (255, 255, 255, 255)
+    else:
+        value = (color.blue(), color.green(), color.red(), 255)
+    return np.array(value, dtype=np.uint8)
+
+
+class Stroke:
+    """A brush, eraser or clone stroke painted straight into the pixels of image.
+
+    Dabs are stamped every DAB_SPACING diameters along the lines between
+    input points. The stroke keeps the original pixels and its own coverage
+    per TILE_SIZE tile it touches, so overlapping dabs don't build up past
+    the brush opacity, and the pixels it changed can be restored. The clone
+    tool copies from offset (dx, dy) pixels away. Coordinates are in
+    editor (proxy) pixels; scale maps them to image's.
+    """
+
+    def __init__(self, image, brush, mode="brush", offset=(0, 0), scale=1.0):
+        if not can_paint(image):
+            raise ValueError(f"Can't paint on a format {image.format()} image")
+        self.image = image
+        self.pixels = image_array(image, writable=True)
+        self.brush = brush.copy()
+        self.mode = mode
+        self.scale = scale
+        self.diameter = max(1, round(brush.size * scale))
+        self.dab = dab_mask(self.diameter, brush.hardness, brush.opacity)
+        self.spacing = max(1.0, self.diameter * DAB_SPACING)
+        self.offset = (round(offset[0] * scale), round(offset[1] * scale))
+        self.value = None if mode == "clone" else _paint_value(image, mode, brush.color)
+        self.bounds = image.rect()
+        if mode == "clone":
+            # Only where the source is inside the image too
+            self.bounds = self.bounds.intersected(image.rect().translated(-self.offset[0], -self.offset[1]))
+        self.points = []
+        self.originals = {}
+        self.coverage = {}
+        self.dirty = QRect()
+        self.last = None
+        self.travelled = 0.0
+
+    def moveTo(self, x, y):
+        """Start the stroke at (x, y) with one dab; return the rectangle it changed."""
+        self.points.append((x, y))
+        self.last = (x * self.scale, y * self.scale)
+        self.travelled = 0.0
+        return self.stamp(*self.last)
+
+    def lineTo(self, x, y):
+        """Continue the stroke to (x, y); return the rectangle the dabs along the way changed."""
+        self.points.append((x, y))
+        x0, y0 = self.last
+        x1, y1 = x * self.scale, y * self.scale
+        length = math.hypot(x1 - x0, y1 - y0)
+        changed = QRect()
+        # Dabs continue the spacing of the previous segment
+        distance = self.spacing - self.travelled
+        while distance <= length:
+            t = distance / length
+            changed = changed.united(self.stamp(x0 + (x1 - x0) * t, y0 + (y1 - y0) * t))
+            distance += self.spacing
+        self.travelled = length - (distance - self.spacing)
+        self.last = (x1, y1)
+        return changed
+
+    def stamp(self, x, y):
+        """Stamp one dab centred on (x, y); return the rectangle it changed."""
+        left, top = round(x - self.diameter / 2), round(y - self.diameter / 2)
+        rect = QRect(left, top, self.diameter, self.diameter).intersected(self.bounds)
+        if rect.isEmpty():
+            return QRect()
+        for ty in range(rect.top() // TILE_SIZE, rect.bottom() // TILE_SIZE + 1):
+            for tx in range(rect.left() // TILE_SIZE, rect.right() // TILE_SIZE + 1):
+                piece = rect.intersected(QRect(tx * TILE_SIZE, ty * TILE_SIZE, TILE_SIZE, TILE_SIZE))
+                self.stamp_tile((tx, ty), piece, left, top)
+        self.dirty = self.dirty.united(rect)
+        return rect
+
+    def stamp_tile(self, tile, piece, left, top):
+        """Blend the part of the dab at (left, top) covering piece, which lies in tile."""
+        tile_x, tile_y = tile[0] * TILE_SIZE, tile[1] * TILE_SIZE
+        original = self.originals.get(tile)
+        if original is None:
+            rows = slice(tile_y, min(tile_y + TILE_SIZE, self.pixels.shape[0]))
+            columns = slice(tile_x, min(tile_x + TILE_SIZE, self.pixels.shape[1]))
+            original = self.originals[tile] = self.pixels[rows, columns].copy()
+            self.coverage[tile] = np.zeros(original.shape[:2], dtype=np.uint8)
+        x0, y0 = piece.x() - tile_x, piece.y() - tile_y
+        x1, y1 = x0 + piece.width(), y0 + piece.height()
+        coverage = self.coverage[tile][y0:y1, x0:x1]
+        dab = self.dab[piece.y() - top:piece.y() - top + piece.height(), piece.x() - left:piece.x() - left + piece.width()]
+        np.maximum(coverage, dab, out=coverage)
+        weight = coverage.astype(np.uint16)
+        before = original[y0:y1, x0:x1]
+        if self.mode == "clone":
+            sx, sy = piece.x() + self.offset[0], piece.y() + self.offset[1]
+            source = self.pixels[sy:sy + piece.height(), sx:sx + piece.width()]
+        else:
+            source = self.value
+        if before.ndim == 3:
+            weight = weight[:, :, np.newaxis]
+        blended = before * (255 - weight) + source * weight
+        blended += 127
+        blended //= 255
+        self.pixels[piece.y():piece.y() + piece.height(), piece.x():piece.x() + piece.width()] = blended
+
+    def before(self):
+        """Return the pixels of the changed rectangle as they were before the stroke, as a QImage."""
+        rect = self.dirty
+        pixels = self.pixels[rect.top():rect.bottom() + 1, rect.left():rect.right() + 1].copy()
+        for (tx, ty), original in self.originals.items():
+            x, y = tx * TILE_SIZE - rect.left(), ty * TILE_SIZE - rect.top()
+            # Tiles may reach past the changed rectangle; only their overlap is needed
+            target = pixels[max(y, 0):y + original.shape[0], max(x, 0):x + original.shape[1]]
+            target[...] = original[max(-y, 0):max(-y, 0) + target.shape[0], max(-x, 0):max(-x, 0) + target.shape[1]]
+        return array_to_image(pixels, self.image.format())
@@ -0,0 +1,58 @@
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtGui import QImage
+from PyQt5.QtCore import QMimeData, QBuffer, QByteArray, QIODevice
+
+QT_IMAGE_MIME = "application/x-qt-image"
+
+
+class LazyImageMimeData(QMimeData):
+    """Clipboard data that holds a QImage by reference.
+
+    Nothing is serialized when the image is put on the clipboard; a
+    representation is only rendered when someone actually asks for it.
+    """
+
+    def __init__(self, image):
+        super().__init__()
+        self.image = image
+
+    def formats(self):
+        return [QT_IMAGE_MIME, "image/png", "image/bmp"]
+
+    def hasFormat(self, mime_type):
+        return mime_type in self.formats()
+
+    def retrieveData(self, mime_type, preferred_type):
+        if mime_type == QT_IMAGE_MIME:
+            return self.image
+        if mime_type in ("image/png", "image/bmp"):
+            data = QByteArray()
+            buffer = QBuffer(data)
+            buffer.open(QIODevice.WriteOnly)
+            self.image.save(buffer, mime_type.split("/")[1].upper())
+            buffer.close()
+            return data
+        return super().retrieveData(mime_type, preferred_type)
+
+
+def set_clipboard_image(image):
+    """Put an image on the clipboard without serializing it."""
+    QApplication.clipboard().setMimeData(LazyImageMimeData(image))
+
+
+def clipboard_image():
+    """Return the clipboard image, or None.
+
+    Images copied from one of our own documents are returned directly and
+    share their pixel buffer with the clipboard; anything else is decoded.
+    """
+    mime_data = QApplication.clipboard().mimeData()
+    if mime_data is None:
+        return None
+    if isinstance(mime_data, LazyImageMimeData):
+        return mime_data.image
+    if mime_data.hasImage():
+        image = QImage(mime_data.imageData())
+        if not image.isNull():
+            return image
+    return None
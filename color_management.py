@@ -0,0 +1,237 @@
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+import numpy as np
+from PIL import Image, ImageCms
+from PyQt5.QtGui import QImage, qRgba, qAlpha
+from imaging import image_array, convert_image, working_format, is_palette, map_channels, conversion_counts, LUMA_WEIGHTS
+from jobs import run_bands
+from tracing import span
+
+try:
+    import cv2
+    CV2_AVAILABLE = True
+except ImportError:
+    CV2_AVAILABLE = False
+
+# Rendering intents by the name they are stored under in the config
+INTENTS = {
+    "perceptual": ("Perceptual", ImageCms.Intent.PERCEPTUAL),
+    "relative": ("Relative Colorimetric", ImageCms.Intent.RELATIVE_COLORIMETRIC),
+    "saturation": ("Saturation", ImageCms.Intent.SATURATION),
+    "absolute": ("Absolute Colorimetric", ImageCms.Intent.ABSOLUTE_COLORIMETRIC),
+}
+DEFAULT_INTENT = "perceptual"
+# Documents are brought into the working space with a fixed intent, so a file
+# opens to the same pixels whatever intent the monitor is shown with
+DOCUMENT_INTENT = "perceptual"
+
+# Built transforms kept for reuse; documents mostly come from a handful of
+# cameras and scanners, and each needs one to sRGB plus one to the monitor
+TRANSFORM_CACHE_SIZE = 16
+
+
+class Profile:
+    """An ICC profile, identified by a digest of its bytes."""
+
+    def __init__(self, profile):
+        self.profile = profile if isinstance(profile, ImageCms.ImageCmsProfile) else ImageCms.ImageCmsProfile(profile)
+        self.key = hashlib.sha1(self.profile.tobytes()).hexdigest()
+        self.color_space = self.profile.profile.xcolor_space.strip()
+        self.description = ImageCms.getProfileDescription(self.profile).strip() or "Unnamed profile"
+
+    @classmethod
+    def fromBytes(cls, data):
+        """Return the Profile in data; raises ValueError if it isn't a readable ICC profile."""
+        try:
+            return cls(io.BytesIO(data))
+        except (OSError, ImageCms.PyCMSError) as e:
+            raise ValueError(f"Unreadable ICC profile: {e}") from None
+
+    @classmethod
+    def fromFile(cls, path):
+        with open(path, "rb") as file:
+            return cls.fromBytes(file.read())
+
+    def __eq__(self, other):
+        return isinstance(other, Profile) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+
+# Documents are edited in sRGB, which is also what untagged files are taken to be
+WORKING_PROFILE = Profile(ImageCms.createProfile("sRGB"))
+
+
+def embedded_profile(source):
+    """Return the Profile embedded in an image file (a path or a file object), or None.
+
+    Only the header is read. Profiles that can't be parsed count as none.
+    """
+    try:
+        with Image.open(source) as image:
+            data = image.info.get("icc_profile")
+    except (OSError, ValueError):
+        return None
+    if not data:
+        return None
+    try:
+        return Profile.fromBytes(data)
+    except ValueError:
+        return None
+
+
+class TransformCache:
+    """A least-recently-used cache of ImageCms transforms by (source, target, intent, modes).
+
+    Building a transform parses both profiles and optimizes the pipeline
+    between them, which takes longer than applying it to a tile, so every
+    document and redraw between the same profiles shares one.
+    """
+
+    def __init__(self, size=TRANSFORM_CACHE_SIZE):
+        self.size = size
+        self.transforms = OrderedDict()
+        # Bands and background jobs look transforms up from worker threads
+        self.lock = threading.Lock()
+
+    def get(self, source, target, intent=DEFAULT_INTENT, in_mode="RGBA", out_mode="RGBA"):
+        key = (source.key, target.key, intent, in_mode, out_mode)
+        with self.lock:
+            transform = self.transforms.get(key)
+            if transform is not None:
+                self.transforms.move_to_end(key)
+                return transform
+        with span("build transform", "convert", source=source.description, target=target.description, intent=intent):
+            transform = ImageCms.buildTransform(source.profile, target.profile, in_mode, out_mode,
+                                                INTENTS[intent][1])
+        with self.lock:
+            self.transforms[key] = transform
+            while len(self.transforms) > self.size:
+                self.transforms.popitem(last=False)
+        return transform
+
+    def clear(self):
+        with self.lock:
+            self.transforms.clear()
+
+
+transforms = TransformCache()
+
+
+def can_convert(profile):
+    """Whether images tagged with profile can be converted: RGB and gray ones can, CMYK and others not."""
+    return profile.color_space in ("RGB", "GRAY")
+
+
+def _transform_colours(colours, source, target, intent):
+    """Return colours (an (n, 3) uint8 RGB array) converted from source to target RGB."""
+    if source.color_space == "GRAY":
+        gray = np.rint(colours @ np.array(LUMA_WEIGHTS)).astype(np.uint8)
+        image = Image.frombuffer("L", (len(colours), 1), np.ascontiguousarray(gray), "raw", "L", 0, 1)
+        transform = transforms.get(source, target, intent, "L", "RGB")
+    else:
+        image = Image.frombuffer("RGB", (len(colours), 1), np.ascontiguousarray(colours), "raw", "RGB", 0, 1)
+        transform = transforms.get(source, target, intent, "RGB", "RGB")
+    return np.asarray(ImageCms.applyTransform(image, transform))[0]
+
+
+def _transform_band(pixels, out, transform, y0, y1):
+    """Convert rows y0..y1 of pixels (B, G, R, A) into out; ImageCms works on R, G, B, A."""
+    band = pixels[y0:y1]
+    height, width = band.shape[:2]
+    rgba = cv2.cvtColor(band, cv2.COLOR_BGRA2RGBA) if CV2_AVAILABLE else np.ascontiguousarray(band[..., [2, 1, 0, 3]])
+    converted = np.asarray(ImageCms.applyTransform(Image.frombuffer("RGBA", (width, height), rgba, "raw", "RGBA",
+                                                                    0, 1), transform))
+    if CV2_AVAILABLE:
+        cv2.cvtColor(converted, cv2.COLOR_RGBA2BGRA, dst=out[y0:y1])
+    else:
+        out[y0:y1] = converted[..., [2, 1, 0, 3]]
+
+
+def transform_image(image, source, target, intent=DEFAULT_INTENT, reason="profile", token=None, progress=None):
+    """Return a copy of image converted from the source profile to the target one (both RGB or gray Profiles).
+
+    The format is preserved like imaging.map_channels() does: palette
+    images only get a new colour table and grayscale ones are mapped level
+    by level. Colour images are converted band by band in parallel. token
+    (a jobs.CancelToken) is checked and progress called between bands.
+    """
+    conversion_counts[reason] += 1
+    if is_palette(image):
+        table = np.array(image.colorTable(), dtype=np.uint32)
+        colours = np.stack([(table >> shift) & 0xFF for shift in (16, 8, 0)], axis=-1).astype(np.uint8)
+        mapped = _transform_colours(colours, source, target, intent)
+        result = image.copy()
+        result.setColorTable([qRgba(int(r), int(g), int(b), qAlpha(int(c))) for (r, g, b), c in zip(mapped, table)])
+        return result
+    if image.format() == QImage.Format_Grayscale8 or source.color_space == "GRAY":
+        # Mapped level by level; a colour image tagged with a gray profile takes each channel through its curve
+        ramp = np.repeat(np.arange(256, dtype=np.uint8)[:, None], 3, axis=1)
+        mapped = _transform_colours(ramp, source, target, intent)
+        # A gray converted to another space can pick up a tint; the document stays gray
+        lut = np.rint(mapped @ np.array(LUMA_WEIGHTS)).astype(np.uint8)
+        return map_channels(image, lut, lut, lut, token=token, progress=progress)
+    result_format = working_format(image)
+    # Profiles describe straight (not premultiplied) colour values
+    image = convert_image(image, QImage.Format_ARGB32 if image.hasAlphaChannel() else QImage.Format_RGB32, reason)
+    transform = transforms.get(source, target, intent)
+    pixels = image_array(image)
+    result = QImage(image.width(), image.height(), image.format())
+    out = image_array(result, writable=True)
+    with span("color transform", "convert", reason=reason, width=image.width(), height=image.height()):
+        run_bands(lambda y0, y1: _transform_band(pixels, out, transform, y0, y1), image.height(), token, progress)
+    return convert_image(result, result_format, reason)
+
+
+def to_working_space(image, profile, intent=DOCUMENT_INTENT):
+    """Return image, whose pixels are in profile's space, converted to WORKING_PROFILE.
+
+    image is returned as it is if profile is None, is the working profile
+    or can't be converted (see can_convert()).
+    """
+    if profile is None or profile == WORKING_PROFILE or not can_convert(profile):
+        return image
+    return transform_image(image, profile, WORKING_PROFILE, intent, "profile")
+
+
+class DisplaySettings:
+    """The monitor profile documents are shown in, and the intent to show them with.
+
+    Without a monitor profile the working space values are shown as they
+    are, which is right for an sRGB monitor and free: the display pixmaps
+    then share the documents' pixels.
+    """
+
+    def __init__(self):
+        self.profile = None
+        self.intent = DEFAULT_INTENT
+
+    def set(self, profile, intent=DEFAULT_INTENT):
+        # An sRGB monitor needs no conversion
+        self.profile = None if profile is None or profile == WORKING_PROFILE else profile
+        self.intent = intent
+
+    def active(self):
+        return self.profile is not None
+
+
+display = DisplaySettings()
+
+
+def system_display_profile():
+    """Return the Profile of the primary monitor as the system reports it (Windows only), or None."""
+    try:
+        profile = ImageCms.get_display_profile()
+    except (OSError, ImageCms.PyCMSError):
+        return None
+    return Profile(profile) if profile is not None else None
+
+
+def display_image(image):
+    """Return image converted from the working space to the monitor profile, or image itself without one."""
+    if not display.active():
+        return image
+    return transform_image(image, WORKING_PROFILE, display.profile, display.intent, "monitor")
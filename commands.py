@@ -1,10 +1,19 @@
-import numpy as np
-from PyQt5.QtWidgets import QApplication, QGraphicsItem, QMessageBox
-from PyQt5.QtGui import QImage, QPixmap, QPainter, QTransform
-from PyQt5.QtCore import QRect, Qt
-from PIL import Image, ImageEnhance
+from abc import ABC, abstractmethod
+from PyQt5.QtWidgets import QMessageBox
+from PyQt5.QtGui import QImage, QPainter
+from PyQt5.QtCore import QRect, QPoint, Qt
 from editor import ImageEditor
 from scene import MovableImageItem
+from clipboard import set_clipboard_image
+from imaging import adjust_image, grayscale_image, restore_format, image_to_pixmap, is_palette, paste_region, convert_image
+from selection_mask import blend_outside, clear_outside
+from layers import Layer, flatten_layers
+from filters import filter_image, filter_halo
+from curves import curve_image
+from grading import grade_image
+from quantize import convert_mode
+from straighten import straighten_perspective
+from resampling import resize_image, rotate_image, DEFAULT_RESIZE_MODE, DEFAULT_ROTATION_INTERPOLATION, DEFAULT_ROTATION_FILL
 
 
 try:
@@ -13,7 +22,14 @@ try:
 except ImportError:
     CV2_AVAILABLE = False
 
-class Command:
+def scale_rect(rect, scale):
+    """Map a QRect from proxy coordinates to full-resolution coordinates."""
+    if scale == 1.0:
+        return QRect(rect)
+    return QRect(round(rect.x() * scale), round(rect.y() * scale),
+                 max(1, round(rect.width() * scale)), max(1, round(rect.height() * scale)))
+
+class Command(ABC):
     def execute(self):
         """Execute the command."""
         pass
@@ -22,17 +38,38 @@ class Command:
         """Undo the command."""
         pass
 
+    def prepare(self, token=None, progress=None):
+        """Compute the command's result ahead of execute(), possibly on a worker thread.
+
+        Must not touch the editor or any widget. Commands that don't override
+        this do all their work in execute().
+        """
+        pass
+
+    @abstractmethod
+    def replay(self, image, scale):
+        """Re-apply the command to a full-resolution image and return the result.
+
+        scale maps the editor's (proxy) coordinates to the coordinates of image.
+        """
+
+    def replay_view(self, store, scale):
+        """Re-apply the command to a BackingStore as a view; None if it needs real pixels."""
+        return None
+
 class CropCommand(Command):
-    def __init__(self, editor, rect):
+    def __init__(self, editor, rect, mask=None):
         self.editor = editor
         self.rect = rect
+        # A lasso, polygon or wand selection: the pixels outside it are cleared
+        self.mask = mask
         self.original_image = editor.getCurrentImage().copy()
         self.cropped_image = None
 
     def execute(self):
         """Crop the image to the specified rectangle."""
         from widgets import CustomMdiSubWindow
-        self.cropped_image = self.original_image.copy(self.rect)
+        self.cropped_image = self.crop(self.original_image, self.rect, 1.0)
         self.editor.setImage(self.cropped_image)
         self.editor.window().statusBar().showMessage(f"Image cropped to {self.rect.width()}x{self.rect.height()}", 2000)
 
@@ -44,94 +81,170 @@ class CropCommand(Command):
         from widgets import CustomMdiSubWindow
         self.editor.setImage(self.original_image)
         self.editor.window().statusBar().showMessage("Crop undone", 2000)
+
+    def crop(self, image, rect, scale):
+        """Return rect of image; outside the mask it becomes transparent, or white if image has no alpha."""
+        cropped = image.copy(rect)
+        if self.mask is None:
+            return cropped
+        selected = self.mask.array(rect, scale)
+        return restore_format(clear_outside(cropped, selected, image.hasAlphaChannel()), image)
+
+    def replay(self, image, scale):
+        return self.crop(image, scale_rect(self.rect, scale), scale)
+
+    def replay_view(self, store, scale):
+        if self.mask is not None:
+            return None
+        return store.crop(scale_rect(self.rect, scale))
         
-class AdjustmentsCommand(Command):
-    def __init__(self, editor, brightness, contrast, gamma, autobalance=False, original_image_override=None):
+class RegionCommand(Command):
+    """Base for pixel commands that only change the selection when there is one.
+
+    Subclasses implement process(image, scale, token, progress) and, if
+    pixels depend on their neighbours, halo(scale). Without a region the
+    whole image is processed and kept for undo. With one, only the region
+    (plus its halo) is processed and patched into the document in place,
+    and the history keeps just the region's pixels before and after. A
+    mask (a SelectionMask covering the region) further limits the change
+    to the pixels it selects.
+    """
+
+    def __init__(self, editor, original_image_override=None, region=None, mask=None):
         self.editor = editor
-        self.brightness = brightness
-        self.contrast = contrast
-        self.gamma = gamma
-        self.autobalance = autobalance
-        if original_image_override:
-            self.original_image = original_image_override
+        self.mask = mask
+        base = original_image_override if original_image_override else editor.getCurrentImage()
+        if region is not None:
+            region = region.intersected(base.rect())
+            # Palette images only get a new colour table, which is cheap for the whole image
+            if region.isEmpty() or is_palette(base):
+                region = None
+        self.region = region
+        self.result_image = None
+        if region is None:
+            self.original_image = original_image_override if original_image_override else base.copy()
         else:
-            self.original_image = editor.getCurrentImage().copy()
-        self.adjusted_image = None
+            self.original_image = None
+            self.before = base.copy(region)
+            self.source_rect = self.expanded(region, base.rect(), 1.0)
+            # Without a halo the region is its own source; nothing writes into either
+            self.source = self.before if self.source_rect == region else base.copy(self.source_rect)
+
+    def halo(self, scale):
+        """Return how many pixels around a region process() reads."""
+        return 0
+
+    def expanded(self, rect, bounds, scale):
+        halo = self.halo(scale)
+        return rect.adjusted(-halo, -halo, halo, halo).intersected(bounds)
+
+    @abstractmethod
+    def process(self, image, scale=1.0, token=None, progress=None):
+        """Return image with the command applied; scale maps proxy coordinates to image's."""
+
+    def process_region(self, source, source_rect, rect, scale=1.0, token=None, progress=None):
+        """Process source (the pixels of source_rect) and return the part covering rect."""
+        result = self.process(source, scale, token, progress)
+        inner = rect.translated(-source_rect.topLeft())
+        if inner != result.rect():
+            result = result.copy(inner)
+        if self.mask is not None:
+            original = source if inner == source.rect() else source.copy(inner)
+            result = blend_outside(result, original, self.mask.array(rect, scale))
+        return result
+
+    def prepare(self, token=None, progress=None):
+        if self.region is None:
+            self.result_image = self.process(self.original_image, 1.0, token, progress)
+        else:
+            self.result_image = self.process_region(self.source, self.source_rect, self.region, 1.0, token, progress)
 
     def execute(self):
-        """Apply brightness, contrast, gamma adjustments, and optionally autobalance."""
-        image = self.original_image.copy()
-        if self.autobalance:
-            width, height = image.width(), image.height()
-            ptr = image.bits()
-            ptr.setsize(height * width * 4)
-            img_array = np.frombuffer(ptr, dtype=np.uint8).reshape(height, width, 4).copy()
-
-            r_hist = np.histogram(img_array[:, :, 2], bins=256, range=(0, 256))[0]
-            g_hist = np.histogram(img_array[:, :, 1], bins=256, range=(0, 256))[0]
-            b_hist = np.histogram(img_array[:, :, 0], bins=256, range=(0, 256))[0]
-            total_pixels = width * height
-            threshold = total_pixels * 0.05
-
-            def find_bounds(hist):
-                low, high = 0, 255
-                count = 0
-                for i, val in enumerate(hist):
-                    count += val
-                    if count > threshold:
-                        low = i
-                        break
-                count = 0
-                for i, val in enumerate(hist[::-1]):
-                    count += val
-                    if count > threshold:
-                        high = 255 - i
-                        break
-                if low >= high:
-                    high = low + 1 if low < 255 else 255
-                    low = high - 1 if high > 0 else 0
-                return low, high
-
-            r_low, r_high = find_bounds(r_hist)
-            g_low, g_high = find_bounds(g_hist)
-            b_low, b_high = find_bounds(b_hist)
-
-            r_range = max(r_high - r_low, 1)
-            g_range = max(g_high - g_low, 1)
-            b_range = max(b_high - b_low, 1)
-
-            img_array[:, :, 2] = np.clip((img_array[:, :, 2].astype(np.float32) - r_low) * 255 / r_range, 0, 255).astype(np.uint8)
-            img_array[:, :, 1] = np.clip((img_array[:, :, 1].astype(np.float32) - g_low) * 255 / g_range, 0, 255).astype(np.uint8)
-            img_array[:, :, 0] = np.clip((img_array[:, :, 0].astype(np.float32) - b_low) * 255 / b_range, 0, 255).astype(np.uint8)
-
-            image = QImage(img_array.tobytes(), width, height, image.bytesPerLine(), QImage.Format_RGB32)
-
-        pil_img = Image.frombytes("RGBA", (image.width(), image.height()), image.bits().asstring(image.byteCount()))
-        if self.brightness != 0:
-            enhancer = ImageEnhance.Brightness(pil_img)
-            pil_img = enhancer.enhance(1.0 + self.brightness)
-        if self.contrast != 0:
-            enhancer = ImageEnhance.Contrast(pil_img)
-            pil_img = enhancer.enhance(1.0 + self.contrast)
-        if self.gamma != 1.0:
-            enhancer = ImageEnhance.Brightness(pil_img)
-            pil_img = enhancer.enhance(self.gamma)
-
-        self.adjusted_image = QImage(pil_img.tobytes(), image.width(), image.height(), image.bytesPerLine(), QImage.Format_RGB32)
-        self.editor.setImage(self.adjusted_image)
-    
+        if self.result_image is None:
+            self.prepare()
+        if self.region is None:
+            self.editor.setImage(self.result_image)
+        else:
+            self.editor.patchImage(self.region, self.result_image)
+
     def redo(self):
-        self.execute()  # Повторяем действия execute
- 
+        self.execute()
+
     def undo(self):
-        """Restore the original image."""
-        self.editor.setImage(self.original_image)
+        """Restore the original image or region."""
+        if self.region is None:
+            self.editor.setImage(self.original_image)
+        else:
+            self.editor.patchImage(self.region, self.before)
+
+    def replay(self, image, scale):
+        # The full-resolution source of a proxy may be a palette image even if the proxy isn't;
+        # like the constructor, process it whole, which only changes its colour table
+        if self.region is None or is_palette(image):
+            return self.process(image, scale)
+        rect = scale_rect(self.region, scale).intersected(image.rect())
+        source_rect = self.expanded(rect, image.rect(), scale)
+        region = self.process_region(image.copy(source_rect), source_rect, rect, scale)
+        image = image.copy()
+        paste_region(image, rect, region)
+        return image
+
+class AdjustmentsCommand(RegionCommand):
+    def __init__(self, editor, brightness, contrast, gamma, autobalance=False, original_image_override=None,
+                 region=None, mask=None):
+        self.brightness = brightness
+        self.contrast = contrast
+        self.gamma = gamma
+        self.autobalance = autobalance
+        super().__init__(editor, original_image_override, region, mask)
+
+    def process(self, image, scale=1.0, token=None, progress=None):
+        return self.adjust(image, token, progress)
+
+    def adjust(self, image, token=None, progress=None):
+        """Return a copy of image with the adjustments applied."""
+        return adjust_image(image, self.brightness, self.contrast, self.gamma, self.autobalance, token, progress)
+
+class CurvesCommand(RegionCommand):
+    def __init__(self, editor, curves, original_image_override=None, region=None, mask=None):
+        self.curves = curves
+        super().__init__(editor, original_image_override, region, mask)
+
+    def process(self, image, scale=1.0, token=None, progress=None):
+        return curve_image(image, self.curves, token, progress)
+
+class ColorGradeCommand(RegionCommand):
+    def __init__(self, editor, grade, original_image_override=None, region=None, mask=None):
+        self.grade = grade
+        super().__init__(editor, original_image_override, region, mask)
+
+    def process(self, image, scale=1.0, token=None, progress=None):
+        return grade_image(image, self.grade, token, progress)
+
+class FilterCommand(RegionCommand):
+    def __init__(self, editor, name, radius, amount=0, threshold=0, original_image_override=None, region=None,
+                 mask=None):
+        self.name = name
+        self.radius = radius
+        self.amount = amount
+        self.threshold = threshold
+        super().__init__(editor, original_image_override, region, mask)
+
+    def halo(self, scale):
+        return filter_halo(self.name, self.radius * scale)
+
+    def process(self, image, scale=1.0, token=None, progress=None):
+        # The radius was chosen on the proxy, so it grows with the image
+        return filter_image(image, self.name, self.radius * scale, self.amount, self.threshold, token, progress)
 
 class TransformCommand(Command):
-    def __init__(self, editor, degrees=None, horizontal_flip=None, original_image_override=None):
+    def __init__(self, editor, degrees=None, horizontal_flip=None, original_image_override=None,
+                 interpolation=DEFAULT_ROTATION_INTERPOLATION, fill=DEFAULT_ROTATION_FILL):
         self.editor = editor
         self.degrees = degrees
         self.horizontal_flip = horizontal_flip
+        self.interpolation = interpolation
+        self.fill = fill
         self.original_image_override = original_image_override
         if self.original_image_override:
             self.original_image = self.original_image_override
@@ -139,17 +252,32 @@ class TransformCommand(Command):
             self.original_image = editor.getCurrentImage().copy()
         self.transformed_image = None
 
+    def prepare(self, token=None, progress=None):
+        self.transformed_image = self.transform(self.original_image, token, progress)
+
     def execute(self):
         """Apply rotation or flip transformation."""
-        image = self.original_image.copy()
+        if self.transformed_image is None:
+            self.prepare()
+        self.editor.setImage(self.transformed_image)
+
+    def replay(self, image, scale):
+        return self.transform(image)
+
+    def replay_view(self, store, scale):
         if self.degrees is not None:
-            transform = QTransform().rotate(self.degrees)
-            # Ensure smooth transformation for rotations
-            image = image.transformed(transform, Qt.SmoothTransformation)
+            return store.rotated(self.degrees) if self.degrees % 90 == 0 else None
+        if self.horizontal_flip is not None:
+            return store.flipped(self.horizontal_flip)
+        return store
+
+    def transform(self, image, token=None, progress=None):
+        """Return image rotated or flipped."""
+        if self.degrees is not None:
+            return rotate_image(image, self.degrees, self.interpolation, self.fill, token, progress)
         elif self.horizontal_flip is not None:
-            image = image.mirrored(self.horizontal_flip, not self.horizontal_flip)
-        self.transformed_image = image
-        self.editor.setImage(self.transformed_image)
+            return image.mirrored(self.horizontal_flip, not self.horizontal_flip)
+        return image.copy()
 
     def undo(self):
         """Restore the original image."""
@@ -158,56 +286,108 @@ class TransformCommand(Command):
         self.execute()
 
 
-class GrayscaleCommand(Command):
-    def __init__(self, editor):
+class PerspectiveCommand(Command):
+    """Straighten the quadrilateral with corners points (four (x, y) in any order) onto a rectangle."""
+
+    def __init__(self, editor, points):
         self.editor = editor
+        self.points = [(float(x), float(y)) for x, y in points]
         self.original_image = editor.getCurrentImage().copy()
-        self.grayscale_image = None
+        self.corrected_image = None
+
+    def prepare(self, token=None, progress=None):
+        self.corrected_image = straighten_perspective(self.original_image, self.points, token=token,
+                                                      progress=progress)
+
+    def execute(self):
+        if self.corrected_image is None:
+            self.prepare()
+        self.editor.setImage(self.corrected_image)
+
+    def redo(self):
+        self.execute()
+
+    def undo(self):
+        self.editor.setImage(self.original_image)
+
+    def replay(self, image, scale):
+        return straighten_perspective(image, [(x * scale, y * scale) for x, y in self.points])
+
+
+class ConvertModeCommand(Command):
+    """Convert the whole document to a palette, grayscale or 1-bit image (a quantize.ModeConversion)."""
+
+    def __init__(self, editor, conversion):
+        self.editor = editor
+        self.conversion = conversion
+        self.original_image = editor.getCurrentImage().copy()
+        self.converted_image = None
+
+    def prepare(self, token=None, progress=None):
+        self.converted_image = convert_mode(self.original_image, self.conversion, 1.0, token, progress)
+
+    def execute(self):
+        if self.converted_image is None:
+            self.prepare()
+        self.editor.setImage(self.converted_image)
+
+    def redo(self):
+        self.execute()
+
+    def undo(self):
+        self.editor.setImage(self.original_image)
+
+    def replay(self, image, scale):
+        return convert_mode(image, self.conversion, scale)
+
+
+class GrayscaleCommand(RegionCommand):
+    def __init__(self, editor, region=None, mask=None):
+        super().__init__(editor, region=region, mask=mask)
 
     def execute(self):
         if not CV2_AVAILABLE:
             QMessageBox.warning(self.editor.window(), "Error", "OpenCV (cv2) is not installed. Please install it to use the Grayscale feature.")
             return
-        print("Executing GrayscaleCommand")  # Отладка
-        # Конвертируем изображение в нужный формат
-        image = self.original_image.convertToFormat(QImage.Format_RGBA8888)
-        width = image.width()
-        height = image.height()
-        print(f"Image size: {width}x{height}, Format: {image.format()}")  # Отладка
-        ptr = image.bits()
-        ptr.setsize(height * width * 4)
-        arr = np.frombuffer(ptr, np.uint8).reshape((height, width, 4))
-        print("Converting to grayscale...")  # Отладка
-        gray = cv2.cvtColor(arr, cv2.COLOR_RGBA2GRAY)
-        gray_rgb = cv2.cvtColor(gray, cv2.COLOR_GRAY2RGBA)
-        self.grayscale_image = QImage(gray_rgb.data, width, height, gray_rgb.strides[0], QImage.Format_RGBA8888)
-        if self.grayscale_image.isNull():
-            print("Error: Grayscale image is null")  # Отладка
+        if self.result_image is None:
+            self.prepare()
+        if self.result_image.isNull():
             QMessageBox.warning(self.editor.window(), "Error", "Failed to convert image to grayscale.")
             return
-        print("Setting grayscale image")  # Отладка
-        self.editor.setImage(self.grayscale_image)
+        super().execute()
         self.editor.window().statusBar().showMessage("Converted to grayscale", 2000)
 
+    def replay(self, image, scale):
+        if not CV2_AVAILABLE:
+            raise RuntimeError("OpenCV (cv2) is required to replay the grayscale conversion")
+        return super().replay(image, scale)
+
+    def process(self, image, scale=1.0, token=None, progress=None):
+        return self.to_grayscale(image)
+
+    def to_grayscale(self, image):
+        """Return a grayscale version of image."""
+        return grayscale_image(image)
+
     def undo(self):
-        self.editor.setImage(self.original_image)
+        super().undo()
         self.editor.window().statusBar().showMessage("Grayscale undone", 2000)
 
-    def redo(self):
-        self.execute()
-
 class PasteCommand(Command):
     def __init__(self, editor, clipboard_image):
         self.editor = editor
-        self.clipboard_image = clipboard_image.copy()
-        self.original_image = editor.getCurrentImage().copy() if editor.getCurrentImage() else None
+        # QImage is implicitly shared, so this keeps a reference instead of copying the pixels
+        self.clipboard_image = QImage(clipboard_image)
         self.movable_item = None
         self.selection_rect = editor.scene.selection_rect.rect().toRect() if editor.scene.selection_rect and editor.scene.selection_rect.rect().isValid() else None
-        self.pasted_items_before = editor.pasted_items.copy()
+        self.into_selection = bool(self.selection_rect and not self.selection_rect.isEmpty())
+        # Only a paste into the selection changes the image's own pixels
+        self.original_image = editor.getCurrentImage().copy() if self.into_selection and editor.getCurrentImage() else None
 
     def execute(self):
-        """Paste the clipboard image either into a selection or as a movable item."""
-        if self.selection_rect and not self.selection_rect.isEmpty():
+        """Paste the clipboard image either into a selection or as a new layer."""
+        if self.into_selection:
+            self.editor.discardRegionStatistics()
             painter = QPainter(self.editor.current_image)
             painter.setRenderHint(QPainter.Antialiasing)
             painter.setRenderHint(QPainter.SmoothPixmapTransform)
@@ -216,19 +396,12 @@ class PasteCommand(Command):
             self.editor.setImage(self.editor.current_image)
             self.editor.window().statusBar().showMessage("Image pasted into selection", 2000)
         else:
-            pixmap = QPixmap.fromImage(self.clipboard_image)
-            self.movable_item = MovableImageItem(pixmap)
-            self.movable_item.setPos(10, 10)
-            for item in self.editor.pasted_items[:]:
-                if item.isSelected():
-                    self.editor.scene.fixMovableItem(item, self.editor)
-                    self.editor.scene.removeItem(item)
-                    self.editor.pasted_items.remove(item)
-            self.editor.scene.addItem(self.movable_item)
-            self.editor.pasted_items.append(self.movable_item)
+            if self.movable_item is None:
+                self.movable_item = MovableImageItem(Layer(self.clipboard_image, QPoint(10, 10)))
+            self.editor.scene.deselectLayers()
+            self.editor.addLayer(self.movable_item)
             self.movable_item.setSelected(True)
-            self.editor.window().statusBar().showMessage(f"Image pasted as movable object (items: {len(self.editor.pasted_items)})", 2000)
-            self.editor.scene.update()
+            self.editor.window().statusBar().showMessage(f"Image pasted as a layer (layers: {len(self.editor.pasted_items)})", 2000)
         self.editor.is_modified = True
 
     def redo(self):
@@ -236,67 +409,143 @@ class PasteCommand(Command):
 
     def undo(self):
         """Undo the paste operation."""
-        if self.selection_rect and not self.selection_rect.isEmpty():
-            self.editor.setImage(self.original_image)
-        else:
-            if self.movable_item and self.movable_item in self.editor.pasted_items:
-                self.editor.scene.removeItem(self.movable_item)
-                self.editor.pasted_items.remove(self.movable_item)
-            self.editor.pasted_items = self.pasted_items_before.copy()
-            for item in self.editor.pasted_items:
-                if item not in self.editor.scene.items():
-                    self.editor.scene.addItem(item)
+        if self.into_selection:
             self.editor.setImage(self.original_image)
-            self.editor.scene.update()
+        elif self.movable_item.layer in self.editor.pasted_items:
+            self.editor.removeLayer(self.movable_item)
         self.editor.is_modified = bool(self.editor.undo_stack)
         self.editor.window().statusBar().showMessage("Paste undone", 2000)
 
-class CutCommand(Command):
+    def replay(self, image, scale):
+        if not self.into_selection:
+            # A layer reaches the pixels only when FixPasteCommand flattens it
+            return image
+        target = scale_rect(QRect(self.selection_rect.topLeft(), self.clipboard_image.size()), scale)
+        image = image.copy()
+        painter = QPainter(image)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        painter.drawImage(target, self.clipboard_image)
+        painter.end()
+        return image
+
+    def replay_view(self, store, scale):
+        return None if self.into_selection else store
+
+class CutCommand(RegionCommand):
+    """Cut the selection to the clipboard, leaving white behind.
+
+    Like the other region commands it keeps only the selection's pixels for
+    undo; a lasso, polygon or wand selection is cut along its mask.
+    """
+
     def __init__(self, editor):
-        self.editor = editor
-        self.original_image = editor.getCurrentImage().copy()
-        self.selection_rect = editor.scene.selection_rect.rect().toRect() if editor.scene.selection_rect else QRect()
+        selection = editor.selectionRect()
+        self.selection_rect = selection if selection is not None else QRect()
+        super().__init__(editor, region=selection, mask=editor.selectionMask())
         self.cut_image = None
 
+    def process(self, image, scale=1.0, token=None, progress=None):
+        if self.region is not None:
+            # image is just the region; process_region() keeps what lies outside the mask
+            result = QImage(image.size(), image.format())
+            result.fill(Qt.white)
+            return result
+        # Palette documents are processed whole
+        rect = scale_rect(self.selection_rect, scale).intersected(image.rect())
+        result = QImage(convert_image(image, QImage.Format_RGB32, "cut"))
+        before = result.copy(rect)
+        cleared = QImage(rect.size(), QImage.Format_RGB32)
+        cleared.fill(Qt.white)
+        if self.mask is not None:
+            cleared = blend_outside(cleared, before, self.mask.array(rect, scale))
+        paste_region(result, rect, cleared)
+        return restore_format(result, image)
+
     def execute(self):
         """Cut the selected area and copy it to the clipboard."""
-        if not self.selection_rect.isValid() or self.selection_rect.isEmpty():
+        if self.selection_rect.isEmpty():
             self.editor.window().statusBar().showMessage("No valid selection to cut", 2000)
             return
-        self.cut_image = self.original_image.copy(self.selection_rect)
-        QApplication.clipboard().setImage(self.cut_image)
-        result_image = self.original_image.copy()
-        painter = QPainter(result_image)
-        painter.fillRect(self.selection_rect, Qt.white)
-        painter.end()
-        self.editor.setImage(result_image)
-        self.editor.scene.removeItem(self.editor.scene.selection_rect)
-        self.editor.scene.selection_rect = None
-        for handle in self.editor.scene.handles:
-            self.editor.scene.removeItem(handle)
-        self.editor.scene.handles.clear()
+        if self.cut_image is None:
+            before = self.before if self.region is not None else self.original_image.copy(self.selection_rect)
+            if self.mask is not None:
+                before = clear_outside(before, self.mask.array(self.selection_rect))
+            self.cut_image = before
+        set_clipboard_image(self.cut_image)
+        super().execute()
+        self.editor.scene.clearSelection()
         self.editor.is_modified = True
         self.editor.window().statusBar().showMessage("Selection cut to clipboard", 2000)
 
-    def redo(self):
-        self.execute()
-
     def undo(self):
         """Restore the original image after cutting."""
-        self.editor.setImage(self.original_image)
+        if self.selection_rect.isEmpty():
+            return
+        super().undo()
         self.editor.is_modified = bool(self.editor.undo_stack)
         self.editor.window().statusBar().showMessage("Cut undone", 2000)
 
+    def replay(self, image, scale):
+        if self.selection_rect.isEmpty():
+            return image
+        return super().replay(image, scale)
+
+class StrokeCommand(Command):
+    """A brush, eraser or clone stroke, painted live by the scene before it gets here.
+
+    The history keeps the pixels of the stroke's bounding rectangle before
+    and after it; replay() paints the stroke again from its input points.
+    """
+
+    def __init__(self, editor, brush, mode, points, offset, rect, before, after):
+        self.editor = editor
+        self.brush = brush
+        self.mode = mode
+        self.points = points
+        self.offset = offset
+        self.rect = rect
+        self.before = before
+        self.after = after
+
+    def execute(self):
+        self.editor.patchImage(self.rect, self.after)
+
+    def redo(self):
+        self.execute()
+
+    def undo(self):
+        self.editor.patchImage(self.rect, self.before)
+
+    def replay(self, image, scale):
+        from brush import Stroke, can_paint
+        # A proxy's source is decoded as it is stored: possibly straight alpha, a palette or 1-bit
+        if can_paint(image):
+            painted = image.copy()
+        else:
+            painted = convert_image(image, QImage.Format_ARGB32_Premultiplied if image.hasAlphaChannel()
+                                    else QImage.Format_RGB32, "stroke")
+        stroke = Stroke(painted, self.brush, self.mode, self.offset, scale)
+        stroke.moveTo(*self.points[0])
+        for point in self.points[1:]:
+            stroke.lineTo(*point)
+        return restore_format(painted, image)
+
 class ResizeCommand(Command):
-    def __init__(self, editor, old_image, new_image):
+    def __init__(self, editor, old_image, new_image, mode=DEFAULT_RESIZE_MODE):
         self.editor = editor
         self.old_image = old_image
         self.new_image = new_image
+        self.mode = mode
+
+    def replay(self, image, scale):
+        width = max(1, round(self.new_image.width() * scale))
+        height = max(1, round(self.new_image.height() * scale))
+        return resize_image(image, width, height, self.mode)
 
     def undo(self):
         """Revert to the original image size."""
         self.editor.current_image = self.old_image
-        self.editor.image_item.setPixmap(QPixmap.fromImage(self.editor.current_image))
+        self.editor.image_item.setPixmap(image_to_pixmap(self.editor.current_image))
         self.editor.scene.setSceneRect(0, 0, self.old_image.width(), self.old_image.height())
         self.editor.image_item.setPos(0, 0)
         self.editor.fitInViewWithRulers()
@@ -306,7 +555,7 @@ class ResizeCommand(Command):
     def redo(self):
         """Apply the resized image."""
         self.editor.current_image = self.new_image
-        self.editor.image_item.setPixmap(QPixmap.fromImage(self.editor.current_image))
+        self.editor.image_item.setPixmap(image_to_pixmap(self.editor.current_image))
         self.editor.scene.setSceneRect(0, 0, self.new_image.width(), self.new_image.height())
         self.editor.image_item.setPos(0, 0)
         self.editor.fitInViewWithRulers()
@@ -314,35 +563,83 @@ class ResizeCommand(Command):
         self.editor.viewport().update()
 
 class FixPasteCommand(Command):
-    def __init__(self, editor, old_image, new_image, pasted_items):
+    """Flatten pasted layers into the image; only the rectangle they cover is kept, before and after."""
+
+    def __init__(self, editor, pasted_items, rect, flattened):
         self.editor = editor
-        self.old_image = old_image
-        self.new_image = new_image
         self.pasted_items = pasted_items
-        self.positions = [item.pos() for item in pasted_items]
+        # As they were flattened, for the full-resolution replay
+        self.layers = [item.layer.copy() for item in pasted_items]
+        image = editor.getCurrentImage()
+        if is_palette(image):
+            # Palette pixels can't be patched in place: keep both whole images
+            self.rect = image.rect()
+            self.old_image = image
+            self.new_image = flatten_layers(image, self.layers)
+        else:
+            # No rectangle if the layers lie outside the image
+            self.rect = rect
+            self.old_image = image.copy(rect) if flattened is not None else None
+            self.new_image = restore_format(flattened, image) if flattened is not None else None
+
+    def execute(self):
+        self.editor.removeLayers(self.pasted_items)
+        self.show(self.new_image)
+        self.editor.window().statusBar().showMessage(f"Flattened {len(self.pasted_items)} layer(s)", 2000)
+
+    def replay(self, image, scale):
+        return flatten_layers(image, self.layers, scale)
+
+    def show(self, image):
+        if image is None:
+            return
+        if is_palette(self.editor.current_image) or is_palette(image):
+            self.editor.discardRegionStatistics()
+            self.editor.current_image = image
+            self.editor.image_item.setPixmap(image_to_pixmap(image))
+            self.editor.showLayers()
+            self.editor.scene.update()
+        else:
+            self.editor.patchImage(self.rect, image)
 
     def undo(self):
         """Undo the fixation of pasted items."""
-        self.editor.current_image = self.old_image
-        self.editor.image_item.setPixmap(QPixmap.fromImage(self.editor.current_image))
-        self.editor.pasted_items.clear()
-        for item, pos in zip(self.pasted_items, self.positions):
-            self.editor.scene.addItem(item)
-            item.setPos(pos)
-            item.setFlag(QGraphicsItem.ItemIsMovable, True)
-            item.setFlag(QGraphicsItem.ItemIsSelectable, True)
-            self.editor.pasted_items.append(item)
+        self.show(self.old_image)
+        self.editor.addLayers(self.pasted_items)
         self.editor.scene.update()
         self.editor.viewport().update()
 
     def redo(self):
         """Redo the fixation of pasted items."""
-        self.editor.current_image = self.new_image
-        self.editor.image_item.setPixmap(QPixmap.fromImage(self.editor.current_image))
-        for item in self.pasted_items:
-            if item in self.editor.pasted_items:
-                self.editor.pasted_items.remove(item)
-            self.editor.scene.removeItem(item)
-        self.editor.pasted_items.clear()
+        self.execute()
         self.editor.scene.update()
         self.editor.viewport().update()
+
+
+class LayerPropertiesCommand(Command):
+    """Change a pasted layer's opacity and blend mode."""
+
+    def __init__(self, editor, item, opacity, blend_mode, old_opacity=None, old_blend_mode=None):
+        self.editor = editor
+        self.item = item
+        self.opacity = opacity
+        self.blend_mode = blend_mode
+        # The dialog previews on the layer itself, so it passes the values it started from
+        self.old_opacity = item.layer.opacity if old_opacity is None else old_opacity
+        self.old_blend_mode = item.layer.blend_mode if old_blend_mode is None else old_blend_mode
+
+    def execute(self):
+        self.editor.setLayerProperties(self.item, self.opacity, self.blend_mode)
+
+    def redo(self):
+        self.execute()
+
+    def undo(self):
+        self.editor.setLayerProperties(self.item, self.old_opacity, self.old_blend_mode)
+
+    def replay(self, image, scale):
+        # FixPasteCommand replays layers as they were flattened
+        return image
+
+    def replay_view(self, store, scale):
+        return store
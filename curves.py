@@ -0,0 +1,160 @@
+import math
+import numpy as np
+from PyQt5.QtGui import QImage
+from imaging import image_array, array_to_image, channel_histogram, convert_image, is_palette, palette_counts, map_channels
+
+# Channels a curve and levels apply to: each colour channel's own, then the "rgb" one on all three
+CHANNELS = {"rgb": "RGB", "red": "Red", "green": "Green", "blue": "Blue"}
+
+# Control points of a curve that leaves its channel unchanged
+IDENTITY_POINTS = ((0, 0), (255, 255))
+
+# The histogram is counted over at most this many pixels, taken on a regular
+# grid from larger images; its shape is what matters, not the exact counts
+HISTOGRAM_SAMPLE_PIXELS = 1000000
+
+
+def levels_lut(in_black=0, in_white=255, gamma=1.0, out_black=0, out_white=255):
+    """Return the float32 256-entry table of a levels setting.
+
+    Input levels from in_black to in_white are stretched over out_black to
+    out_white; gamma above 1 brightens the midtones.
+    """
+    x = np.arange(256, dtype=np.float32)
+    x = np.clip((x - in_black) / max(in_white - in_black, 1), 0, 1)
+    if gamma != 1.0:
+        x **= 1 / gamma
+    return out_black + x * (out_white - out_black)
+
+
+def curve_lut(points):
+    """Return the float32 256-entry table of a curve through points, (input, output) pairs sorted by input.
+
+    The curve is a monotone piecewise cubic (Fritsch-Butland slopes), so it
+    doesn't overshoot between points; it is flat beyond the first and last.
+    """
+    xs = np.array([x for x, _ in points], dtype=np.float64)
+    ys = np.array([y for _, y in points], dtype=np.float64)
+    x = np.arange(256, dtype=np.float64)
+    if len(xs) < 2:
+        return np.full(256, ys[0] if len(ys) else 0, dtype=np.float32)
+    h = np.diff(xs)
+    secants = np.diff(ys) / h
+    slopes = np.empty_like(xs)
+    slopes[0], slopes[-1] = secants[0], secants[-1]
+    if len(xs) > 2:
+        w1 = 2 * h[1:] + h[:-1]
+        w2 = h[1:] + 2 * h[:-1]
+        left, right = secants[:-1], secants[1:]
+        same_sign = left * right > 0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            harmonic = (w1 + w2) / (w1 / left + w2 / right)
+        slopes[1:-1] = np.where(same_sign, harmonic, 0)
+    segment = np.clip(np.searchsorted(xs, x, side="right") - 1, 0, len(xs) - 2)
+    t = np.clip((x - xs[segment]) / h[segment], 0, 1)
+    t2, t3 = t * t, t * t * t
+    y = ((2 * t3 - 3 * t2 + 1) * ys[segment] + (t3 - 2 * t2 + t) * h[segment] * slopes[segment]
+         + (-2 * t3 + 3 * t2) * ys[segment + 1] + (t3 - t2) * h[segment] * slopes[segment + 1])
+    return np.clip(y, 0, 255).astype(np.float32)
+
+
+class ChannelCurve:
+    """Levels and a curve for one channel; the levels are applied first."""
+
+    def __init__(self, points=IDENTITY_POINTS, in_black=0, in_white=255, gamma=1.0, out_black=0, out_white=255):
+        self.points = [tuple(point) for point in points]
+        self.in_black = in_black
+        self.in_white = in_white
+        self.gamma = gamma
+        self.out_black = out_black
+        self.out_white = out_white
+
+    def copy(self):
+        return ChannelCurve(self.points, self.in_black, self.in_white, self.gamma, self.out_black, self.out_white)
+
+    def isIdentity(self):
+        return (self.points == list(IDENTITY_POINTS) and (self.in_black, self.in_white, self.gamma) == (0, 255, 1.0)
+                and (self.out_black, self.out_white) == (0, 255))
+
+    def table(self):
+        """Return the float32 256-entry table of the levels followed by the curve."""
+        levels = levels_lut(self.in_black, self.in_white, self.gamma, self.out_black, self.out_white)
+        return np.interp(levels, np.arange(256), curve_lut(self.points)).astype(np.float32)
+
+
+class Curves:
+    """A ChannelCurve for each of CHANNELS."""
+
+    def __init__(self, channels=None):
+        self.channels = {name: ChannelCurve() for name in CHANNELS}
+        if channels:
+            self.channels.update({name: curve.copy() for name, curve in channels.items()})
+
+    def copy(self):
+        return Curves(self.channels)
+
+    def isIdentity(self):
+        return all(curve.isIdentity() for curve in self.channels.values())
+
+    def luts(self):
+        """Compile the settings into one uint8 256-entry table each for red, green and blue."""
+        master = self.channels["rgb"].table()
+        luts = []
+        for name in ("red", "green", "blue"):
+            table = np.interp(self.channels[name].table(), np.arange(256), master)
+            luts.append(np.clip(np.round(table), 0, 255).astype(np.uint8))
+        return luts
+
+
+def curve_image(image, curves, token=None, progress=None):
+    """Return a copy of image with curves (a Curves) applied, in one pass of table lookups."""
+    return map_channels(image, *curves.luts(), token=token, progress=progress)
+
+
+class ChannelHistograms:
+    """Red, green and blue histograms of an image or a rectangle of it, counted on a sample of its pixels.
+
+    Built once per image (they are keyed by its cacheKey) and reused while
+    curves are edited: a table lookup only moves counts between levels, so
+    the histograms of the result are remapped from these without looking at
+    the pixels again.
+    """
+
+    def __init__(self, image, rect=None, token=None):
+        self.key = image.cacheKey()
+        self.rect = image.rect() if rect is None else rect
+        if is_palette(image):
+            # Counted over the colour table, weighted by how often each entry is used
+            table = np.array(image.colorTable(), dtype=np.uint32)
+            counts = palette_counts(image if rect is None else image.copy(rect))[:len(table)]
+            self.counts = [np.bincount((table >> shift) & 0xFF, weights=counts, minlength=256)
+                           for shift in (16, 8, 0)]
+            return
+        if image.format() not in (QImage.Format_Grayscale8, QImage.Format_RGB32, QImage.Format_ARGB32,
+                                  QImage.Format_ARGB32_Premultiplied):
+            image = convert_image(image, QImage.Format_ARGB32, "histogram")
+        pixels = image_array(image)[self.rect.top():self.rect.bottom() + 1, self.rect.left():self.rect.right() + 1]
+        step = max(1, math.ceil(math.sqrt(pixels.shape[0] * pixels.shape[1] / HISTOGRAM_SAMPLE_PIXELS)))
+        sample = pixels[::step, ::step]
+        if sample.ndim == 2:
+            gray = channel_histogram(sample).astype(np.float64)
+            self.counts = [gray, gray, gray]
+            return
+        if image.format() == QImage.Format_ARGB32_Premultiplied:
+            # Curves apply to straight colour values; only the sample is converted
+            converted = convert_image(array_to_image(sample, image.format()), QImage.Format_ARGB32, "histogram")
+            sample = image_array(converted)
+        self.counts = []
+        # Memory order is B, G, R, A
+        for index in (2, 1, 0):
+            if token is not None:
+                token.check()
+            self.counts.append(channel_histogram(sample, index).astype(np.float64))
+
+    def matches(self, image, rect=None):
+        return self.key == image.cacheKey() and self.rect == (image.rect() if rect is None else rect)
+
+    def mapped(self, luts):
+        """Return the red, green and blue histograms after mapping the channels through luts."""
+        return [np.bincount(lut, weights=counts, minlength=256) for lut, counts in zip(luts, self.counts)]
+
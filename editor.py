@@ -1,10 +1,31 @@
 
 import numpy as np
-from PyQt5.QtWidgets import QGraphicsView, QGraphicsPixmapItem, QApplication, QWidget, QGridLayout
-from PyQt5.QtGui import QImage, QPixmap, QPainter, QTransform
-from PyQt5.QtCore import Qt, QSizeF, QRectF, QPointF
-from PIL import Image, ImageEnhance
-
+from PyQt5.QtWidgets import QGraphicsView, QGraphicsPixmapItem, QApplication, QWidget, QGridLayout, QMessageBox
+from PyQt5.QtGui import QImage, QPixmap, QPainter, QPixmapCache
+from PyQt5.QtCore import Qt, QSize, QSizeF, QRect, QRectF, QPointF
+from proxy import ProxyDocument, read_proxy, PROXY_MAX_PIXELS
+from backing_store import BackingStore
+from imaging import (
+    adjust_image, to_working_format, image_to_pixmap, pixmap_shares_pixels, draw_to_pixmap, is_palette,
+    paste_region, CV2_AVAILABLE
+)
+from tracing import span, traced
+from jobs import Job, BACKGROUND_MIN_PIXELS
+from region_stats import RegionStatistics, format_statistics
+from selection_mask import blend_outside, clear_outside
+from layers import LayerStack, flatten_layers
+from filters import filter_image, FILTERS
+from curves import curve_image, ChannelHistograms
+from grading import ColourIndex
+from straighten import estimate_skew, order_corners, DEFAULT_INTERPOLATION, DEFAULT_DESKEW_FILL, FINE_STEP
+from resampling import (
+    resize_image, rotate_image, DEFAULT_RESIZE_MODE, DEFAULT_ROTATION_INTERPOLATION, DEFAULT_ROTATION_FILL
+)
+import frame_timing
+
+# Views zoomed out less than this are previewed at full resolution, as a
+# proxy would be nearly another copy of the visible area and save little work
+PROXY_MAX_SCALE = 0.75
 
 #from commands import FixPasteCommand, CropCommand, TransformCommand, GrayscaleCommand, CutCommand, PasteCommand, ResizeCommand
 #from widgets import RulerWidget
@@ -37,7 +58,9 @@ class ImageEditor(QGraphicsView):
         self.setResizeAnchor(QGraphicsView.AnchorUnderMouse)
         self.rulers_visible = False
         self.scene.selectionChanged.connect(self.updateStatusBar)
-        self.pasted_items = []
+        self.pasted_items = {}  # Layer -> its MovableImageItem handle; layers holds their order
+        self.layers = LayerStack()
+        self.composite_item = None  # Shows the image with the layers blended in, where they are
         self.clipboard = QApplication.clipboard()
         self.is_modified = False
         self.undo_stack = []
@@ -45,6 +68,17 @@ class ImageEditor(QGraphicsView):
         self.ruler_width = 30
         self.cursor_pos = QPointF(-1, -1)
         self.image_before_preview = None
+        self.proxy = None  # ProxyDocument when editing a reduced-resolution proxy
+        self.pixmap_dropped = False  # Display pixmap released to save memory; rebuilt on the next paint
+        self.job = None  # Background job currently computing an edit
+        self.background_min_pixels = BACKGROUND_MIN_PIXELS  # None runs every edit on the GUI thread
+        self.filter_preview_item = None  # Filtered proxy of the visible area shown by the filter dialog
+        self.filter_preview_source = None  # (key, proxy) of the visible area, reused while the view doesn't change
+        self.grade_index = None  # ColourIndex of that proxy for the colour grading preview
+        self.region_stats = None  # RegionStatistics of current_image for the selection readout
+        self.region_stats_job = None  # Background job building region_stats for a newer image
+        self.histograms = None  # ChannelHistograms of current_image (or the selection) for the curves dialog
+        self.histograms_job = None  # Background job counting them
 
     def adjustTickSpacing(self, spacing):
         """Adjust tick spacing to a convenient number."""
@@ -61,21 +95,68 @@ class ImageEditor(QGraphicsView):
         else:
             return 10 * magnitude
 
+    @traced("ImageEditor.paint", "paint")
+    @frame_timing.timed("ImageEditor.paint", presents_frame=True)
     def paintEvent(self, event):
         """Handle paint events."""
+        if self.pixmap_dropped:
+            self.restorePixmap()
+        if self.pasted_items:
+            # Catches images changed without patchImage() or a stroke telling the layers where
+            self.showLayers()
         super().paintEvent(event)
 
+    def restorePixmap(self):
+        """Rebuild the display pixmap dropped by dropCachedPixmaps(), unless something set a new one."""
+        self.pixmap_dropped = False
+        if self.image_item and self.current_image and self.image_item.pixmap().isNull():
+            self.image_item.setPixmap(image_to_pixmap(self.current_image))
+
+    def refreshDisplay(self):
+        """Rebuild the display pixmaps, after the monitor profile changed."""
+        self.cancel_filter_preview()
+        if self.image_item and self.current_image and not self.pixmap_dropped:
+            self.image_item.setPixmap(image_to_pixmap(self.current_image))
+        if self.composite_item is not None:
+            self.composite_item.setPixmap(QPixmap())
+            self.showLayers()
+        self.viewport().update()
+
+    def dropCachedPixmaps(self):
+        """Release the display pixmap and Qt's pixmap cache; return the bytes freed.
+
+        The pixmap is rebuilt from current_image when the document is painted
+        again, so this mostly helps documents in background windows.
+        """
+        from memory_usage import image_bytes
+        QPixmapCache.clear()
+        if not self.image_item or self.image_item.pixmap().isNull():
+            return 0
+        freed = image_bytes(self.image_item.pixmap())
+        self.image_item.setPixmap(QPixmap())
+        self.pixmap_dropped = True
+        return freed
+
+    def purgeRedoHistory(self):
+        """Discard the redo history; return the number of entries removed."""
+        count = len(self.redo_stack)
+        self.redo_stack.clear()
+        return count
+
+    @traced("ImageEditor.setImage", "display")
     def setImage(self, image):
         """Set the current image in the editor."""
         if not image:
             return
+        image = to_working_format(image)
         self.current_image = image
         self.original_image = image.copy()
         if not self.image_item:
-            self.image_item = QGraphicsPixmapItem()
+            from scene import DocumentItem
+            self.image_item = DocumentItem()
             self.image_item.setTransformationMode(Qt.SmoothTransformation)
             self.scene.addItem(self.image_item)
-        self.image_item.setPixmap(QPixmap.fromImage(self.current_image))
+        self.image_item.setPixmap(image_to_pixmap(self.current_image))
         self.scene.setSceneRect(0, 0, image.width(), image.height())
         self.image_item.setPos(0, 0)  # Always set to (0, 0)
         self.zoom_factor = 1.0
@@ -83,7 +164,13 @@ class ImageEditor(QGraphicsView):
         self.fitInViewWithRulers()
         self.scene.update()
         self.viewport().update()
+        self.updateRegionStatistics()
         
+    @frame_timing.timed("ImageEditor.wheel", input_event=True)
+    def wheelEvent(self, event):
+        """Handle wheel scrolling (timed as input for the frame statistics)."""
+        super().wheelEvent(event)
+
     def scrollContentsBy(self, dx, dy):
         """Update rulers during scrolling."""
         super().scrollContentsBy(dx, dy)
@@ -92,11 +179,72 @@ class ImageEditor(QGraphicsView):
 
     def executeCommand(self, command):
         """Execute a command and add it to the undo stack."""
-        command.execute()
+        if not self.ensureIdle():
+            return
+        with span(f"{type(command).__name__}.execute", "command"):
+            command.execute()
         self.undo_stack.append(command)
         self.redo_stack.clear()
         self.is_modified = True
+        self.updateRegionStatistics()
+
+    def ensureIdle(self):
+        """Return True if no background job is running; otherwise tell the user and return False."""
+        if self.job is None:
+            return True
+        self.window().statusBar().showMessage(f"Please wait: {self.job.title} is still running", 2000)
+        return False
+
+    def runsInBackground(self):
+        """Return True if edits of the current image are large enough to go to a worker thread."""
+        if self.background_min_pixels is None or not self.current_image:
+            return False
+        return self.current_image.width() * self.current_image.height() >= self.background_min_pixels
+
+    def runJob(self, title, function, on_finished, on_cancelled=None):
+        """Run function(token, progress) and pass its result to on_finished on the GUI thread.
+
+        Large documents run it on a worker thread with progress in the status
+        bar; a cancelled or failed job calls on_cancelled instead and leaves
+        the document and history untouched.
+        """
+        if not self.ensureIdle():
+            return False
+        if not self.runsInBackground():
+            on_finished(function(None, None))
+            return True
+        job = Job(title, function)
+        self.job = job
+        job.signals.finished.connect(lambda result: self.finishJob(on_finished, result))
+        job.signals.cancelled.connect(lambda: self.finishJob(on_cancelled))
+        job.signals.failed.connect(lambda error: self.failJob(title, error, on_cancelled))
+        progress = getattr(self.window(), 'job_progress', None)
+        if progress is not None:
+            progress.track(job)
+        job.start()
+        return True
+
+    def finishJob(self, callback, *args):
+        self.job = None
+        if callback:
+            callback(*args)
+
+    def failJob(self, title, error, on_cancelled):
+        self.finishJob(on_cancelled)
+        QMessageBox.warning(self.window(), "Error", f"{title} failed: {error}")
 
+    def cancelJob(self):
+        if self.job is not None:
+            self.job.cancel()
+
+    def runCommand(self, command, title, on_cancelled=None):
+        """Execute a command whose result is computed by command.prepare(), in the background for large images."""
+        def finished(result):
+            self.executeCommand(command)
+            self.image_before_preview = None
+        return self.runJob(title, command.prepare, finished, on_cancelled)
+
+    @frame_timing.timed("ImageEditor.mouseMove", input_event=True)
     def mouseMoveEvent(self, event):
         """Handle mouse movement for cursor tracking."""
         super().mouseMoveEvent(event)
@@ -105,34 +253,119 @@ class ImageEditor(QGraphicsView):
         if self.rulers_visible:
             self.parent().updateRulerLayout()
 
-    def mousePressEvent(self, event):
-        """Handle mouse press to fix pasted items."""
-        super().mousePressEvent(event)
-        if not self.scene.selectedItems() and self.pasted_items:
-            self.fixPastedItems()
+    def addLayer(self, item, index=None):
+        """Put the MovableImageItem of a layer on the document, at index in the stack (default: on top)."""
+        self.addLayers([item], [index])
+
+    def addLayers(self, items, indices=None):
+        """Put several layers' items on the document at once, recompositing once; indices as for addLayer()."""
+        for item, index in zip(items, indices or [None] * len(items)):
+            self.pasted_items[item.layer] = item
+            self.layers.add(item.layer, index)
+            # Before it joins the scene, so that it doesn't report a move
+            item.setPos(QPointF(item.layer.pos))
+            if item.scene() is None:
+                self.scene.addItem(item)
+        self.showLayers()
+
+    def removeLayer(self, item):
+        """Take a layer and its item off the document; return its index in the stack."""
+        return self.removeLayers([item])[0]
+
+    def removeLayers(self, items):
+        """Take several layers off the document at once, skipping any not on it; return their indices."""
+        items = [item for item in items if item.layer in self.pasted_items]
+        indices = [self.layers.index(item.layer) for item in items]
+        self.layers.remove(*(item.layer for item in items))
+        for item in items:
+            del self.pasted_items[item.layer]
+            if item.scene() is not None:
+                self.scene.removeItem(item)
+        self.showLayers()
+        return indices
+
+    def layerItems(self):
+        """Return the items of the pasted layers, bottom first."""
+        return [self.pasted_items[layer] for layer in self.layers]
+
+    def moveLayer(self, item):
+        """Follow a layer's item to its new position."""
+        if item.layer not in self.pasted_items:
+            return
+        self.layers.move(item.layer, item.pos().toPoint())
+        self.is_modified = True
+        self.showLayers()
+
+    def setLayerProperties(self, item, opacity, blend_mode):
+        """Change a layer's opacity and blend mode, recompositing only the area it covers."""
+        item.layer.opacity = opacity
+        item.layer.blend_mode = blend_mode
+        self.layers.changed(item.layer)
+        self.showLayers()
+
+    def selectedLayerItem(self):
+        """Return the selected pasted layer's item, or the only one if there's just one; None otherwise."""
+        from scene import MovableImageItem
+        selected = [item for item in self.scene.selectedItems() if isinstance(item, MovableImageItem)]
+        if len(selected) == 1:
+            return selected[0]
+        if len(self.pasted_items) == 1:
+            return next(iter(self.pasted_items.values()))
+        return None
 
-    def fixPastedItems(self):
-        """Fix all pasted items onto the canvas."""
-        if not self.pasted_items:
+    def showLayers(self):
+        """Recomposite whatever changed in the layers or under them and show it over the image."""
+        if not self.current_image or not self.image_item:
             return
-        old_image = self.current_image.copy()
-        painter = QPainter(self.current_image)
-        painter.setRenderHint(QPainter.Antialiasing)
-        painter.setRenderHint(QPainter.SmoothPixmapTransform)
-        for item in self.pasted_items:
-            pos = item.pos()
-            pixmap = item.pixmap()
-            painter.drawPixmap(int(pos.x()), int(pos.y()), pixmap)
-            self.scene.removeItem(item)
-        painter.end()
-        self.image_item.setPixmap(QPixmap.fromImage(self.current_image))
-        self.scene.update()
-        self.viewport().update()
+        composite = self.layers.composite
+        rects = self.layers.render(self.current_image)
+        if self.layers.composite is None:
+            if self.composite_item is not None:
+                self.scene.removeItem(self.composite_item)
+                self.composite_item = None
+                self.image_item.covered = QRect()
+                self.scene.update()
+            return
+        if self.composite_item is None:
+            self.composite_item = QGraphicsPixmapItem()
+            self.composite_item.setTransformationMode(Qt.SmoothTransformation)
+            # Right over the image: below filter previews, layer handles and the selection
+            self.composite_item.setZValue(1)
+            self.scene.addItem(self.composite_item)
+        if self.layers.composite is not composite or self.composite_item.pixmap().isNull():
+            # Shares the composite's pixels, so later renders show up without an upload
+            self.composite_item.setPixmap(image_to_pixmap(self.layers.composite))
+            self.composite_item.setPos(QPointF(self.layers.bounds.topLeft()))
+            self.image_item.covered = QRect(self.layers.bounds)
+            self.scene.update()
+            return
+        if not pixmap_shares_pixels(self.layers.composite):
+            # Converted for the monitor: redraw the recomposited rectangles into the pixmap
+            pixmap = self.composite_item.pixmap()
+            self.composite_item.setPixmap(QPixmap())
+            for rect in rects:
+                draw_to_pixmap(pixmap, self.layers.composite, rect.translated(-self.layers.bounds.topLeft()))
+            self.composite_item.setPixmap(pixmap)
+        for rect in rects:
+            self.scene.update(QRectF(rect))
+
+    @traced("ImageEditor.flattenLayers", "command")
+    def flattenLayers(self):
+        """Blend the pasted layers into the image as one undo step; return False if a job is running."""
+        if not self.pasted_items:
+            return True
+        if not self.ensureIdle():
+            return False
+        rect, region = self.layers.flattened(self.current_image)
         from commands import FixPasteCommand
-        command = FixPasteCommand(self, old_image, self.current_image.copy(), self.pasted_items[:])
-        self.undo_stack.append(command)
-        self.redo_stack.clear()
-        self.pasted_items.clear()
+        self.executeCommand(FixPasteCommand(self, self.layerItems(), rect, region))
+        return True
+
+    def flattenedImage(self):
+        """Return current_image with the layers blended in, leaving the document as it is."""
+        if not self.pasted_items:
+            return self.current_image
+        return flatten_layers(self.current_image, self.layers)
 
     def leaveEvent(self, event):
         """Handle cursor leaving the widget."""
@@ -168,26 +401,30 @@ class ImageEditor(QGraphicsView):
 
     def undo(self):
         """Undo last operation"""
-        if not self.undo_stack:
+        if not self.undo_stack or not self.ensureIdle():
             return
         command = self.undo_stack.pop()
         self.redo_stack.append(command)
-        command.undo()
+        with span(f"{type(command).__name__}.undo", "command"):
+            command.undo()
         self.is_modified = bool(self.undo_stack)  # Update flag of changes
         self.updateWindowTitle()
+        self.updateRegionStatistics()
         self.scene.update()
         self.viewport().update()
         self.window().statusBar().showMessage("Undo performed", 2000)
 
     def redo(self):
         """Redo undone operation"""
-        if not self.redo_stack:
+        if not self.redo_stack or not self.ensureIdle():
             return
         command = self.redo_stack.pop()
         self.undo_stack.append(command)
-        command.redo()
+        with span(f"{type(command).__name__}.redo", "command"):
+            command.redo()
         self.is_modified = True  # After redo always chsnges there
         self.updateWindowTitle()
+        self.updateRegionStatistics()
         self.scene.update()
         self.viewport().update()
         self.window().statusBar().showMessage("Redo performed", 2000)
@@ -201,6 +438,7 @@ class ImageEditor(QGraphicsView):
         self.setImage(self.original_image)
         return True
 
+    @traced("ImageEditor.openImage", "io")
     def openImage(self, file_name):
         """Open an image file."""
         image = QImage(file_name)
@@ -215,6 +453,55 @@ class ImageEditor(QGraphicsView):
         self.redo_stack.clear()
         return True
 
+    @traced("ImageEditor.openProxy", "io")
+    def openProxy(self, file_name, max_pixels=PROXY_MAX_PIXELS):
+        """Open a reduced-resolution proxy of an image file; edits are replayed on save."""
+        image, full_size = read_proxy(file_name, max_pixels)
+        if image.isNull():
+            return False
+        self.setImage(image)
+        self.proxy = ProxyDocument(file_name, full_size, image.size())
+        self.is_modified = False
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        return True
+
+    @traced("ImageEditor.openMapped", "io")
+    def openMapped(self, file_name, max_pixels=PROXY_MAX_PIXELS, store=None):
+        """Memory-map an uncompressed image and edit it through a display overview."""
+        if store is None:
+            store = BackingStore.open(file_name)
+        if store is None:
+            return False
+        overview = store.overview(max_pixels)
+        self.setImage(overview)
+        self.proxy = ProxyDocument(file_name, QSize(store.width(), store.height()), overview.size(), store=store)
+        self.is_modified = False
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        return True
+
+    @traced("ImageEditor.saveImage", "io")
+    def saveImage(self, file_name):
+        """Save the document; proxies are re-rendered from their full-resolution source."""
+        if self.proxy is None:
+            return self.flattenedImage().save(file_name)
+        # The full-resolution replay only sees layers through the history
+        if not self.flattenLayers():
+            return False
+        return self.proxy.save(file_name, self.undo_stack)
+
+    def renderImage(self):
+        """Return the image to save, layers blended in; in proxy mode the full-resolution source with all edits replayed.
+
+        None if the layers must be flattened for the replay while a job is running.
+        """
+        if self.proxy is None:
+            return self.flattenedImage()
+        if not self.flattenLayers():
+            return None
+        return self.proxy.render(self.undo_stack)
+
     def resetView(self):
         """Reset the view to fit the image."""
         self.fitInView(self.scene.sceneRect(), Qt.KeepAspectRatio)
@@ -263,11 +550,14 @@ class ImageEditor(QGraphicsView):
         return self.current_image
 
     def getSelectedRegion(self):
-        """Get the selected region as a QImage."""
+        """Get the selected region as a QImage, transparent outside a lasso, polygon or wand selection."""
         if not self.scene.selection_rect or not self.current_image:
             return None
         selection = self.scene.selection_rect.rect().toRect()
         if selection.isValid() and not selection.isEmpty():
+            mask = self.selectionMask()
+            if mask is not None:
+                return clear_outside(self.current_image.copy(selection), mask.array(selection))
             return self.current_image.copy(selection)
         return None
 
@@ -277,6 +567,7 @@ class ImageEditor(QGraphicsView):
             return False
         selection = self.scene.selection_rect.rect().toRect()
         if selection.isValid() and not selection.isEmpty():
+            self.discardRegionStatistics()
             painter = QPainter(self.current_image)
             painter.setRenderHint(QPainter.Antialiasing)
             painter.setRenderHint(QPainter.SmoothPixmapTransform)
@@ -288,17 +579,16 @@ class ImageEditor(QGraphicsView):
 
     def rotateImage(self, degrees):
         """Rotate the image by specified degrees."""
-        if not self.current_image: return
+        if not self.current_image or not self.flattenLayers(): return
         from commands import TransformCommand
         # For direct rotations, the 'original' for the command is always a fresh copy of the current state.
         command = TransformCommand(self, degrees=degrees, original_image_override=self.current_image.copy())
-        self.executeCommand(command)
-        # Ensure preview state is cleared if any was inadvertently active
-        self.image_before_preview = None
+        # Clears any preview state that was inadvertently active once the rotation is applied
+        self.runCommand(command, f"Rotating by {degrees}°")
 
     def flipImage(self, horizontal=True):
         """Flip the image horizontally or vertically."""
-        if not self.current_image:
+        if not self.current_image or not self.flattenLayers():
             return
         from commands import TransformCommand  # Local import
         command = TransformCommand(self, horizontal_flip=horizontal)
@@ -323,7 +613,7 @@ class ImageEditor(QGraphicsView):
 
         # Обновляем текущее изображение
         self.current_image = resized_image
-        self.image_item.setPixmap(QPixmap.fromImage(self.current_image))
+        self.image_item.setPixmap(image_to_pixmap(self.current_image))
         self.scene.setSceneRect(0, 0, new_width, new_height)
         self.image_item.setPos(0, 0)
         self.fitInViewWithRulers()
@@ -342,29 +632,42 @@ class ImageEditor(QGraphicsView):
         self.redo_stack.clear()
     '''
     
-    def resizeImage(self, new_width, new_height, keep_aspect=True):
-        """Resize the current image."""
-        if not self.current_image:
+    @traced("ImageEditor.resizeImage", "command")
+    def resizeImage(self, new_width, new_height, keep_aspect=True, mode=DEFAULT_RESIZE_MODE):
+        """Resize the current image with one of the resampling.RESIZE_MODES; pasted layers are flattened first."""
+        if not self.current_image or not self.flattenLayers():
             return
-        old_image = self.current_image.copy()
+        source = self.current_image
         # Выбираем режим масштабирования в зависимости от keep_aspect
         aspect_mode = Qt.KeepAspectRatio if keep_aspect else Qt.IgnoreAspectRatio
-        resized_image = self.current_image.scaled(new_width, new_height, aspect_mode, Qt.SmoothTransformation)
-        self.current_image = resized_image
-        self.image_item.setPixmap(QPixmap.fromImage(self.current_image))
+        size = source.size().scaled(new_width, new_height, aspect_mode)
+        width, height = max(1, size.width()), max(1, size.height())
+
+        def resize(token, progress):
+            return resize_image(source, width, height, mode, token, progress)
+        self.runJob(f"Resizing to {width}x{height}", resize, lambda image: self.applyResizedImage(image, mode))
+
+    def applyResizedImage(self, resized_image, mode=DEFAULT_RESIZE_MODE):
+        """Show a resized image and record the resize in the history."""
+        old_image = self.current_image.copy()
+        new_width, new_height = resized_image.width(), resized_image.height()
+        self.current_image = to_working_format(resized_image, "resize")
+        self.image_item.setPixmap(image_to_pixmap(self.current_image))
         self.scene.setSceneRect(0, 0, new_width, new_height)
         self.image_item.setPos(0, 0)
         self.fitInViewWithRulers()
         self.scene.update()
         self.viewport().update()
         self.is_modified = True
-        if len(self.undo_stack) > 10:
+        # A proxy's history is what saving replays on the source, so it is kept whole
+        if self.proxy is None and len(self.undo_stack) > 10:
             self.undo_stack.pop(0)
         from commands import ResizeCommand
-        command = ResizeCommand(self, old_image, self.current_image.copy())
+        command = ResizeCommand(self, old_image, self.current_image.copy(), mode)
         self.undo_stack.append(command)
         self.redo_stack.clear()
         self.updateWindowTitle()
+        self.updateRegionStatistics()
         
     
     def convertToGrayscale(self):
@@ -372,26 +675,108 @@ class ImageEditor(QGraphicsView):
         if not self.current_image:
             return
         from commands import GrayscaleCommand
-        command = GrayscaleCommand(self)
+        command = GrayscaleCommand(self, region=self.selectionRect(), mask=self.selectionMask())
         self.executeCommand(command)
 
+    def convertMode(self, conversion):
+        """Convert the document to the palette, grayscale or 1-bit mode of conversion (a quantize.ModeConversion)."""
+        if not self.current_image:
+            return
+        from commands import ConvertModeCommand
+        self.runCommand(ConvertModeCommand(self, conversion), f"Converting to {conversion.description()}")
+
+    def deskew(self):
+        """Straighten the image by the skew of its lines of text, or other horizontal structure."""
+        if not self.current_image or not self.flattenLayers():
+            return
+        # Measured on a small copy of the page, so it needn't be a background job
+        degrees = estimate_skew(self.current_image)
+        if abs(degrees) < FINE_STEP:
+            self.window().statusBar().showMessage("No skew found", 2000)
+            return
+        from commands import TransformCommand
+        command = TransformCommand(self, degrees=degrees, original_image_override=self.current_image.copy(),
+                                   interpolation=DEFAULT_INTERPOLATION, fill=DEFAULT_DESKEW_FILL)
+        self.runCommand(command, f"Deskewing by {degrees}°")
+
+    def correctPerspective(self, points):
+        """Map the quadrilateral with corners points (four (x, y) in any order) onto a rectangle."""
+        if not self.current_image or not self.flattenLayers():
+            return
+        if not CV2_AVAILABLE:
+            self.window().statusBar().showMessage("Perspective correction requires OpenCV (cv2)", 3000)
+            return
+        try:
+            points = order_corners(points)
+        except ValueError as e:
+            self.window().statusBar().showMessage(f"Can't correct perspective: {e}", 3000)
+            return
+        from commands import PerspectiveCommand
+        self.runCommand(PerspectiveCommand(self, points), "Correcting perspective")
+
     def updateStatusBar(self, rect=None):
-        """Update the status bar with selection info."""
+        """Update the status bar with selection info and, once they're built, its channel statistics."""
         if rect and rect.isValid():
             status_message = f"Selection: {rect.width():.0f}x{rect.height():.0f} at ({rect.x():.0f}, {rect.y():.0f})"
+            region_stats = self.regionStatistics()
+            statistics = region_stats.rect_statistics(rect.toRect()) if region_stats else None
+            if statistics:
+                status_message += "  " + format_statistics(statistics)
             window = self.window()
             if hasattr(window, 'statusBar'):
                 window.statusBar().showMessage(status_message)
 
-    def applyAllPastedItems(self):
-        """Apply all pasted movable items to the main image."""
+    def regionStatistics(self):
+        """Return the RegionStatistics of current_image, or None while they're built in the background."""
         if not self.current_image:
+            return None
+        if self.region_stats is None or not self.region_stats.matches(self.current_image):
+            if self.runsInBackground():
+                # Also catches images changed without going through setImage() or the history
+                self.updateRegionStatistics()
+                return None
+            self.region_stats = RegionStatistics(self.current_image)
+        return self.region_stats
+
+    def updateRegionStatistics(self):
+        """Start rebuilding the selection statistics of a large current_image in the background.
+
+        Small images are done on demand by regionStatistics() instead. The
+        selection readout stays geometry-only until the build finishes, and
+        a build for an image that has been replaced since is dropped.
+        """
+        image = self.current_image
+        if not image or (self.region_stats is not None and self.region_stats.matches(image)):
             return
-        for item in self.pasted_items[:]:
-            self.scene.fixMovableItem(item, self)
-            self.scene.removeItem(item)
-            self.pasted_items.remove(item)
-        self.scene.update()
+        if self.region_stats_job is not None and self.region_stats_job.key == image.cacheKey():
+            return
+        self.discardRegionStatistics()
+        if not self.runsInBackground():
+            return
+        job = Job("Selection statistics", lambda token, progress: RegionStatistics(image, token))
+        job.key = image.cacheKey()
+        job.signals.finished.connect(lambda statistics: self.finishRegionStatistics(job, statistics))
+        job.signals.cancelled.connect(lambda: self.finishRegionStatistics(job, None))
+        job.signals.failed.connect(lambda error: self.finishRegionStatistics(job, None))
+        self.region_stats_job = job
+        job.start()
+
+    def discardRegionStatistics(self):
+        """Drop the statistics before painting into current_image, so they don't make QPainter copy it."""
+        self.region_stats = None
+        if self.region_stats_job is not None:
+            self.region_stats_job.cancel()
+            self.region_stats_job = None
+
+    def finishRegionStatistics(self, job, statistics):
+        if job is not self.region_stats_job:
+            return
+        self.region_stats_job = None
+        if statistics is None or not statistics.matches(self.current_image):
+            return
+        self.region_stats = statistics
+        if self.scene.selection_rect:
+            self.updateStatusBar(self.scene.selection_rect.rect())
 
     def cut(self):
         """Cut the selected area to the clipboard."""
@@ -404,27 +789,24 @@ class ImageEditor(QGraphicsView):
 
     def paste(self):
         """Paste an image from the clipboard as a movable item."""
-        clipboard = QApplication.clipboard()
-        mime_data = clipboard.mimeData()
-        if mime_data.hasImage():
-            clipboard_image = QImage(mime_data.imageData())
-            if not clipboard_image.isNull():
-                # Convert to a high-quality format with an alpha channel to preserve quality
-                clipboard_image = clipboard_image.convertToFormat(QImage.Format_ARGB32)
-                from commands import PasteCommand
-                
-                command = PasteCommand(self, clipboard_image)
-                self.executeCommand(command)
+        from clipboard import clipboard_image as get_clipboard_image
+        clipboard_image = get_clipboard_image()
+        if clipboard_image is not None:
+            # A no-op (shared buffer) for images copied from our own documents
+            clipboard_image = to_working_format(clipboard_image, "paste")
+            from commands import PasteCommand
+
+            command = PasteCommand(self, clipboard_image)
+            self.executeCommand(command)
 
     def start_preview(self):
         self.image_before_preview = self.current_image.copy() if self.current_image else None
 
-    def preview_rotation(self, angle):
+    def preview_rotation(self, angle, interpolation=DEFAULT_ROTATION_INTERPOLATION, fill=DEFAULT_ROTATION_FILL):
         if self.image_before_preview and self.image_item:
-            transform = QTransform().rotate(angle)
-            preview_image = self.image_before_preview.transformed(transform, Qt.SmoothTransformation)
+            preview_image = rotate_image(self.image_before_preview, angle, interpolation, fill)
             self.current_image = preview_image
-            self.image_item.setPixmap(QPixmap.fromImage(self.current_image))
+            self.image_item.setPixmap(image_to_pixmap(self.current_image))
             self.scene.setSceneRect(0, 0, self.current_image.width(), self.current_image.height())
             self.image_item.setPos(0, 0)
             self.scene.update()
@@ -433,85 +815,38 @@ class ImageEditor(QGraphicsView):
     def cancel_preview(self):
         if self.image_before_preview and self.image_item:
             self.current_image = self.image_before_preview.copy() # Restore from the saved state
-            self.image_item.setPixmap(QPixmap.fromImage(self.current_image))
+            self.image_item.setPixmap(image_to_pixmap(self.current_image))
             self.scene.setSceneRect(0, 0, self.current_image.width(), self.current_image.height())
             self.image_item.setPos(0, 0)
             self.scene.update()
             self.viewport().update()
         self.image_before_preview = None # Clear the saved state
 
-    def apply_rotation(self, degrees):
+    def apply_rotation(self, degrees, interpolation=DEFAULT_ROTATION_INTERPOLATION, fill=DEFAULT_ROTATION_FILL):
         if not self.current_image: return
         from commands import TransformCommand
         # Use image_before_preview if available (meaning dialog was used),
         # otherwise, current_image for direct calls (though rotateImage is now primary for that).
         image_for_command_basis = self.image_before_preview if self.image_before_preview else self.current_image
-        command = TransformCommand(self, degrees=degrees, original_image_override=image_for_command_basis.copy())
-        self.executeCommand(command)
-        self.image_before_preview = None # Clear preview state post-command
+        command = TransformCommand(self, degrees=degrees, original_image_override=image_for_command_basis.copy(),
+                                   interpolation=interpolation, fill=fill)
+        # The preview stays on screen until the job is done; cancelling restores the original
+        self.runCommand(command, f"Rotating by {degrees}°", on_cancelled=self.cancel_preview)
 
     def preview_adjustments(self, brightness, contrast, gamma, autobalance):
         if self.image_before_preview and self.image_item:
-            image = self.image_before_preview.copy()
-            if autobalance:
-                width, height = image.width(), image.height()
-                ptr = image.bits()
-                ptr.setsize(height * width * 4)
-                img_array = np.frombuffer(ptr, dtype=np.uint8).reshape(height, width, 4).copy()
-
-                r_hist = np.histogram(img_array[:, :, 2], bins=256, range=(0, 256))[0]
-                g_hist = np.histogram(img_array[:, :, 1], bins=256, range=(0, 256))[0]
-                b_hist = np.histogram(img_array[:, :, 0], bins=256, range=(0, 256))[0]
-                total_pixels = width * height
-                threshold = total_pixels * 0.05
-
-                def find_bounds(hist):
-                    low, high = 0, 255
-                    count = 0
-                    for i, val in enumerate(hist):
-                        count += val
-                        if count > threshold:
-                            low = i
-                            break
-                    count = 0
-                    for i, val in enumerate(hist[::-1]):
-                        count += val
-                        if count > threshold:
-                            high = 255 - i
-                            break
-                    if low >= high:
-                        high = low + 1 if low < 255 else 255
-                        low = high - 1 if high > 0 else 0
-                    return low, high
-
-                r_low, r_high = find_bounds(r_hist)
-                g_low, g_high = find_bounds(g_hist)
-                b_low, b_high = find_bounds(b_hist)
-
-                r_range = max(r_high - r_low, 1)
-                g_range = max(g_high - g_low, 1)
-                b_range = max(b_high - b_low, 1)
-
-                img_array[:, :, 2] = np.clip((img_array[:, :, 2].astype(np.float32) - r_low) * 255 / r_range, 0, 255).astype(np.uint8)
-                img_array[:, :, 1] = np.clip((img_array[:, :, 1].astype(np.float32) - g_low) * 255 / g_range, 0, 255).astype(np.uint8)
-                img_array[:, :, 0] = np.clip((img_array[:, :, 0].astype(np.float32) - b_low) * 255 / b_range, 0, 255).astype(np.uint8)
-
-                image = QImage(img_array.tobytes(), width, height, image.bytesPerLine(), QImage.Format_RGB32)
-
-            pil_img = Image.frombytes("RGBA", (image.width(), image.height()), image.bits().asstring(image.byteCount()))
-            if brightness != 0:
-                enhancer = ImageEnhance.Brightness(pil_img)
-                pil_img = enhancer.enhance(1.0 + brightness)
-            if contrast != 0:
-                enhancer = ImageEnhance.Contrast(pil_img)
-                pil_img = enhancer.enhance(1.0 + contrast)
-            if gamma != 1.0:
-                enhancer = ImageEnhance.Brightness(pil_img)
-                pil_img = enhancer.enhance(gamma)
-
-            preview_image = QImage(pil_img.tobytes(), image.width(), image.height(), image.bytesPerLine(), QImage.Format_RGB32)
+            region = self.selectionRect()
+            if region is not None and not is_palette(self.image_before_preview):
+                before = self.image_before_preview.copy(region)
+                adjusted = adjust_image(before, brightness, contrast, gamma, autobalance)
+                mask = self.selectionMask()
+                if mask is not None:
+                    adjusted = blend_outside(adjusted, before, mask.array(region))
+                self.patchImage(region, adjusted)
+                return
+            preview_image = adjust_image(self.image_before_preview, brightness, contrast, gamma, autobalance)
             self.current_image = preview_image
-            self.image_item.setPixmap(QPixmap.fromImage(self.current_image))
+            self.image_item.setPixmap(image_to_pixmap(self.current_image))
             self.scene.update()
             self.viewport().update()
 
@@ -519,9 +854,255 @@ class ImageEditor(QGraphicsView):
         if not self.current_image: return
         from commands import AdjustmentsCommand
         image_for_command_basis = self.image_before_preview if self.image_before_preview else self.current_image
-        command = AdjustmentsCommand(self, brightness, contrast, gamma, autobalance, original_image_override=image_for_command_basis.copy())
-        self.executeCommand(command)
-        self.image_before_preview = None
+        # Shared, not copied: nothing paints into it, and a selection-scoped command keeps only the region
+        command = AdjustmentsCommand(self, brightness, contrast, gamma, autobalance,
+                                     original_image_override=image_for_command_basis, region=self.selectionRect(),
+                                     mask=self.selectionMask())
+        self.runCommand(command, "Adjusting", on_cancelled=self.cancel_preview)
+
+    def selectionRect(self):
+        """Return the selection clipped to the image as a QRect, or None if there is none."""
+        if not self.scene.selection_rect or not self.current_image:
+            return None
+        selection = self.scene.selection_rect.rect().toRect().intersected(self.current_image.rect())
+        return None if selection.isEmpty() else selection
+
+    def selectionMask(self):
+        """Return the SelectionMask of a lasso, polygon or magic wand selection, or None."""
+        return getattr(self.scene.selection_rect, 'mask', None)
+
+    def patchImage(self, rect, region):
+        """Replace the pixels of current_image in rect with region, in place.
+
+        Only the region is written and redrawn, so selection-sized edits cost
+        in proportion to the selection, not the image.
+        """
+        self.discardRegionStatistics()
+        pixmap = self.image_item.pixmap()
+        shown = not pixmap.isNull()  # Otherwise dropped by dropCachedPixmaps(); restorePixmap() rebuilds it
+        # Take the pixmap off the item, so painting into it doesn't copy it
+        self.image_item.setPixmap(QPixmap())
+        if pixmap_shares_pixels(self.current_image):
+            # The pixmap shares current_image's pixels: let go of them, it's recreated below for free
+            pixmap = None
+        # A handle of our own: the write then detaches from pixels the history or a caller
+        # still holds (setImage() keeps the QImage object it's given) instead of changing them
+        self.current_image = QImage(self.current_image)
+        paste_region(self.current_image, rect, region)
+        self.layers.imageChanged(self.current_image, rect)
+        if shown and pixmap is None:
+            self.image_item.setPixmap(image_to_pixmap(self.current_image))
+        elif shown:
+            draw_to_pixmap(pixmap, self.current_image, rect)
+            self.image_item.setPixmap(pixmap)
+        self.showLayers()
+        self.scene.update(QRectF(rect))
+        self.viewport().update()
+
+    def beginStroke(self, brush, mode, offset=(0, 0)):
+        """Start a brush, eraser or clone stroke painted straight into current_image; None if it can't be painted."""
+        from brush import Stroke, can_paint
+        if not self.current_image or not self.ensureIdle():
+            return None
+        if not can_paint(self.current_image):
+            self.window().statusBar().showMessage("Painting needs an RGB or grayscale image", 3000)
+            return None
+        self.discardRegionStatistics()
+        pixmap = self.image_item.pixmap()
+        shown = not pixmap.isNull()
+        self.image_item.setPixmap(QPixmap())
+        if pixmap_shares_pixels(self.current_image):
+            # The pixmap shares current_image's pixels: let go of them, it's recreated below for free
+            pixmap = None
+        # Our own pixels, as in patchImage(): copied only if the history still shares them
+        self.current_image = QImage(self.current_image)
+        stroke = Stroke(self.current_image, brush, mode, offset)
+        # Same pixels, new buffer: the layer composite is still up to date
+        self.layers.imageChanged(self.current_image, QRect())
+        if shown and pixmap is None:
+            # Shares the pixels the stroke writes to, so dabs show up without an upload
+            self.image_item.setPixmap(image_to_pixmap(self.current_image))
+        elif shown:
+            self.image_item.setPixmap(pixmap)
+        return stroke
+
+    def updateStroke(self, rect):
+        """Show the part of the image a stroke changed."""
+        if rect.isEmpty():
+            return
+        pixmap = self.image_item.pixmap()
+        if not pixmap_shares_pixels(self.current_image) and not pixmap.isNull():
+            # A converted copy: convert and upload just the changed rectangle
+            self.image_item.setPixmap(QPixmap())
+            draw_to_pixmap(pixmap, self.current_image, rect)
+            self.image_item.setPixmap(pixmap)
+        if self.pasted_items:
+            self.layers.imageChanged(self.current_image, rect)
+            self.showLayers()
+        self.scene.update(QRectF(rect))
+
+    def endStroke(self, stroke):
+        """Record a finished stroke as one undo step holding the pixels it changed."""
+        if stroke.dirty.isEmpty():
+            return
+        from commands import StrokeCommand
+        command = StrokeCommand(self, stroke.brush, stroke.mode, stroke.points, stroke.offset, stroke.dirty,
+                                stroke.before(), self.current_image.copy(stroke.dirty))
+        self.undo_stack.append(command)
+        self.redo_stack.clear()
+        self.is_modified = True
+        self.updateRegionStatistics()
+
+    def visibleImageRect(self):
+        """Return the part of the image shown in the viewport, in image pixels."""
+        visible = self.mapToScene(self.viewport().rect()).boundingRect().toAlignedRect()
+        return visible.intersected(self.current_image.rect())
+
+    def preview_filter(self, name, radius, amount=0, threshold=0):
+        """Show a filter on a viewport-sized proxy of the visible part of the image."""
+        # The radius shrinks with the view
+        self.preview_visible(lambda region, scale: filter_image(region, name, radius * scale, amount, threshold))
+
+    def preview_curves(self, curves):
+        """Show curves (a Curves) on a viewport-sized proxy of the visible part of the image."""
+        self.preview_visible(lambda region, scale: curve_image(region, curves))
+
+    def preview_grade(self, grade):
+        """Show grade (a ColorGrade) on a viewport-sized proxy of the visible part of the image."""
+        lut = grade.lut()
+
+        def process(region, scale):
+            # The proxy's colours are indexed once; each change only maps them
+            if self.grade_index is None or not self.grade_index.matches(region):
+                self.grade_index = ColourIndex(region)
+            return self.grade_index.map(lut)
+        self.preview_visible(process)
+
+    def preview_visible(self, process):
+        """Lay process(proxy, scale) over the image, for a viewport-sized proxy of its visible part.
+
+        The image stays untouched until the change is applied; the proxy is
+        reused while the view and the image don't change.
+        """
+        if not self.current_image or not self.image_item:
+            return
+        visible = self.visibleImageRect()
+        selection = self.selectionRect()
+        if selection is not None:
+            visible = visible.intersected(selection)
+        if visible.isEmpty():
+            return
+        # One proxy pixel per screen pixel
+        scale = min(1.0, self.transform().m11())
+        if scale > PROXY_MAX_SCALE:
+            scale = 1.0
+        width, height = max(1, round(visible.width() * scale)), max(1, round(visible.height() * scale))
+        key = (self.current_image.cacheKey(), visible, width, height)
+        if self.filter_preview_source is None or self.filter_preview_source[0] != key:
+            region = self.current_image if visible == self.current_image.rect() else self.current_image.copy(visible)
+            if (width, height) != (region.width(), region.height()):
+                region = resize_image(region, width, height)
+            self.filter_preview_source = (key, region)
+        region = self.filter_preview_source[1]
+        scale = width / visible.width()
+        preview = process(region, scale)
+        mask = self.selectionMask()
+        if mask is not None:
+            # Let the image show through outside the selection
+            shown = QRect(round(visible.x() * scale), round(visible.y() * scale), preview.width(), preview.height())
+            preview = clear_outside(preview, mask.array(shown, scale))
+        if self.filter_preview_item is not None:
+            # The last preview's pixmap goes before the next one is uploaded
+            self.filter_preview_item.setPixmap(QPixmap())
+        else:
+            self.filter_preview_item = QGraphicsPixmapItem()
+            self.filter_preview_item.setTransformationMode(Qt.SmoothTransformation)
+            # Above the image, below pasted items and the selection
+            self.filter_preview_item.setZValue(50)
+            self.scene.addItem(self.filter_preview_item)
+        self.filter_preview_item.setPixmap(image_to_pixmap(preview))
+        self.filter_preview_item.setScale(1 / scale)
+        self.filter_preview_item.setPos(visible.topLeft())
+        self.viewport().update()
+
+    def cancel_filter_preview(self):
+        self.filter_preview_source = None
+        self.grade_index = None
+        if self.filter_preview_item is not None:
+            self.scene.removeItem(self.filter_preview_item)
+            self.filter_preview_item = None
+            self.viewport().update()
+
+    def apply_filter(self, name, radius, amount=0, threshold=0):
+        if not self.current_image: return
+        from commands import FilterCommand
+        command = FilterCommand(self, name, radius, amount, threshold, region=self.selectionRect(),
+                                mask=self.selectionMask())
+
+        # The preview stays on screen until the filtered image replaces it
+        def finished(result):
+            self.cancel_filter_preview()
+            self.executeCommand(command)
+        self.runJob(f"Applying {FILTERS[name][0]}", command.prepare, finished, self.cancel_filter_preview)
+
+    def apply_curves(self, curves):
+        if not self.current_image: return
+        from commands import CurvesCommand
+        command = CurvesCommand(self, curves, region=self.selectionRect(), mask=self.selectionMask())
+
+        def finished(result):
+            self.cancel_filter_preview()
+            self.executeCommand(command)
+        self.runJob("Applying curves", command.prepare, finished, self.cancel_filter_preview)
+
+    def apply_grade(self, grade):
+        if not self.current_image: return
+        from commands import ColorGradeCommand
+        command = ColorGradeCommand(self, grade, region=self.selectionRect(), mask=self.selectionMask())
+
+        def finished(result):
+            self.cancel_filter_preview()
+            self.executeCommand(command)
+        self.runJob("Applying color grade", command.prepare, finished, self.cancel_filter_preview)
+
+    def channelHistograms(self, on_ready):
+        """Pass the ChannelHistograms of the selection (or the image) to on_ready once they're counted.
+
+        They are cached until the image or the selection changes; large
+        images are sampled on a worker thread, and on_ready is called from
+        the GUI thread when it's done.
+        """
+        image, rect = self.current_image, self.selectionRect()
+        if not image:
+            return
+        if self.histograms is not None and self.histograms.matches(image, rect):
+            on_ready(self.histograms)
+            return
+        job = self.histograms_job
+        if job is None or job.key != (image.cacheKey(), rect):
+            if job is not None:
+                job.cancel()
+            if not self.runsInBackground():
+                self.histograms_job = None
+                self.histograms = ChannelHistograms(image, rect)
+                on_ready(self.histograms)
+                return
+            job = Job("Histogram", lambda token, progress: ChannelHistograms(image, rect, token))
+            job.key = (image.cacheKey(), rect)
+            job.signals.finished.connect(lambda histograms: self.finishHistograms(job, histograms))
+            job.signals.cancelled.connect(lambda: self.finishHistograms(job, None))
+            job.signals.failed.connect(lambda error: self.finishHistograms(job, None))
+            self.histograms_job = job
+            job.start()
+        # Connected after the cache update; Qt drops the connection if on_ready's widget goes away first
+        job.signals.finished.connect(on_ready)
+
+    def finishHistograms(self, job, histograms):
+        if job is not self.histograms_job:
+            return
+        self.histograms_job = None
+        if histograms is not None:
+            self.histograms = histograms
 
     def updateWindowTitle(self):
         from widgets import CustomMdiSubWindow
@@ -0,0 +1,110 @@
+import math
+import numpy as np
+from PyQt5.QtGui import QImage
+from imaging import CV2_AVAILABLE, image_array, working_format, convert_image, restore_format, is_palette
+from jobs import run_bands, BAND_ROWS
+from tracing import span
+
+if CV2_AVAILABLE:
+    import cv2
+
+# Filters in menu order: name -> (menu label, what amount means with its slider range and default,
+# largest radius in pixels). The bilateral filter's cost grows with the square of its radius.
+FILTERS = {
+    "gaussian_blur": ("Gaussian Blur", None, 100),
+    "box_blur": ("Box Blur", None, 100),
+    "unsharp_mask": ("Unsharp Mask", ("Amount (%)", 0, 500, 100), 100),
+    "median": ("Median Denoise", None, 100),
+    "bilateral": ("Bilateral Denoise", ("Strength", 1, 150, 30), 10),
+}
+
+
+def filter_halo(name, radius):
+    """Return how many rows beyond its own a tile of the filter reads."""
+    if name in ("gaussian_blur", "unsharp_mask"):
+        # OpenCV's 8-bit Gaussian kernel spans 3 sigma each way
+        return math.ceil(3 * max(radius, 0.1)) + 1
+    return max(1, round(radius))
+
+
+def _gaussian(pixels, radius):
+    return cv2.GaussianBlur(pixels, (0, 0), sigmaX=max(radius, 0.1))
+
+
+def _filter_tile(pixels, name, radius, amount, threshold):
+    """Apply the filter to one tile of pixels and return the result."""
+    size = 2 * max(1, round(radius)) + 1
+    if name == "gaussian_blur":
+        return _gaussian(pixels, radius)
+    if name == "box_blur":
+        return cv2.blur(pixels, (size, size))
+    if name == "median":
+        return cv2.medianBlur(pixels, size)
+    if name == "bilateral":
+        # Only 1- and 3-channel images are supported, so alpha is carried over
+        colour = pixels if pixels.ndim == 2 else np.ascontiguousarray(pixels[:, :, :3])
+        filtered = cv2.bilateralFilter(colour, size, amount, radius)
+        if pixels.ndim == 2:
+            return filtered
+        result = pixels.copy()
+        result[:, :, :3] = filtered
+        return result
+    if name == "unsharp_mask":
+        factor = amount / 100
+        blurred = _gaussian(pixels, radius)
+        if threshold <= 0:
+            result = cv2.addWeighted(pixels, 1 + factor, blurred, -factor, 0)
+        else:
+            # Leave differences below the threshold alone, so flat areas don't get noisier
+            detail = pixels.astype(np.int16) - blurred
+            detail[np.abs(detail) < threshold] = 0
+            result = np.clip(pixels + detail * factor, 0, 255).astype(np.uint8)
+        if pixels.ndim == 3:
+            result[:, :, 3] = pixels[:, :, 3]
+        return result
+    raise ValueError(f"Unknown filter: {name}")
+
+
+def filter_pixels(pixels, out, name, radius, amount=0, threshold=0, token=None, progress=None):
+    """Filter a (h, w) or (h, w, c) uint8 array into out, in overlapping bands of rows.
+
+    Each band reads the rows around it that the kernel needs, so the result
+    matches filtering the whole array at once.
+    """
+    height = pixels.shape[0]
+    halo = filter_halo(name, radius)
+    premultiplied = pixels.ndim == 3 and name in ("unsharp_mask", "bilateral")
+
+    def filter_band(y0, y1):
+        top = max(0, y0 - halo)
+        bottom = min(height, y1 + halo)
+        filtered = _filter_tile(pixels[top:bottom], name, radius, amount, threshold)[y0 - top:y1 - top]
+        if premultiplied:
+            # Sharpening can push colour above alpha, which premultiplied pixels can't have
+            np.minimum(filtered[:, :, :3], filtered[:, :, 3:], out=filtered[:, :, :3])
+        out[y0:y1] = filtered.reshape(out[y0:y1].shape)
+    # Bands well above the halo, so overlapping rows stay a small share of the work
+    run_bands(filter_band, height, token, progress, band_rows=max(BAND_ROWS, 8 * halo))
+    return out
+
+
+def filter_image(image, name, radius, amount=0, threshold=0, token=None, progress=None):
+    """Return image with a filter of FILTERS applied; radius is in pixels.
+
+    amount is the unsharp mask strength in percent or the bilateral colour
+    sigma; threshold is the smallest difference the unsharp mask sharpens.
+    """
+    if name not in FILTERS:
+        raise ValueError(f"Unknown filter: {name}")
+    if not CV2_AVAILABLE:
+        raise RuntimeError("OpenCV (cv2) is required for filters")
+    with span(name, "filter", radius=radius, width=image.width(), height=image.height()):
+        if is_palette(image):
+            source_format = QImage.Format_ARGB32_Premultiplied if image.hasAlphaChannel() else QImage.Format_RGB32
+        else:
+            source_format = working_format(image)
+        source = convert_image(image, source_format, "filter")
+        result = QImage(source.size(), source.format())
+        filter_pixels(image_array(source), image_array(result, writable=True), name, radius, amount, threshold,
+                      token, progress)
+        return restore_format(result, image)
@@ -0,0 +1,130 @@
+import atexit
+import functools
+import os
+import time
+from collections import deque
+import numpy as np
+
+# Set PHOTOED_FRAME_STATS=1 to collect frame statistics and print them on exit
+FRAME_STATS_ENV = "PHOTOED_FRAME_STATS"
+
+# Most recent samples kept per histogram
+MAX_SAMPLES = 10000
+
+# Histogram of the time from an input event to the end of the next viewport paint
+INPUT_TO_PAINT = "input_to_paint"
+
+_enabled = False
+_pending_input = None
+histograms = {}
+
+
+class LatencyHistogram:
+    """The most recent durations of one measurement, in seconds."""
+
+    def __init__(self, max_samples=MAX_SAMPLES):
+        self.samples = deque(maxlen=max_samples)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+
+    def percentiles(self, points=(50, 95, 99)):
+        """Return {"p50": ms, ...} plus the maximum; empty if there are no samples."""
+        if not self.samples:
+            return {}
+        values = np.percentile(np.fromiter(self.samples, dtype=np.float64), points) * 1000
+        result = {f"p{point}": float(value) for point, value in zip(points, values)}
+        result["max"] = max(self.samples) * 1000
+        return result
+
+
+def is_enabled():
+    return _enabled
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled, _pending_input
+    _enabled = False
+    _pending_input = None
+
+
+def reset():
+    global _pending_input
+    histograms.clear()
+    _pending_input = None
+
+
+def record(name, seconds):
+    histogram = histograms.get(name)
+    if histogram is None:
+        histogram = histograms[name] = LatencyHistogram()
+    histogram.add(seconds)
+
+
+def input_received(timestamp=None):
+    """Note an input event; the next frame_presented() records its latency.
+
+    Only the oldest input since the last paint counts, which is the one the user waited longest for.
+    """
+    global _pending_input
+    if _enabled and _pending_input is None:
+        _pending_input = time.perf_counter() if timestamp is None else timestamp
+
+
+def frame_presented():
+    global _pending_input
+    if _pending_input is not None:
+        record(INPUT_TO_PAINT, time.perf_counter() - _pending_input)
+        _pending_input = None
+
+
+def timed(name, input_event=False, presents_frame=False):
+    """Decorator that records the duration of every call of an event handler.
+
+    input_event marks the start of the call as user input; presents_frame
+    closes the input-to-paint latency when the call returns.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            if input_event:
+                input_received(start)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+                if presents_frame:
+                    frame_presented()
+        return wrapper
+    return decorator
+
+
+def summary():
+    """Return one line per histogram with its sample count and percentiles."""
+    lines = []
+    for name, histogram in sorted(histograms.items()):
+        stats = histogram.percentiles()
+        if stats:
+            lines.append(f"{name:<32} n={len(histogram):<6} p50={stats['p50']:7.2f} ms  p95={stats['p95']:7.2f} ms  "
+                         f"p99={stats['p99']:7.2f} ms  max={stats['max']:7.2f} ms")
+    return "\n".join(lines)
+
+
+def enable_from_environment():
+    """Enable frame statistics if PHOTOED_FRAME_STATS is set, and print them on exit."""
+    if not os.environ.get(FRAME_STATS_ENV):
+        return False
+    enable()
+    atexit.register(lambda: print(summary()))
+    return True
@@ -0,0 +1,429 @@
+import numpy as np
+from PyQt5.QtGui import QImage, qRgba, qAlpha
+from imaging import image_array, convert_image, working_format, is_compact, is_palette, map_channels, LUMA_WEIGHTS
+from jobs import run_bands
+
+# Points per axis of the 3D LUT colour grading is compiled into; a 33-point
+# grid is what grading tools exchange and keeps interpolation errors below one level
+LUT_SIZE = 33
+
+# Largest .cube grid accepted (a 256-point one would take 800 MB)
+MAX_CUBE_SIZE = 129
+
+# Settings of a ColorGrade: (label, minimum, maximum), in the order they are applied
+SETTINGS = {
+    "temperature": ("Temperature", -100, 100),
+    "tint": ("Tint", -100, 100),
+    "hue": ("Hue", -180, 180),
+    "saturation": ("Saturation", -100, 100),
+    "vibrance": ("Vibrance", -100, 100),
+}
+
+# Distinct colours interpolated per band; each takes ~150 bytes of temporaries
+COLOUR_BAND = 16384
+
+# Pixels per band whose distinct colours are found on their own
+PIXEL_BAND = 65536
+
+# Images with at least this many pixels are mapped through tables indexed by
+# the 24-bit colour (80 MB, under two of their frames); smaller ones map the
+# distinct colours of each band of rows on their own
+DENSE_TABLE_MIN_PIXELS = 12000000
+
+# How far temperature and tint at +-100 scale the red/blue and green gains
+WHITE_BALANCE_RANGE = 0.3
+
+
+class ColorLut:
+    """A 3D colour lookup table: table[r, g, b] is the RGB output (0..1) for the grid point r, g, b.
+
+    Inputs are mapped from domain_min..domain_max onto the grid, as .cube
+    files define it, and interpolated tetrahedrally between grid points.
+    """
+
+    def __init__(self, table, title="", domain_min=(0.0, 0.0, 0.0), domain_max=(1.0, 1.0, 1.0)):
+        self.table = np.asarray(table, dtype=np.float32)
+        self.title = title
+        self.domain_min = np.array(domain_min, dtype=np.float32)
+        self.domain_max = np.array(domain_max, dtype=np.float32)
+
+    @property
+    def size(self):
+        return self.table.shape[0]
+
+    def lookup(self, rgb):
+        """Return the outputs for rgb, a float array of (..., 3) colours."""
+        rgb = np.asarray(rgb, dtype=np.float32)
+        span = np.maximum(self.domain_max - self.domain_min, 1e-6)
+        position = np.clip((rgb - self.domain_min) / span, 0, 1) * (self.size - 1)
+        index = np.minimum(position.astype(np.int32), self.size - 2)
+        fraction = position - index
+        base = (index[..., 0] * self.size + index[..., 1]) * self.size + index[..., 2]
+        return _tetrahedral(self.table, base, *(fraction[..., axis] for axis in range(3)))
+
+
+def identity_table(size=LUT_SIZE):
+    """Return the (size, size, size, 3) grid of a LUT that leaves colours unchanged."""
+    axis = np.linspace(0, 1, size, dtype=np.float32)
+    return np.stack(np.meshgrid(axis, axis, axis, indexing="ij"), axis=-1)
+
+
+def _tetrahedral(table, base, fr, fg, fb):
+    """Interpolate table (a 3D LUT) at flat grid cells base with fractions fr, fg, fb; return the (..., 3) outputs.
+
+    The cell is split into six tetrahedra along its diagonal; the one
+    holding the point is picked by the order of the fractions, so only four
+    corners are read instead of trilinear's eight, and neutral inputs stay
+    on the neutral axis.
+    """
+    size = table.shape[0]
+    strides = size * size, size, 1
+    largest = np.maximum(np.maximum(fr, fg), fb)
+    smallest = np.minimum(np.minimum(fr, fg), fb)
+    middle = fr + fg + fb - largest - smallest
+    weights = 1 - largest, largest - middle, middle - smallest, smallest
+    order = (fr >= fg).view(np.uint8) << 2 | (fg >= fb).view(np.uint8) << 1 | (fr >= fb).view(np.uint8)
+    first, second = _corner_offsets(strides)
+    corners = base, base + first[order], base + second[order], base + sum(strides)
+    result = []
+    for channel in range(3):
+        plane = np.ascontiguousarray(table[..., channel]).ravel()
+        values = plane[corners[0]] * weights[0]
+        for corner, weight in zip(corners[1:], weights[1:]):
+            values += plane[corner] * weight
+        result.append(values)
+    return np.stack(result, axis=-1)
+
+
+def _corner_offsets(strides):
+    """Return the flat offsets of the second and third corners of each tetrahedron.
+
+    They are indexed by (fr >= fg) << 2 | (fg >= fb) << 1 | (fr >= fb): the
+    path from the cell's origin steps along the axis of the largest fraction
+    first, then along the middle one's.
+    """
+    first, second = np.zeros(8, dtype=np.int32), np.zeros(8, dtype=np.int32)
+    for order in range(8):
+        r_over_g, g_over_b, r_over_b = order >> 2 & 1, order >> 1 & 1, order & 1
+        if r_over_g and r_over_b:
+            axes = (0, 1) if g_over_b else (0, 2)
+        elif g_over_b and not r_over_g:
+            axes = (1, 0) if r_over_b else (1, 2)
+        else:
+            axes = (2, 0) if r_over_g else (2, 1)
+        first[order] = strides[axes[0]]
+        second[order] = strides[axes[0]] + strides[axes[1]]
+    return first, second
+
+
+def load_cube(path):
+    """Read a .cube file (Adobe/Resolve format) into a ColorLut.
+
+    1D LUTs are expanded into a 3D grid. Raises ValueError if the file
+    isn't a valid .cube LUT.
+    """
+    title, size_3d, size_1d = "", None, None
+    domain_min, domain_max = [0.0] * 3, [1.0] * 3
+    values = []
+    with open(path, encoding="utf-8", errors="replace") as file:
+        for number, line in enumerate(file, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            keyword, _, rest = line.partition(" ")
+            try:
+                if keyword == "TITLE":
+                    title = rest.strip().strip('"')
+                elif keyword == "LUT_3D_SIZE":
+                    size_3d = int(rest)
+                elif keyword == "LUT_1D_SIZE":
+                    size_1d = int(rest)
+                elif keyword == "DOMAIN_MIN":
+                    domain_min = [float(value) for value in rest.split()]
+                elif keyword == "DOMAIN_MAX":
+                    domain_max = [float(value) for value in rest.split()]
+                elif keyword in ("LUT_3D_INPUT_RANGE", "LUT_1D_INPUT_RANGE"):
+                    low, high = (float(value) for value in rest.split())
+                    domain_min, domain_max = [low] * 3, [high] * 3
+                elif keyword[0].isalpha():
+                    # Other keywords (LUT_IN_VIDEO_RANGE, ...) don't change the mapping
+                    continue
+                else:
+                    values.append(line)
+            except ValueError:
+                raise ValueError(f"Line {number}: can't read '{line}'") from None
+    if (size_3d is None) == (size_1d is None):
+        raise ValueError("Expected exactly one of LUT_3D_SIZE and LUT_1D_SIZE")
+    size = size_3d or size_1d
+    if not 2 <= size <= (MAX_CUBE_SIZE if size_3d else 65536):
+        raise ValueError(f"Unsupported LUT size {size}")
+    if len(domain_min) != 3 or len(domain_max) != 3:
+        raise ValueError("DOMAIN_MIN and DOMAIN_MAX need three values")
+    try:
+        data = np.array(" ".join(values).split(), dtype=np.float32).reshape(-1, 3)
+    except ValueError:
+        raise ValueError("The table rows must have three numbers") from None
+    expected = size ** 3 if size_3d else size
+    if len(data) != expected:
+        raise ValueError(f"Expected {expected} table rows, found {len(data)}")
+    if size_3d:
+        # Red changes fastest in the file
+        table = data.reshape(size, size, size, 3).transpose(2, 1, 0, 3)
+        return ColorLut(table, title, domain_min, domain_max)
+    # Each channel has its own curve; sample them on a LUT_SIZE grid
+    axis = np.linspace(0, 1, LUT_SIZE, dtype=np.float32)
+    curves = [np.interp(axis, np.linspace(0, 1, size), data[:, channel]) for channel in range(3)]
+    table = np.stack(np.meshgrid(*curves, indexing="ij"), axis=-1)
+    return ColorLut(table, title, domain_min, domain_max)
+
+
+def _luma(rgb):
+    return rgb @ np.array(LUMA_WEIGHTS, dtype=rgb.dtype)
+
+
+def _white_balance(rgb, temperature, tint):
+    """Warm (temperature > 0) or cool the colours and push them to magenta (tint > 0) or green."""
+    gains = np.array([1 + WHITE_BALANCE_RANGE * temperature / 100, 1 - WHITE_BALANCE_RANGE * tint / 100,
+                      1 - WHITE_BALANCE_RANGE * temperature / 100])
+    # Keep the brightness of neutral colours
+    gains /= gains @ np.array(LUMA_WEIGHTS)
+    return rgb * gains.astype(rgb.dtype)
+
+
+def _rotate_hue(rgb, degrees):
+    """Turn the hue of every colour by degrees, keeping its HSV saturation and value."""
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    high = np.maximum(np.maximum(r, g), b)
+    low = np.minimum(np.minimum(r, g), b)
+    chroma = high - low
+    safe = np.where(chroma > 0, chroma, 1)
+    hue = np.where(high == r, ((g - b) / safe) % 6, np.where(high == g, (b - r) / safe + 2, (r - g) / safe + 4))
+    hue = (hue + degrees / 60) % 6
+    x = chroma * (1 - np.abs(hue % 2 - 1))
+    sector = hue.astype(np.int32)
+    zero = np.zeros_like(chroma)
+    red = np.choose(sector, [chroma, x, zero, zero, x, chroma], mode="clip")
+    green = np.choose(sector, [x, chroma, chroma, x, zero, zero], mode="clip")
+    blue = np.choose(sector, [zero, zero, x, chroma, chroma, x], mode="clip")
+    return np.stack([red, green, blue], axis=-1) + low[..., None]
+
+
+def _saturate(rgb, factor):
+    """Scale the distance of every colour from its gray by factor (an array broadcasting over the colours)."""
+    luma = _luma(rgb)[..., None]
+    return luma + (rgb - luma) * factor
+
+
+class ColorGrade:
+    """A chain of colour operations, compiled into one 3D LUT.
+
+    White balance comes first, then hue, saturation and vibrance, and the
+    imported .cube LUT last, mixed in by cube_amount. Settings other than
+    hue (in degrees) range from -100 to 100.
+    """
+
+    def __init__(self, temperature=0, tint=0, hue=0, saturation=0, vibrance=0, cube=None, cube_amount=1.0):
+        self.temperature = temperature
+        self.tint = tint
+        self.hue = hue
+        self.saturation = saturation
+        self.vibrance = vibrance
+        self.cube = cube
+        self.cube_amount = cube_amount
+
+    def copy(self):
+        # The cube is never changed, only replaced
+        return ColorGrade(self.temperature, self.tint, self.hue, self.saturation, self.vibrance, self.cube,
+                          self.cube_amount)
+
+    def isIdentity(self):
+        return ((self.temperature, self.tint, self.hue, self.saturation, self.vibrance) == (0, 0, 0, 0, 0)
+                and (self.cube is None or self.cube_amount == 0))
+
+    def map(self, rgb):
+        """Return rgb (a float32 array of (..., 3) colours, 0..1) with the grade applied, clipped to 0..1."""
+        if self.temperature or self.tint:
+            rgb = np.clip(_white_balance(rgb, self.temperature, self.tint), 0, 1)
+        if self.hue:
+            rgb = _rotate_hue(rgb, self.hue)
+        if self.saturation:
+            rgb = np.clip(_saturate(rgb, 1 + self.saturation / 100), 0, 1)
+        if self.vibrance:
+            # Scaled down as colours get more saturated, so those already vivid don't clip
+            chroma = rgb.max(axis=-1, keepdims=True) - rgb.min(axis=-1, keepdims=True)
+            rgb = np.clip(_saturate(rgb, 1 + self.vibrance / 100 * (1 - chroma)), 0, 1)
+        if self.cube is not None and self.cube_amount:
+            rgb = rgb + (np.clip(self.cube.lookup(rgb), 0, 1) - rgb) * self.cube_amount
+        return rgb.astype(np.float32)
+
+    def lut(self, size=LUT_SIZE):
+        """Compile the chain into a size-point ColorLut."""
+        return ColorLut(self.map(identity_table(size)))
+
+
+def _map_colours(lut, colours):
+    """Return colours (packed 0xRRGGBB uint32) mapped through lut, packed the same way."""
+    size = lut.size
+    # The grid cell and the position in it of every 8-bit level, the same for each axis
+    position = np.arange(256, dtype=np.float32) * (size - 1) / 255
+    cells = np.minimum(position.astype(np.int32), size - 2)
+    fractions = position - cells
+    r, g, b = (colours >> 16) & 0xFF, (colours >> 8) & 0xFF, colours & 0xFF
+    base = (cells[r] * size + cells[g]) * size + cells[b]
+    mapped = np.rint(np.clip(_tetrahedral(lut.table, base, fractions[r], fractions[g], fractions[b]), 0, 1) * 255)
+    mapped = mapped.astype(np.uint32)
+    return mapped[:, 0] << 16 | mapped[:, 1] << 8 | mapped[:, 2]
+
+
+def _map_distinct(lut, colours, token=None, progress=None, parallel=True):
+    """Return colours (packed, as for _map_colours()) mapped through lut, COLOUR_BAND at a time."""
+    mapped = np.empty(len(colours), dtype=np.uint32)
+
+    def map_colours(i0, i1):
+        mapped[i0:i1] = _map_colours(lut, colours[i0:i1])
+
+    run_bands(map_colours, len(colours), token, progress, COLOUR_BAND, parallel)
+    return mapped
+
+
+def _unit_domain(lut):
+    """Return lut over the domain 0..1, the one 8-bit levels are scaled to."""
+    if not lut.domain_min.any() and (lut.domain_max == 1).all():
+        return lut
+    # Resampled once, rather than rescaling every colour looked up
+    return ColorLut(lut.lookup(identity_table(lut.size)))
+
+
+def _straight_pixels(image):
+    """Return image in a 32-bit format with straight (not premultiplied) alpha and its pixels as 0xAARRGGBB words."""
+    image = convert_image(image, QImage.Format_ARGB32 if image.hasAlphaChannel() else QImage.Format_RGB32, "grade")
+    return image, image_array(image).view(np.uint32)[..., 0]
+
+
+def _distinct_colours(pixels, token=None):
+    """Return the distinct 24-bit colours of pixels (0xAARRGGBB words) as a sorted uint32 array."""
+    present = np.zeros(1 << 24, dtype=bool)
+
+    def find_colours(y0, y1):
+        present[pixels[y0:y1] & 0xFFFFFF] = True
+
+    run_bands(find_colours, pixels.shape[0], token)
+    return np.flatnonzero(present).astype(np.uint32)
+
+
+def apply_lut(image, lut, token=None, progress=None):
+    """Return a copy of image with its colours mapped through lut (a ColorLut), band by band in parallel.
+
+    The format is preserved: grayscale images take the luma of the mapped
+    grays and palette images only have their colour table changed. token (a
+    jobs.CancelToken) is checked and progress called between bands.
+    """
+    lut = _unit_domain(lut)
+    if is_palette(image):
+        table = np.array(image.colorTable(), dtype=np.uint32)
+        colours = np.stack([(table >> shift) & 0xFF for shift in (16, 8, 0)], axis=-1).astype(np.float32) / 255
+        mapped = np.rint(np.clip(lut.lookup(colours), 0, 1) * 255).astype(np.uint32)
+        result = image.copy()
+        result.setColorTable([qRgba(int(r), int(g), int(b), qAlpha(int(c))) for (r, g, b), c in zip(mapped, table)])
+        return result
+    if image.format() == QImage.Format_Grayscale8:
+        grays = np.repeat(np.linspace(0, 1, 256, dtype=np.float32)[:, None], 3, axis=1)
+        luma = np.rint(np.clip(_luma(lut.lookup(grays)), 0, 1) * 255).astype(np.uint8)
+        return map_channels(image, luma, luma, luma, token=token, progress=progress)
+    result_format = working_format(image)
+    image, pixels = _straight_pixels(image)
+    result = QImage(image.width(), image.height(), image.format())
+    out = image_array(result, writable=True).view(np.uint32)[..., 0]
+    # Photos hold far fewer distinct colours than pixels, so only those are interpolated
+    if pixels.size < DENSE_TABLE_MIN_PIXELS:
+        def map_band(y0, y1):
+            band = pixels[y0:y1]
+            colours, inverse = np.unique(band & 0xFFFFFF, return_inverse=True)
+            # Already on a worker, so the colours are mapped on this thread
+            mapped = _map_distinct(lut, colours, parallel=False)
+            out[y0:y1] = mapped[inverse].reshape(band.shape) | (band & 0xFF000000)
+
+        run_bands(map_band, image.height(), token, progress, max(1, PIXEL_BAND // image.width()))
+        return convert_image(result, result_format, "grade")
+    # Large images share one interpolation of all their colours through a
+    # table indexed by the 24-bit colour, which the pixels are looked up in
+    colours = _distinct_colours(pixels, token)
+    table = np.empty(1 << 24, dtype=np.uint32)
+
+    def map_colours(i0, i1):
+        table[colours[i0:i1]] = _map_colours(lut, colours[i0:i1])
+
+    def map_pixels(y0, y1):
+        out[y0:y1] = table[pixels[y0:y1] & 0xFFFFFF] | (pixels[y0:y1] & 0xFF000000)
+
+    run_bands(map_colours, len(colours), token, progress and (lambda done: progress(done / 2)), COLOUR_BAND)
+    run_bands(map_pixels, image.height(), token, progress and (lambda done: progress(0.5 + done / 2)))
+    return convert_image(result, result_format, "grade")
+
+
+class ColourIndex:
+    """The distinct colours of an image and which of them each pixel has.
+
+    Built once for a preview proxy, so mapping it through each new LUT only
+    interpolates its colours and gathers them back. Palette and grayscale
+    images aren't indexed; map() hands them to apply_lut().
+    """
+
+    def __init__(self, image):
+        self.key = image.cacheKey()
+        self.image = image
+        self.colours = None
+        if is_compact(image):
+            return
+        self.result_format = working_format(image)
+        straight, pixels = _straight_pixels(image)
+        self.format = straight.format()
+        # Each band's pixels are indexed into its own colours, then renumbered into all of them
+        self.indices = np.empty(pixels.shape, dtype=np.int32)
+        bands = {}
+
+        def index_band(y0, y1):
+            bands[y0], inverse = np.unique(pixels[y0:y1] & 0xFFFFFF, return_inverse=True)
+            self.indices[y0:y1] = inverse.reshape(y1 - y0, -1)
+
+        def renumber_band(y0, y1):
+            self.indices[y0:y1] = np.searchsorted(self.colours, bands[y0]).astype(np.int32)[self.indices[y0:y1]]
+
+        rows = max(1, PIXEL_BAND // pixels.shape[1])
+        run_bands(index_band, pixels.shape[0], band_rows=rows)
+        # Sorted in place and deduplicated by hand, as np.unique() would copy them all again
+        colours = np.concatenate(list(bands.values())) if bands else np.empty(0, dtype=np.uint32)
+        colours.sort()
+        first = np.empty(len(colours), dtype=bool)
+        first[:1] = True
+        np.not_equal(colours[1:], colours[:-1], out=first[1:])
+        self.colours = colours[first]
+        del colours, first
+        run_bands(renumber_band, pixels.shape[0], band_rows=rows)
+        # Opaque images have the same alpha everywhere
+        self.alpha = pixels & 0xFF000000 if straight.hasAlphaChannel() else 0xFF000000
+
+    def matches(self, image):
+        return self.key == image.cacheKey()
+
+    def map(self, lut):
+        """Return the image mapped through lut, as apply_lut() would."""
+        if self.colours is None:
+            return apply_lut(self.image, lut)
+        mapped = _map_distinct(_unit_domain(lut), self.colours)
+        height, width = self.indices.shape
+        result = QImage(width, height, self.format)
+        out = image_array(result, writable=True).view(np.uint32)[..., 0]
+
+        def gather_band(y0, y1):
+            # Banded, as take() copies the indices it is given to intp
+            np.take(mapped, self.indices[y0:y1], out=out[y0:y1], mode="clip")
+            out[y0:y1] |= self.alpha if np.isscalar(self.alpha) else self.alpha[y0:y1]
+
+        run_bands(gather_band, height)
+        return convert_image(result, self.result_format, "grade")
+
+
+def grade_image(image, grade, token=None, progress=None):
+    """Return a copy of image with grade (a ColorGrade) applied through its compiled 3D LUT."""
+    return apply_lut(image, grade.lut(), token, progress)
@@ -0,0 +1,331 @@
+from collections import Counter
+import numpy as np
+from PyQt5.QtGui import QImage, QPixmap, QPainter, qGray, qAlpha, qRgba
+from PyQt5.QtCore import Qt
+from tracing import span
+from jobs import run_bands
+
+try:
+    import cv2
+    CV2_AVAILABLE = True
+except ImportError:
+    CV2_AVAILABLE = False
+
+# Formats that store one byte or less per pixel; they are kept as-is through editing
+COMPACT_FORMATS = (QImage.Format_Grayscale8, QImage.Format_Indexed8, QImage.Format_Mono, QImage.Format_MonoLSB)
+PALETTE_FORMATS = (QImage.Format_Indexed8, QImage.Format_Mono, QImage.Format_MonoLSB)
+
+# Formats QPixmap and QPainter use natively on the raster backend; anything else
+# is converted behind our back when it is uploaded or painted on
+NATIVE_FORMATS = (QImage.Format_RGB32, QImage.Format_ARGB32_Premultiplied)
+
+# Full-frame format conversions performed so far, by reason (for profiling)
+conversion_counts = Counter()
+
+# Rec. 601 luma weights for R, G, B (as used by PIL's "L" conversion)
+LUMA_WEIGHTS = (0.299, 0.587, 0.114)
+
+
+def is_compact(image):
+    return image.format() in COMPACT_FORMATS
+
+
+def is_palette(image):
+    return image.format() in PALETTE_FORMATS
+
+
+def _rows(image, writable=False):
+    # constBits() doesn't detach an implicitly shared image, bits() does
+    ptr = image.bits() if writable else image.constBits()
+    ptr.setsize(image.sizeInBytes())
+    return np.frombuffer(ptr, np.uint8).reshape(image.height(), image.bytesPerLine())
+
+
+def working_format(image):
+    """Return the format a document image is kept in while it is being edited.
+
+    Compact formats stay as they are; colour images use the native raster
+    format, with premultiplied alpha when they have an alpha channel.
+    """
+    if is_compact(image):
+        return image.format()
+    if image.hasAlphaChannel():
+        return QImage.Format_ARGB32_Premultiplied
+    return QImage.Format_RGB32
+
+
+def convert_image(image, image_format, reason="convert"):
+    """Convert image to image_format, counting the conversion if one is needed."""
+    if image.format() == image_format:
+        return image
+    conversion_counts[reason] += 1
+    with span("convert", "convert", reason=reason, width=image.width(), height=image.height()):
+        return image.convertToFormat(image_format)
+
+
+def to_working_format(image, reason="load"):
+    return convert_image(image, working_format(image), reason)
+
+
+def image_to_pixmap(image):
+    """Create the display pixmap for image, counting the hidden conversion Qt makes for non-native formats.
+
+    With a monitor profile set (color_management.display) the pixmap holds
+    the image converted to it.
+    """
+    from color_management import display_image
+    image = display_image(image)
+    if image.format() not in NATIVE_FORMATS:
+        conversion_counts["display"] += 1
+    with span("pixmap upload", "display", width=image.width(), height=image.height()):
+        return QPixmap.fromImage(image)
+
+
+def pixmap_shares_pixels(image):
+    """Whether image_to_pixmap(image) shares image's pixels, so changes to them show without an upload."""
+    from color_management import display
+    return image.format() in NATIVE_FORMATS and not display.active()
+
+
+def draw_to_pixmap(pixmap, image, rect):
+    """Redraw rect of image into pixmap, one image_to_pixmap() made of it.
+
+    Only that rectangle is converted for the display and uploaded.
+    """
+    from color_management import display_image
+    region = display_image(image.copy(rect))
+    painter = QPainter(pixmap)
+    painter.setCompositionMode(QPainter.CompositionMode_Source)
+    painter.drawImage(rect.topLeft(), region)
+    painter.end()
+
+
+def conversion_stats():
+    """Return a copy of the conversion counters."""
+    return dict(conversion_counts)
+
+
+def reset_conversion_stats():
+    conversion_counts.clear()
+
+
+def image_array(image, writable=False):
+    """Return a NumPy view of the pixels of a QImage without copying.
+
+    8-bit images give a (height, width) array; 24/32-bit images give
+    (height, width, bytes_per_pixel) in memory order (BGRA for RGB32/ARGB32).
+    The view is read-only unless writable is set.
+    """
+    bytes_per_pixel = image.depth() // 8
+    if bytes_per_pixel == 0:
+        raise ValueError(f"Can't view a {image.depth()}-bit image as an array")
+    rows = _rows(image, writable)
+    pixels = rows[:, :image.width() * bytes_per_pixel]
+    if bytes_per_pixel == 1:
+        return pixels
+    return pixels.reshape(image.height(), image.width(), bytes_per_pixel)
+
+
+def array_to_image(array, image_format, color_table=None):
+    """Copy a uint8 array into a new QImage that owns its pixels."""
+    array = np.ascontiguousarray(array)
+    height, width = array.shape[:2]
+    image = QImage(array.data, width, height, array.strides[0], image_format).copy()
+    if color_table:
+        image.setColorTable(color_table)
+    return image
+
+
+def paste_region(target, rect, region):
+    """Copy the pixels of region into target at rect's top left corner, in place.
+
+    region is converted to target's format first. Palette targets aren't
+    supported: their pixels can't be addressed as an array of colours.
+    """
+    region = convert_image(region, target.format(), "region")
+    x, y = rect.x(), rect.y()
+    image_array(target, writable=True)[y:y + region.height(), x:x + region.width()] = image_array(region)
+
+
+def palette_counts(image):
+    """Return how many pixels use each colour table entry of a palette image."""
+    if image.format() == QImage.Format_Indexed8:
+        return np.bincount(image_array(image).ravel(), minlength=image.colorCount())
+    rows = _rows(image)
+    bitorder = 'little' if image.format() == QImage.Format_MonoLSB else 'big'
+    ones = int(np.unpackbits(rows, axis=1, bitorder=bitorder)[:, :image.width()].sum())
+    return np.array([image.width() * image.height() - ones, ones])
+
+
+def restore_format(image, source):
+    """Convert a processed image back to the compact format of source.
+
+    Qt promotes compact images to 32-bit for smooth transformations; this keeps
+    grayscale, indexed and mono documents compact. Transparent areas become white.
+    """
+    target = source.format()
+    if target not in COMPACT_FORMATS or image.format() == target:
+        return image
+    conversion_counts["compact"] += 1
+    if image.hasAlphaChannel():
+        flattened = QImage(image.size(), QImage.Format_RGB32)
+        flattened.fill(Qt.white)
+        painter = QPainter(flattened)
+        painter.drawImage(0, 0, image)
+        painter.end()
+        image = flattened
+    if target == QImage.Format_Grayscale8:
+        return image.convertToFormat(target)
+    return image.convertToFormat(target, source.colorTable(), Qt.ThresholdDither)
+
+
+def channel_histogram(pixels, channel=0):
+    """Return the 256-bin histogram of one channel of a 2D or 3D pixel array."""
+    if CV2_AVAILABLE:
+        return cv2.calcHist([np.ascontiguousarray(pixels)], [channel], None, [256], [0, 256]).ravel()
+    if pixels.ndim == 3:
+        pixels = pixels[:, :, channel]
+    counts = np.zeros(256, dtype=np.intp)
+
+    def count_band(y0, y1):
+        # bincount() widens what it counts to intp, so only a band at a time
+        counts[:] += np.bincount(pixels[y0:y1].ravel(), minlength=256)
+
+    run_bands(count_band, pixels.shape[0], parallel=False)
+    return counts
+
+
+def _find_bounds(hist, threshold):
+    """Return the levels where the cumulative histogram passes threshold from each end."""
+    low, high = 0, 255
+    above = np.nonzero(np.cumsum(hist) > threshold)[0]
+    if above.size:
+        low = int(above[0])
+    above = np.nonzero(np.cumsum(hist[::-1]) > threshold)[0]
+    if above.size:
+        high = 255 - int(above[0])
+    if low >= high:
+        high = low + 1 if low < 255 else 255
+        low = high - 1 if high > 0 else 0
+    return low, high
+
+
+def _blend(lut, base, factor):
+    """Blend a LUT towards a constant like PIL's ImageEnhance does."""
+    return np.clip(base + factor * (lut.astype(np.float32) - base), 0, 255).astype(np.uint8)
+
+
+def adjustment_luts(histograms, weights, brightness, contrast, gamma, autobalance=False):
+    """Compile autobalance, brightness, contrast and gamma into one 256-entry LUT per channel.
+
+    histograms are per-channel pixel counts and weights the luma weight of each
+    channel; the contrast pivot is derived from them, so the image isn't scanned again.
+    """
+    identity = np.arange(256, dtype=np.float32)
+    luts = [np.arange(256, dtype=np.uint8) for _ in histograms]
+    total = max(float(histograms[0].sum()), 1.0)
+    if autobalance:
+        threshold = total * 0.05
+        for i, hist in enumerate(histograms):
+            low, high = _find_bounds(hist, threshold)
+            luts[i] = np.clip((identity - low) * 255 / max(high - low, 1), 0, 255).astype(np.uint8)
+    if brightness != 0:
+        luts = [_blend(lut, 0, 1.0 + brightness) for lut in luts]
+    if contrast != 0:
+        means = [float((hist * lut).sum()) / total for hist, lut in zip(histograms, luts)]
+        mean = int(sum(w * m for w, m in zip(weights, means)) + 0.5)
+        luts = [_blend(lut, mean, 1.0 + contrast) for lut in luts]
+    if gamma != 1.0:
+        luts = [_blend(lut, 0, gamma) for lut in luts]
+    return luts
+
+
+def _apply_lut(pixels, lut, image_format, token=None, progress=None):
+    """Map pixels through lut into a new QImage, band by band in parallel."""
+    height, width = pixels.shape[:2]
+    result = QImage(width, height, image_format)
+    out = image_array(result, writable=True)
+
+    def apply_band(y0, y1):
+        if CV2_AVAILABLE:
+            out[y0:y1] = cv2.LUT(pixels[y0:y1], lut.reshape(256, 1, -1))
+        elif pixels.ndim == 2:
+            out[y0:y1] = lut[pixels[y0:y1]]
+        else:
+            for c in range(pixels.shape[2]):
+                out[y0:y1, :, c] = lut[:, c][pixels[y0:y1, :, c]]
+
+    run_bands(apply_band, height, token, progress)
+    return result
+
+
+def map_channels(image, red, green, blue, token=None, progress=None):
+    """Return a copy of image with its red, green and blue values mapped through 256-entry uint8 LUTs.
+
+    The format is preserved: grayscale images are mapped through the luma
+    weighted mix of the three LUTs and palette images only have their colour
+    table changed. token (a jobs.CancelToken) is checked and progress called between bands.
+    """
+    if is_palette(image):
+        table = np.array(image.colorTable(), dtype=np.uint32)
+        channels = [((table >> shift) & 0xFF).astype(np.uint8) for shift in (16, 8, 0)]
+        mapped = [lut[channel] for lut, channel in zip((red, green, blue), channels)]
+        result = image.copy()
+        result.setColorTable([qRgba(int(r), int(g), int(b), qAlpha(int(c))) for r, g, b, c in zip(*mapped, table)])
+        return result
+    if image.format() == QImage.Format_Grayscale8:
+        mix = sum(weight * lut.astype(np.float32) for weight, lut in zip(LUMA_WEIGHTS, (red, green, blue)))
+        lut = np.clip(np.round(mix), 0, 255).astype(np.uint8)
+        return _apply_lut(image_array(image), lut, QImage.Format_Grayscale8, token, progress)
+    result_format = working_format(image)
+    # LUTs apply to straight (not premultiplied) colour values
+    image = convert_image(image, QImage.Format_ARGB32 if image.hasAlphaChannel() else QImage.Format_RGB32, "adjust")
+    # Memory order is B, G, R, A
+    lut = np.stack([blue, green, red, np.arange(256, dtype=np.uint8)], axis=1)
+    adjusted = _apply_lut(image_array(image), lut, image.format(), token, progress)
+    return convert_image(adjusted, result_format, "adjust")
+
+
+def adjust_image(image, brightness, contrast, gamma, autobalance=False, token=None, progress=None):
+    """Return a copy of image with autobalance, brightness, contrast and gamma applied.
+
+    The format is preserved: grayscale images are adjusted in their single
+    channel and palette images only have their colour table changed.
+    token (a jobs.CancelToken) is checked and progress called between bands.
+    """
+    if is_palette(image):
+        table = np.array(image.colorTable(), dtype=np.uint32)
+        channels = [((table >> shift) & 0xFF).astype(np.uint8) for shift in (16, 8, 0)]
+        counts = palette_counts(image)[:len(table)]
+        histograms = [np.bincount(channel, weights=counts, minlength=256) for channel in channels]
+        return map_channels(image, *adjustment_luts(histograms, LUMA_WEIGHTS, brightness, contrast, gamma, autobalance))
+    if image.format() == QImage.Format_Grayscale8:
+        pixels = image_array(image)
+        lut = adjustment_luts([channel_histogram(pixels)], (1.0,), brightness, contrast, gamma, autobalance)[0]
+        return _apply_lut(pixels, lut, QImage.Format_Grayscale8, token, progress)
+    # Histograms of the straight colour values the LUTs apply to; map_channels() reuses the conversion
+    image = convert_image(image, QImage.Format_ARGB32 if image.hasAlphaChannel() else QImage.Format_RGB32, "adjust")
+    pixels = image_array(image)
+    # Memory order is B, G, R, A
+    histograms = [channel_histogram(pixels, index) for index in (2, 1, 0)]
+    luts = adjustment_luts(histograms, LUMA_WEIGHTS, brightness, contrast, gamma, autobalance)
+    return map_channels(image, *luts, token=token, progress=progress)
+
+
+def grayscale_image(image):
+    """Return a grayscale version of image in the most compact format available.
+
+    Palette images keep their indices and only get a gray colour table.
+    """
+    if is_palette(image):
+        result = image.copy()
+        result.setColorTable([qRgba(qGray(c), qGray(c), qGray(c), qAlpha(c)) for c in image.colorTable()])
+        return result
+    if image.format() == QImage.Format_Grayscale8:
+        return image.copy()
+    if not CV2_AVAILABLE:
+        return convert_image(image, QImage.Format_Grayscale8, "grayscale")
+    if image.format() not in (QImage.Format_RGB32, QImage.Format_ARGB32):
+        image = convert_image(image, QImage.Format_ARGB32, "grayscale")
+    gray = cv2.cvtColor(image_array(image), cv2.COLOR_BGRA2GRAY)
+    return array_to_image(gray, QImage.Format_Grayscale8)
@@ -0,0 +1,127 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, wait
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+from tracing import span, name_thread
+
+# Documents with at least this many pixels are edited on a worker thread
+BACKGROUND_MIN_PIXELS = 4000000
+
+# Rows per band for banded pixel processing
+BAND_ROWS = 256
+
+_band_executor = None
+
+
+class JobCancelled(Exception):
+    """Raised inside a job when its cancellation token has been triggered."""
+
+
+class CancelToken:
+    """Shared flag a running job checks between bands."""
+
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def check(self):
+        """Raise JobCancelled if cancellation was requested."""
+        if self.cancelled:
+            raise JobCancelled()
+
+
+def band_workers():
+    return os.cpu_count() or 1
+
+
+def _executor():
+    global _band_executor
+    if _band_executor is None:
+        _band_executor = ThreadPoolExecutor(max_workers=band_workers(), thread_name_prefix="band",
+                                            initializer=lambda: name_thread("band worker"))
+    return _band_executor
+
+
+def _run_band(function, y0, y1, token):
+    if token is not None:
+        token.check()
+    function(y0, y1)
+
+
+def run_bands(function, height, token=None, progress=None, band_rows=BAND_ROWS, parallel=True):
+    """Call function(y0, y1) for consecutive bands of rows covering height.
+
+    Bands run on a shared thread pool unless parallel is false, so function
+    must only write to its own rows (OpenCV and NumPy release the GIL while
+    they work). token is checked before each band and progress(fraction) is
+    called as bands complete; both are optional.
+    """
+    bands = [(y, min(y + band_rows, height)) for y in range(0, height, band_rows)]
+    if not parallel or len(bands) < 2 or band_workers() < 2:
+        for done, (y0, y1) in enumerate(bands, 1):
+            _run_band(function, y0, y1, token)
+            if progress:
+                progress(done / len(bands))
+        return
+    futures = [_executor().submit(_run_band, function, y0, y1, token) for y0, y1 in bands]
+    try:
+        for done, future in enumerate(futures, 1):
+            future.result()
+            if progress:
+                progress(done / len(bands))
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        # Bands still running write into buffers the caller is about to release
+        wait(futures)
+        raise
+
+
+class JobSignals(QObject):
+    progress = pyqtSignal(float)
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(str)
+    cancelled = pyqtSignal()
+
+
+class Job(QRunnable):
+    """Runs function(token, progress) on Qt's global thread pool.
+
+    The signals are delivered on the GUI thread: finished with the return
+    value, cancelled if the token was triggered, failed with the error text.
+    """
+
+    def __init__(self, title, function):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.title = title
+        self.function = function
+        self.token = CancelToken()
+        self.signals = JobSignals()
+        self._reported = -1.0
+
+    def start(self):
+        QThreadPool.globalInstance().start(self)
+
+    def cancel(self):
+        self.token.cancel()
+
+    def report(self, fraction):
+        # Whole percents only, so a fast loop doesn't flood the event queue
+        if fraction >= 1.0 or fraction - self._reported >= 0.01:
+            self._reported = fraction
+            self.signals.progress.emit(fraction)
+
+    def run(self):
+        try:
+            with span(self.title, "job"):
+                result = self.function(self.token, self.report)
+            # Steps that can't be interrupted still honour a late cancel
+            self.token.check()
+        except JobCancelled:
+            self.signals.cancelled.emit()
+        except Exception as e:
+            self.signals.failed.emit(str(e))
+        else:
+            self.signals.finished.emit(result)
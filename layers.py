@@ -0,0 +1,352 @@
+import numpy as np
+from PyQt5.QtGui import QImage, QRegion
+from PyQt5.QtCore import Qt, QRect, QPoint
+from imaging import image_array, convert_image, restore_format, paste_region, is_palette, NATIVE_FORMATS
+from jobs import run_bands
+from tracing import span
+
+BLEND_MODES = {
+    "normal": "Normal",
+    "multiply": "Multiply",
+    "screen": "Screen",
+    "overlay": "Overlay",
+    "darken": "Darken",
+    "lighten": "Lighten",
+    "difference": "Difference",
+    "add": "Add",
+}
+DEFAULT_BLEND_MODE = "normal"
+
+# When a layer moves out of the cached composite, the composite grows to take it
+# in plus this fraction of the document on every side, so a drag reallocates it rarely
+COMPOSITE_MARGIN = 0.125
+
+# Side of the square cells the layers are indexed by, in pixels: finding the
+# layers over a rectangle looks only at the cells it touches
+LAYER_INDEX_CELL = 512
+
+
+# Separable blend modes in premultiplied form: the colour term alpha_s * alpha_b * B(Cb, Cs),
+# written so that no channel has to be divided by its alpha
+def _mix_normal(b, s, ab, as_):
+    return s * ab
+
+
+def _mix_overlay(b, s, ab, as_):
+    return np.where(2 * b <= ab, 2 * s * b, as_ * ab - 2 * (ab - b) * (as_ - s))
+
+
+_MIXES = {
+    "normal": _mix_normal,
+    "multiply": lambda b, s, ab, as_: s * b,
+    "screen": lambda b, s, ab, as_: s * ab + b * as_ - s * b,
+    "overlay": _mix_overlay,
+    "darken": lambda b, s, ab, as_: np.minimum(s * ab, b * as_),
+    "lighten": lambda b, s, ab, as_: np.maximum(s * ab, b * as_),
+    "difference": lambda b, s, ab, as_: np.abs(s * ab - b * as_),
+    "add": lambda b, s, ab, as_: np.minimum(as_ * ab, s * ab + b * as_),
+}
+
+
+def blend(backdrop, source, mode=DEFAULT_BLEND_MODE, opacity=1.0, opaque=False):
+    """Composite source over backdrop in place; both are premultiplied BGRA uint8 arrays of the same shape.
+
+    opaque says every source pixel has full alpha. Normal layers stay in
+    integer arithmetic (a plain copy if opaque at full opacity); the other
+    modes are computed in float32, on (pixels, 4) arrays.
+    """
+    if mode == DEFAULT_BLEND_MODE:
+        if opacity >= 1.0 and opaque:
+            backdrop[...] = source
+            return
+        if opacity < 1.0:
+            source = source * np.uint16(round(opacity * 255))
+            source += 127
+            source //= 255
+        keep = 255 - source[:, :, 3:4].astype(np.uint16)
+        blended = backdrop * keep
+        blended += 127
+        blended //= 255
+        blended += source
+        backdrop[...] = blended
+        return
+    s = source.astype(np.float32).reshape(-1, 4)
+    s *= opacity / 255
+    b = backdrop.astype(np.float32).reshape(-1, 4)
+    b *= 1 / 255
+    as_, ab = s[:, 3:4], b[:, 3:4]
+    result = _MIXES[mode](b, s, ab, as_)
+    result += s * (1 - ab)
+    result += b * (1 - as_)
+    alpha = as_ + ab - as_ * ab
+    # Rounding may leave a channel a hair above its alpha
+    np.minimum(result, alpha, out=result)
+    result[:, 3:4] = alpha
+    result *= 255
+    result += 0.5
+    backdrop[...] = result.reshape(backdrop.shape)
+
+
+class Layer:
+    """A pasted image over the document, with a position, an opacity (0-1) and a blend mode."""
+
+    def __init__(self, image, pos=None, opacity=1.0, blend_mode=DEFAULT_BLEND_MODE):
+        if image.format() not in NATIVE_FORMATS:
+            image = convert_image(image, QImage.Format_ARGB32_Premultiplied, "layer")
+        self.image = image
+        self.pos = QPoint(pos) if pos is not None else QPoint()
+        self.opacity = opacity
+        self.blend_mode = blend_mode
+
+    def rect(self):
+        return QRect(self.pos, self.image.size())
+
+    def opaque(self):
+        return not self.image.hasAlphaChannel()
+
+    def copy(self):
+        # The image is implicitly shared, not copied
+        return Layer(self.image, self.pos, self.opacity, self.blend_mode)
+
+
+def composite_format(image):
+    """Return the 32-bit format image and the layers over it are composited in."""
+    return QImage.Format_ARGB32_Premultiplied if image.hasAlphaChannel() else QImage.Format_RGB32
+
+
+def _blend_layers(pixels, rect, layers, y0, y1):
+    """Blend the rows y0:y1 of every layer overlapping rect (the area pixels covers) into pixels."""
+    band = QRect(rect.x(), rect.y() + y0, rect.width(), y1 - y0)
+    for layer in layers:
+        overlap = layer.rect().intersected(band)
+        if overlap.isEmpty():
+            continue
+        lx, ly = overlap.x() - layer.pos.x(), overlap.y() - layer.pos.y()
+        px, py = overlap.x() - rect.x(), overlap.y() - rect.y()
+        source = image_array(layer.image)[ly:ly + overlap.height(), lx:lx + overlap.width()]
+        blend(pixels[py:py + overlap.height(), px:px + overlap.width()], source, layer.blend_mode,
+              layer.opacity, layer.opaque())
+
+
+class LayerStack:
+    """The layers pasted over a document's image, bottom first, and a cached composite of them.
+
+    composite holds the image with every layer blended in over bounds, a
+    rectangle around the layers clipped to the image; outside it the image
+    shows as it is. Changes only mark rectangles dirty, and render()
+    recomputes just those, band by band, so moving one of dozens of layers
+    costs in proportion to the area it uncovers and covers.
+
+    The layers are indexed by a grid of LAYER_INDEX_CELL cells, so that
+    with hundreds of them a rectangle is blended from only the layers
+    over it.
+    """
+
+    def __init__(self):
+        self.layers = []
+        self.bounds = QRect()
+        self.composite = None
+        # Writable view of composite, taken before anything shares its pixels
+        self.pixels = None
+        self.dirty = QRegion()
+        # cacheKey of the image the composite was last brought up to date with
+        self.key = None
+        # Grid cell -> layers over it, and layer -> its cells
+        self.cells = {}
+        self.cells_of = {}
+        # Layer -> index in layers and the union of their rectangles, None when out of date
+        self.positions = {}
+        self.covered = QRect()
+
+    def __len__(self):
+        return len(self.layers)
+
+    def __iter__(self):
+        return iter(self.layers)
+
+    def __contains__(self, layer):
+        return layer in self.cells_of
+
+    def add(self, layer, index=None):
+        if index is None or index >= len(self.layers):
+            if self.positions is not None:
+                self.positions[layer] = len(self.layers)
+            self.layers.append(layer)
+        else:
+            self.layers.insert(index, layer)
+            self.positions = None
+        self.indexLayer(layer)
+        if self.covered is not None:
+            self.covered = self.covered.united(layer.rect())
+        self.invalidate(layer.rect())
+
+    def remove(self, *layers):
+        """Remove layers from the stack, in one pass over it however many there are."""
+        gone = set(layers)
+        self.layers = [layer for layer in self.layers if layer not in gone]
+        for layer in layers:
+            self.unindexLayer(layer)
+            self.invalidate(layer.rect())
+        self.positions = None
+        self.covered = None
+
+    def index(self, layer):
+        if self.positions is None:
+            self.positions = {layer: index for index, layer in enumerate(self.layers)}
+        return self.positions[layer]
+
+    def move(self, layer, pos):
+        """Move layer to the QPoint pos; the area it leaves and the area it covers get recomputed."""
+        if layer.pos == pos:
+            return
+        self.invalidate(layer.rect())
+        self.unindexLayer(layer)
+        layer.pos = QPoint(pos)
+        self.indexLayer(layer)
+        self.covered = None
+        self.invalidate(layer.rect())
+
+    def changed(self, layer):
+        """Note that layer's opacity or blend mode changed."""
+        self.invalidate(layer.rect())
+
+    def cellsOf(self, rect):
+        left, top = rect.left() // LAYER_INDEX_CELL, rect.top() // LAYER_INDEX_CELL
+        right, bottom = rect.right() // LAYER_INDEX_CELL, rect.bottom() // LAYER_INDEX_CELL
+        return [(x, y) for y in range(top, bottom + 1) for x in range(left, right + 1)]
+
+    def indexLayer(self, layer):
+        cells = self.cellsOf(layer.rect())
+        self.cells_of[layer] = cells
+        for cell in cells:
+            self.cells.setdefault(cell, set()).add(layer)
+
+    def unindexLayer(self, layer):
+        for cell in self.cells_of.pop(layer, ()):
+            self.cells[cell].discard(layer)
+            if not self.cells[cell]:
+                del self.cells[cell]
+
+    def overlapping(self, rect):
+        """Return the layers over rect, bottom first."""
+        found = set()
+        for cell in self.cellsOf(rect):
+            found.update(self.cells.get(cell, ()))
+        return sorted((layer for layer in found if layer.rect().intersects(rect)), key=self.index)
+
+    def invalidate(self, rect=None):
+        """Mark rect, or the whole composite, to be recomputed by the next render()."""
+        rect = self.bounds if rect is None else rect.intersected(self.bounds)
+        if not rect.isEmpty():
+            self.dirty += QRegion(rect)
+
+    def imageChanged(self, image, rect):
+        """Note that image changed only in rect; otherwise render() would recompute everything."""
+        self.invalidate(rect)
+        if self.key is not None:
+            self.key = image.cacheKey()
+
+    def coverage(self, image):
+        """Return the part of image the layers cover."""
+        if self.covered is None:
+            self.covered = QRect()
+            for layer in self.layers:
+                self.covered = self.covered.united(layer.rect())
+        return self.covered.intersected(image.rect())
+
+    def render(self, image):
+        """Bring the composite up to date with image and the layers; return the rectangles recomputed.
+
+        The composite is dropped when the layers cover nothing, and
+        reallocated (all of it dirty) when they reach outside it.
+        """
+        covered = self.coverage(image)
+        if covered.isEmpty():
+            self.release()
+            return []
+        fmt = composite_format(image)
+        if (self.composite is None or self.composite.format() != fmt or not self.bounds.contains(covered)
+                or not image.rect().contains(self.bounds)):
+            margin = round(max(image.width(), image.height()) * COMPOSITE_MARGIN)
+            self.bounds = covered.adjusted(-margin, -margin, margin, margin).intersected(image.rect())
+            self.composite = QImage(self.bounds.size(), fmt)
+            self.pixels = image_array(self.composite, writable=True)
+            self.dirty = QRegion(self.bounds)
+        elif image.cacheKey() != self.key:
+            self.dirty = QRegion(self.bounds)
+        self.key = image.cacheKey()
+        rects = list(self.dirty.rects())
+        self.dirty = QRegion()
+        with span("layer composite", "display", layers=len(self.layers), rects=len(rects)):
+            for rect in rects:
+                self.renderRect(image, rect)
+        return rects
+
+    def renderRect(self, image, rect):
+        """Recompute the composite in rect (image coordinates, inside bounds)."""
+        x, y = rect.x() - self.bounds.x(), rect.y() - self.bounds.y()
+        target = self.pixels[y:y + rect.height(), x:x + rect.width()]
+        if image.format() == self.composite.format():
+            source = image_array(image)[rect.top():rect.bottom() + 1, rect.left():rect.right() + 1]
+        else:
+            region = convert_image(image.copy(rect), self.composite.format(), "layers")
+            source = image_array(region)
+
+        layers = self.overlapping(rect)
+
+        def render_band(y0, y1):
+            target[y0:y1] = source[y0:y1]
+            _blend_layers(target, rect, layers, y0, y1)
+        run_bands(render_band, rect.height())
+
+    def release(self):
+        """Drop the composite; the next render() rebuilds it."""
+        self.bounds = QRect()
+        self.composite = None
+        self.pixels = None
+        self.dirty = QRegion()
+        self.key = None
+
+    def flattened(self, image):
+        """Return (rect, pixels of image in rect with the layers blended in); rect is empty if they cover nothing."""
+        self.render(image)
+        covered = self.coverage(image)
+        if covered.isEmpty():
+            return covered, None
+        return covered, self.composite.copy(covered.translated(-self.bounds.topLeft()))
+
+
+def flatten_layers(image, layers, scale=1.0):
+    """Return a copy of image with layers blended in, positions and sizes multiplied by scale.
+
+    All the layers are blended in one pass over the union of their
+    rectangles; the rest of the image is only shared, not converted.
+    """
+    if scale != 1.0:
+        scaled = []
+        for layer in layers:
+            size = layer.image.size() * scale
+            resized = layer.image.scaled(max(1, size.width()), max(1, size.height()),
+                                         Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+            pos = QPoint(round(layer.pos.x() * scale), round(layer.pos.y() * scale))
+            scaled.append(Layer(resized, pos, layer.opacity, layer.blend_mode))
+        layers = scaled
+    rect = QRect()
+    for layer in layers:
+        rect = rect.united(layer.rect())
+    rect = rect.intersected(image.rect())
+    if rect.isEmpty():
+        return image
+    if is_palette(image):
+        # Palette pixels can't be patched in place
+        rect = image.rect()
+    # Our own copy of the area, in the format the layers are blended in
+    region = QImage(convert_image(image.copy(rect), composite_format(image), "layers"))
+    pixels = image_array(region, writable=True)
+    run_bands(lambda y0, y1: _blend_layers(pixels, rect, layers, y0, y1), rect.height())
+    region = restore_format(region, image)
+    if rect == image.rect():
+        return region
+    result = QImage(image)
+    paste_region(result, rect, region)
+    return result
@@ -9,9 +9,16 @@ import sys
 from PyQt5.QtWidgets import QApplication
 from main_window import MainWindow, resource_path
 from utils import load_config, save_config
+from tracing import enable_from_environment
+import frame_timing
 import os
 
 if __name__ == "__main__":
+    # PHOTOED_TRACE=trace.json records a Chrome trace of the session
+    enable_from_environment()
+    # PHOTOED_FRAME_STATS=1 prints frame time and input latency percentiles on exit
+    frame_timing.enable_from_environment()
+
     # Initialize the PyQt5 application
     app = QApplication(sys.argv)
     app.setWindowIcon(QIcon(resource_path("icons/icon.ico")))
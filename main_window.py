@@ -2,15 +2,32 @@ import sys
 import os
 from PyQt5.QtWidgets import (
     QMainWindow, QAction, QFileDialog, QDialog, QMenu, QMdiArea, QMessageBox,
-    QApplication, QStatusBar, QGraphicsView, QCheckBox, QInputDialog
+    QApplication, QStatusBar, QGraphicsView, QCheckBox, QInputDialog, QSpinBox, QLabel, QColorDialog
 )
 from PyQt5.QtGui import QIcon, QPixmap, QImage, QPen, QColor
 from PyQt5.QtCore import Qt, QRectF, QTimer
 from PyQt5.QtPrintSupport import QPrinter, QPrintDialog
 from editor import ImageEditor, EditorContainer
-from widgets import CustomMdiSubWindow, NewImageDialog, AdjustmentsDialog, ResizeDialog, RotationDialog
+from widgets import (
+    CustomMdiSubWindow, NewImageDialog, AdjustmentsDialog, ResizeDialog, RotationDialog, MemoryInspectorDock,
+    JobProgressWidget, FilterDialog, LayerPropertiesDialog, CurvesDialog, ColorGradeDialog, ConvertModeDialog
+)
 from commands import CropCommand
+from proxy import PROXY_MAX_PIXELS
+from filters import FILTERS
+from imaging import CV2_AVAILABLE
+from selection_mask import DEFAULT_WAND_TOLERANCE
+from brush import Brush, DEFAULT_BRUSH_SIZE, DEFAULT_HARDNESS, DEFAULT_OPACITY
+from quantize import ModeConversion
+from resampling import DEFAULT_RESIZE_MODE, DEFAULT_ROTATION_INTERPOLATION, DEFAULT_ROTATION_FILL
+from backing_store import BackingStore
+from clipboard import set_clipboard_image
 from utils import load_config, save_config, get_recent_files, add_recent_file
+from tracing import span, traced, instant
+from color_management import (
+    Profile, INTENTS, DEFAULT_INTENT, display, embedded_profile, can_convert, to_working_space,
+    system_display_profile
+)
 
 try:
     from win32com.client import Dispatch
@@ -31,10 +48,17 @@ class MainWindow(QMainWindow):
         self.setCentralWidget(self.mdi_area)
 
         self.statusBar().showMessage("Ready")
+        self.job_progress = JobProgressWidget(self)
+        self.statusBar().addPermanentWidget(self.job_progress)
 
         # --- Централизованное управление конфигурацией ---
         self.config = config
 
+        self.memory_dock = MemoryInspectorDock(self)
+        self.addDockWidget(Qt.RightDockWidgetArea, self.memory_dock)
+        self.memory_dock.hide()
+
+        self.loadDisplayProfile()
         self.createActions()
         self.createMenus()
         self.createToolbars()
@@ -143,6 +167,14 @@ class MainWindow(QMainWindow):
         self.open_act.setIcon(QIcon(resource_path("icons/open.png")))
         self.open_act.setToolTip("Open File (Ctrl+O)")
 
+        self.open_proxy_act = QAction("Open as &Proxy...", self, triggered=lambda checked: self.openFileAsProxy())
+        self.open_proxy_act.setIcon(QIcon(resource_path("icons/open.png")))
+        self.open_proxy_act.setToolTip("Open a reduced-resolution proxy of a large image")
+
+        self.open_mapped_act = QAction("Open &Memory-Mapped...", self, triggered=lambda checked: self.openFileMapped())
+        self.open_mapped_act.setIcon(QIcon(resource_path("icons/open.png")))
+        self.open_mapped_act.setToolTip("Open an uncompressed BMP, TIFF or raw image without loading it into memory")
+
         self.save_act = QAction("&Save", self, shortcut="Ctrl+S", triggered=lambda checked: self.saveFile())
         self.save_act.setIcon(QIcon(resource_path("icons/save.png")))
         self.save_act.setToolTip("Save File (Ctrl+S)")
@@ -184,6 +216,12 @@ class MainWindow(QMainWindow):
         self.paste_act.setIcon(QIcon(resource_path("icons/paste.png")))
         self.paste_act.setToolTip("Paste (Ctrl+V)")
 
+        self.layer_properties_act = QAction("&Layer Properties...", self, triggered=self.editLayerProperties)
+        self.layer_properties_act.setToolTip("Opacity and blend mode of the selected pasted layer")
+
+        self.flatten_layers_act = QAction("&Flatten Layers", self, shortcut="Ctrl+Shift+F", triggered=self.flattenLayers)
+        self.flatten_layers_act.setToolTip("Blend the pasted layers into the image (Ctrl+Shift+F)")
+
         self.crop_act = QAction("C&rop", self, shortcut="Ctrl+R", triggered=self.cropImage)
         self.crop_act.setIcon(QIcon(resource_path("icons/crop.png")))
         self.crop_act.setToolTip("Crop to Selection (Ctrl+R)")
@@ -223,6 +261,16 @@ class MainWindow(QMainWindow):
         self.toggle_rulers_act.setToolTip("Show Rulers")
         self.toggle_rulers_act.triggered.connect(self.toggleRulers)  # Подключаем сигнал triggered
 
+        self.monitor_profile_act = QAction("&Monitor Profile...", self, triggered=self.chooseMonitorProfile)
+        self.monitor_profile_act.setToolTip("Show images converted to the profile of your monitor")
+        self.srgb_monitor_act = QAction("Use &sRGB Monitor", self, triggered=lambda: self.setDisplayProfile(None))
+        self.intent_acts = []
+        for name, (label, _) in INTENTS.items():
+            action = QAction(f"{label} Intent", self, checkable=True,
+                             triggered=lambda checked, name=name: self.setRenderingIntent(name))
+            action.setChecked(name == display.intent)
+            self.intent_acts.append(action)
+
         #self.toggle_rulers_act = QAction("Show &Rulers", self, checkable=True, triggered=self.toggleRulers)
         #self.toggle_rulers_act.setIcon(QIcon(resource_path("icons/ruler.png")))  # Если нет, подбери подходящую
         #self.toggle_rulers_act.setToolTip("Show Rulers")
@@ -244,6 +292,9 @@ class MainWindow(QMainWindow):
         self.precise_rotate_act.setIcon(QIcon(resource_path("icons/rotate_cw.png")))
         self.precise_rotate_act.setToolTip("Precise Rotation")
 
+        self.deskew_act = QAction("Auto &Deskew", self, triggered=self.deskew)
+        self.deskew_act.setToolTip("Straighten a scanned page by the slope of its lines of text")
+
         self.flip_horizontal_act = QAction("Flip &Horizontal", self, triggered=lambda: self.flipImage(True))
         self.flip_horizontal_act.setIcon(QIcon(resource_path("icons/flip.png")))
         self.flip_horizontal_act.setToolTip("Flip Horizontal")
@@ -256,10 +307,26 @@ class MainWindow(QMainWindow):
         self.grayscale_act.setIcon(QIcon(resource_path("icons/grayscale.png")))
         self.grayscale_act.setToolTip("Convert to Grayscale")
 
+        self.convert_mode_act = QAction("Convert &Mode...", self, triggered=self.showConvertModeDialog)
+        self.convert_mode_act.setToolTip("Convert to an 8-bit palette, grayscale or 1-bit image")
+
         self.adjustments_act = QAction("&Adjustments...", self, triggered=self.showAdjustmentsDialog)
         self.adjustments_act.setIcon(QIcon(resource_path("icons/tune.png")))
         self.adjustments_act.setToolTip("Adjustments...")
 
+        self.curves_act = QAction("&Curves and Levels...", self, shortcut="Ctrl+M", triggered=self.showCurvesDialog)
+        self.curves_act.setToolTip("Curves and Levels...")
+
+        self.grade_act = QAction("Color &Grading...", self, triggered=self.showColorGradeDialog)
+        self.grade_act.setToolTip("Color Grading...")
+
+        # Filter actions
+        self.filter_acts = []
+        for name, (label, *_) in FILTERS.items():
+            action = QAction(f"{label}...", self, triggered=lambda checked=False, name=name: self.showFilterDialog(name))
+            action.setToolTip(f"{label}...")
+            self.filter_acts.append(action)
+
         # Window actions
         self.tile_act = QAction("&Tile", self, triggered=self.mdi_area.tileSubWindows)
         self.tile_act.setIcon(QIcon(resource_path("icons/tile.png")))  # Если нет, подбери подходящую
@@ -285,6 +352,24 @@ class MainWindow(QMainWindow):
         self.selection_tool_act = QAction("Selection Tool", self, triggered=self.activateSelectionTool)
         self.selection_tool_act.setIcon(QIcon(resource_path("icons/select.png")))
         self.selection_tool_act.setToolTip("Selection Tool")
+        self.lasso_tool_act = QAction("Lasso", self, triggered=lambda: self.setTool("lasso"))
+        self.lasso_tool_act.setToolTip("Lasso: drag around an area to select it")
+        self.polygon_tool_act = QAction("Polygon", self, triggered=lambda: self.setTool("polygon"))
+        self.polygon_tool_act.setToolTip("Polygon Selection: click the corners of an area")
+        self.magic_wand_act = QAction("Magic Wand", self, triggered=lambda: self.setTool("magic_wand"))
+        self.magic_wand_act.setToolTip("Magic Wand: click to select the connected area of a similar colour")
+        self.magic_wand_act.setEnabled(CV2_AVAILABLE)
+        self.perspective_tool_act = QAction("Perspective", self, triggered=lambda: self.setTool("perspective"))
+        self.perspective_tool_act.setToolTip("Perspective: click the four corners of a page to straighten it")
+        self.perspective_tool_act.setEnabled(CV2_AVAILABLE)
+        self.brush_tool_act = QAction("Brush", self, triggered=lambda: self.setTool("brush"))
+        self.brush_tool_act.setToolTip("Brush: paint with the brush colour")
+        self.eraser_tool_act = QAction("Eraser", self, triggered=lambda: self.setTool("eraser"))
+        self.eraser_tool_act.setToolTip("Eraser: paint white, or transparency in images with alpha")
+        self.clone_tool_act = QAction("Clone", self, triggered=lambda: self.setTool("clone"))
+        self.clone_tool_act.setToolTip("Clone: Alt+click the source, then paint a copy of it")
+        self.brush_color_act = QAction("Brush Color...", self, triggered=self.chooseBrushColor)
+        self.brush_color_act.setToolTip("Choose the brush colour")
 
 
         # Help actions
@@ -298,6 +383,8 @@ class MainWindow(QMainWindow):
         file_menu = self.menuBar().addMenu("&File")
         file_menu.addAction(self.new_act)
         file_menu.addAction(self.open_act)
+        file_menu.addAction(self.open_proxy_act)
+        file_menu.addAction(self.open_mapped_act)
         # Добавляем подменю Recent Files
         self.recent_files_menu = QMenu("Recent Files", self)
         file_menu.addMenu(self.recent_files_menu)
@@ -318,9 +405,21 @@ class MainWindow(QMainWindow):
         edit_menu.addAction(self.cut_act)
         edit_menu.addAction(self.copy_act)
         edit_menu.addAction(self.paste_act)
+        edit_menu.addAction(self.layer_properties_act)
+        edit_menu.addAction(self.flatten_layers_act)
         edit_menu.addAction(self.crop_act)
         edit_menu.addSeparator()
         edit_menu.addAction(self.select_all_act)
+        edit_menu.addAction(self.selection_tool_act)
+        edit_menu.addAction(self.lasso_tool_act)
+        edit_menu.addAction(self.polygon_tool_act)
+        edit_menu.addAction(self.magic_wand_act)
+        edit_menu.addAction(self.perspective_tool_act)
+        edit_menu.addSeparator()
+        edit_menu.addAction(self.brush_tool_act)
+        edit_menu.addAction(self.eraser_tool_act)
+        edit_menu.addAction(self.clone_tool_act)
+        edit_menu.addAction(self.brush_color_act)
 
         # View menu
         view_menu = self.menuBar().addMenu("&View")
@@ -330,6 +429,14 @@ class MainWindow(QMainWindow):
         view_menu.addAction(self.actual_size_act)
         view_menu.addSeparator()
         view_menu.addAction(self.toggle_rulers_act)
+        view_menu.addAction(self.memory_dock.toggleViewAction())
+        view_menu.addSeparator()
+        color_menu = view_menu.addMenu("&Color Management")
+        color_menu.addAction(self.monitor_profile_act)
+        color_menu.addAction(self.srgb_monitor_act)
+        color_menu.addSeparator()
+        for action in self.intent_acts:
+            color_menu.addAction(action)
 
         # Image menu
         image_menu = self.menuBar().addMenu("&Image")
@@ -339,6 +446,7 @@ class MainWindow(QMainWindow):
         rotate_menu.addAction(self.rotate_180_act)
         rotate_menu.addSeparator() # Optional separator
         rotate_menu.addAction(self.precise_rotate_act)
+        rotate_menu.addAction(self.deskew_act)
         image_menu.addAction(self.crop_act)
         image_menu.addAction(self.resizeAct)
 
@@ -349,7 +457,15 @@ class MainWindow(QMainWindow):
 
         image_menu.addSeparator()
         image_menu.addAction(self.grayscale_act)
+        image_menu.addAction(self.convert_mode_act)
         image_menu.addAction(self.adjustments_act)
+        image_menu.addAction(self.curves_act)
+        image_menu.addAction(self.grade_act)
+
+        # Filter menu
+        filter_menu = self.menuBar().addMenu("F&ilter")
+        for action in self.filter_acts:
+            filter_menu.addAction(action)
 
         # Window menu
         window_menu = self.menuBar().addMenu("&Window")
@@ -422,12 +538,145 @@ class MainWindow(QMainWindow):
         tool_toolbar = self.addToolBar("Tools")
         tool_toolbar.setToolButtonStyle(Qt.ToolButtonIconOnly)
         tool_toolbar.addAction(self.selection_tool_act)
+        # No icons for these yet, so the buttons show their text
+        tool_toolbar.addAction(self.lasso_tool_act)
+        tool_toolbar.addAction(self.polygon_tool_act)
+        tool_toolbar.addAction(self.magic_wand_act)
+        tool_toolbar.addAction(self.perspective_tool_act)
+        self.wand_tolerance = self.config.getint('Editor', 'wand_tolerance', fallback=DEFAULT_WAND_TOLERANCE)
+        tolerance_spin = QSpinBox()
+        tolerance_spin.setRange(0, 255)
+        tolerance_spin.setValue(self.wand_tolerance)
+        tolerance_spin.setToolTip("Magic wand tolerance: largest difference from the clicked colour per channel")
+        tolerance_spin.valueChanged.connect(self.setWandTolerance)
+        tool_toolbar.addWidget(QLabel(" Tolerance: "))
+        tool_toolbar.addWidget(tolerance_spin)
+
+        # Painting tools
+        paint_toolbar = self.addToolBar("Paint")
+        paint_toolbar.setToolButtonStyle(Qt.ToolButtonIconOnly)
+        paint_toolbar.addAction(self.brush_tool_act)
+        paint_toolbar.addAction(self.eraser_tool_act)
+        paint_toolbar.addAction(self.clone_tool_act)
+        paint_toolbar.addAction(self.brush_color_act)
+        self.brush = Brush(self.config.getint('Editor', 'brush_size', fallback=DEFAULT_BRUSH_SIZE),
+                           self.config.getfloat('Editor', 'brush_hardness', fallback=DEFAULT_HARDNESS),
+                           self.config.getfloat('Editor', 'brush_opacity', fallback=DEFAULT_OPACITY),
+                           QColor(self.config.get('Editor', 'brush_color', fallback='#000000')))
+        for label, key, minimum, maximum, value, tip in (
+                ("Size", 'brush_size', 1, 1000, self.brush.size, "Brush diameter in pixels"),
+                ("Hardness", 'brush_hardness', 0, 100, round(self.brush.hardness * 100),
+                 "Part of the brush radius painted at full strength, in percent"),
+                ("Opacity", 'brush_opacity', 1, 100, round(self.brush.opacity * 100),
+                 "Strongest a stroke paints, in percent")):
+            spin = QSpinBox()
+            spin.setRange(minimum, maximum)
+            spin.setValue(value)
+            spin.setToolTip(tip)
+            spin.valueChanged.connect(lambda value, key=key: self.setBrushOption(key, value))
+            paint_toolbar.addWidget(QLabel(f" {label}: "))
+            paint_toolbar.addWidget(spin)
+
+    def setBrushOption(self, key, value):
+        """Set the brush size (pixels), hardness or opacity (percent) and remember it."""
+        if key == 'brush_size':
+            self.brush.size = value
+        elif key == 'brush_hardness':
+            self.brush.hardness = value / 100
+        else:
+            self.brush.opacity = value / 100
+        if not self.config.has_section('Editor'):
+            self.config.add_section('Editor')
+        self.config.set('Editor', key, str(value if key == 'brush_size' else value / 100))
+
+    def chooseBrushColor(self):
+        color = QColorDialog.getColor(self.brush.color, self, "Brush Color")
+        if not color.isValid():
+            return
+        self.brush.color = color
+        if not self.config.has_section('Editor'):
+            self.config.add_section('Editor')
+        self.config.set('Editor', 'brush_color', color.name())
+
+    def loadDisplayProfile(self):
+        """Set up the monitor profile and rendering intent from the config, or from the system."""
+        intent = self.config.get('Editor', 'rendering_intent', fallback=DEFAULT_INTENT)
+        if intent not in INTENTS:
+            intent = DEFAULT_INTENT
+        path = self.config.get('Editor', 'monitor_profile', fallback='')
+        profile = None
+        if path:
+            try:
+                profile = Profile.fromFile(path)
+            except (OSError, ValueError) as e:
+                instant("monitor profile ignored", "convert", file=path, error=e)
+                self.statusBar().showMessage(f"Ignoring monitor profile {path}: {e}", 5000)
+        else:
+            profile = system_display_profile()
+        display.set(profile, intent)
+
+    def convertEmbeddedProfile(self, image, profile):
+        """Return image converted from its embedded profile to the working space, and a note for the status bar.
+
+        The conversion uses color_management.DOCUMENT_INTENT, not the monitor's
+        rendering intent, which only affects how documents are shown.
+        """
+        if profile is None:
+            return image, ""
+        if not can_convert(profile):
+            return image, f" (ignored {profile.color_space} profile {profile.description})"
+        with span("convert profile", "io", profile=profile.description):
+            image = to_working_space(image, profile)
+        return image, f" (converted from {profile.description})"
+
+    def chooseMonitorProfile(self):
+        file_name, _ = QFileDialog.getOpenFileName(self, "Monitor Profile", "", "ICC Profiles (*.icc *.icm)")
+        if not file_name:
+            return
+        try:
+            profile = Profile.fromFile(file_name)
+        except (OSError, ValueError) as e:
+            QMessageBox.warning(self, "Error", f"Failed to read profile: {e}")
+            return
+        if profile.color_space != "RGB":
+            QMessageBox.warning(self, "Error", f"{profile.description} is a {profile.color_space} profile, not a monitor one.")
+            return
+        self.setDisplayProfile(profile, file_name)
+
+    def setDisplayProfile(self, profile, path=''):
+        """Show documents converted to profile (None for an sRGB monitor) and remember it."""
+        display.set(profile, display.intent)
+        if not self.config.has_section('Editor'):
+            self.config.add_section('Editor')
+        self.config.set('Editor', 'monitor_profile', path)
+        self.refreshDisplays()
+        self.statusBar().showMessage(f"Monitor profile: {profile.description if profile else 'sRGB'}", 2000)
+
+    def setRenderingIntent(self, name):
+        for action, intent in zip(self.intent_acts, INTENTS):
+            action.setChecked(intent == name)
+        display.set(display.profile, name)
+        if not self.config.has_section('Editor'):
+            self.config.add_section('Editor')
+        self.config.set('Editor', 'rendering_intent', name)
+        self.refreshDisplays()
+
+    def refreshDisplays(self):
+        for sub_window in self.mdi_area.subWindowList():
+            sub_window.editor_container.editor.refreshDisplay()
+
+    def setWandTolerance(self, value):
+        self.wand_tolerance = value
+        if not self.config.has_section('Editor'):
+            self.config.add_section('Editor')
+        self.config.set('Editor', 'wand_tolerance', str(value))
 
     def activateSelectionTool(self):
         editor = self.currentEditor()
         if editor:
+            editor.scene.cancelPath()
             editor.scene.current_tool = "selection"
-            self.statusBar().showMessage("Selection tool active: Click and drag to select an area")
+            self.statusBar().showMessage(TOOL_HINTS["selection"])
             editor.setDragMode(QGraphicsView.NoDrag)
 
 
@@ -501,13 +750,10 @@ class MainWindow(QMainWindow):
 
 
 
+    @traced("MainWindow.openFile", "io")
     def openFile(self, file_name=None):
         """Открыть файл. Если file_name указан, открыть его напрямую, иначе показать диалог."""
-        print("MainWindow.openFile called")
-        print(f"file_name at start: {file_name}")  # Отладка
         if file_name is None:
-            print("file_name is None, proceeding to open dialog")  # Отладка
-            print("Opening file dialog...")  # Отладка
             try:
                 file_name, _ = QFileDialog.getOpenFileName(
                     self,
@@ -515,54 +761,117 @@ class MainWindow(QMainWindow):
                     "",
                     "Images (*.png *.jpg *.jpeg *.bmp *.gif *.tiff)"
                 )
-                print(f"File dialog returned: {file_name}")  # Отладка
             except Exception as e:
-                print(f"Error opening file dialog: {e}")  # Отладка
                 QMessageBox.critical(self, "Error", f"Failed to open file dialog: {e}")
                 return
-        else:
-            print(f"file_name provided: {file_name}")  # Отладка
         if file_name:
-            print(f"Checking if file exists: {file_name}")  # Отладка
             if not os.path.exists(file_name):
-                print("File does not exist")  # Отладка
                 QMessageBox.warning(self, "Error", f"File does not exist: {file_name}")
                 return
-            print(f"Loading image: {file_name}")  # Отладка
-            image = QImage(file_name)
+            with span("decode", "io", file=file_name) as decode:
+                image = QImage(file_name)
+                decode.set(width=image.width(), height=image.height())
             if image.isNull():
-                print("Image is null, showing error message")  # Отладка
                 QMessageBox.warning(self, "Error", "Failed to open image.")
                 return
-            print("Creating subwindow...")  # Отладка
+            image, profile_note = self.convertEmbeddedProfile(image, embedded_profile(file_name))
             sub_window = CustomMdiSubWindow(self)
             sub_window.editor_container.editor.setImage(image)
             sub_window.base_title = os.path.basename(file_name)
             sub_window.setWindowTitle(f"{os.path.basename(file_name)} ({image.width()}x{image.height()}) @ 100%")
             sub_window.file_path = file_name  # Сохраняем путь к файлу
-            print("Adding subwindow to MDI area...")  # Отладка
             self.mdi_area.addSubWindow(sub_window)
-            print("Showing subwindow...")  # Отладка
             sub_window.show()
 
             # Корректируем позицию окна
             viewport = self.mdi_area.viewport()
             viewport_rect = viewport.rect()
-            print("Moving subwindow to top-left...")  # Отладка
             sub_window.move(viewport_rect.topLeft())  # Перемещаем в верхний левый угол
 
-            print("Scheduling fitInViewWithRulers...")  # Отладка
             QTimer.singleShot(100, sub_window.editor_container.editor.fitInViewWithRulers)
-            self.statusBar().showMessage(f"Opened {file_name}", 2000)
+            self.statusBar().showMessage(f"Opened {file_name}{profile_note}", 2000)
             
             # Обновляем список недавних файлов в self.config
             add_recent_file(self.config, file_name)
             self.update_recent_files_menu()
-        else:
-            print("No file selected, exiting openFile")
 
 
 
+    def openFileAsProxy(self, file_name=None):
+        """Open a large image as a reduced-resolution proxy; edits are applied to the full image on save."""
+        if file_name is None:
+            file_name, _ = QFileDialog.getOpenFileName(
+                self,
+                "Open Image as Proxy",
+                "",
+                "Images (*.png *.jpg *.jpeg *.bmp *.gif *.tif *.tiff)"
+            )
+        if not file_name:
+            return
+        if not os.path.exists(file_name):
+            QMessageBox.warning(self, "Error", f"File does not exist: {file_name}")
+            return
+        max_pixels = self.config.getint('Editor', 'proxy_max_pixels', fallback=PROXY_MAX_PIXELS)
+        sub_window = CustomMdiSubWindow(self)
+        editor = sub_window.editor_container.editor
+        if not editor.openProxy(file_name, max_pixels):
+            QMessageBox.warning(self, "Error", "Failed to open image.")
+            return
+        full_size = editor.proxy.full_size
+        sub_window.base_title = f"{os.path.basename(file_name)} [proxy {full_size.width()}x{full_size.height()}]"
+        sub_window.setWindowTitle(sub_window.base_title)
+        # Saving asks for a new file: the source is what every save is replayed on
+        sub_window.file_path = None
+        self.mdi_area.addSubWindow(sub_window)
+        sub_window.show()
+        QTimer.singleShot(100, editor.fitInViewWithRulers)
+        self.statusBar().showMessage(f"Opened proxy of {file_name}", 2000)
+        add_recent_file(self.config, file_name)
+        self.update_recent_files_menu()
+
+    def openFileMapped(self, file_name=None):
+        """Open an uncompressed image through a memory-mapped backing store."""
+        if file_name is None:
+            file_name, _ = QFileDialog.getOpenFileName(
+                self,
+                "Open Memory-Mapped Image",
+                "",
+                "Uncompressed Images (*.bmp *.tif *.tiff *.raw)"
+            )
+        if not file_name:
+            return
+        if not os.path.exists(file_name):
+            QMessageBox.warning(self, "Error", f"File does not exist: {file_name}")
+            return
+        store = None
+        try:
+            if file_name.lower().endswith('.raw'):
+                geometry, ok = QInputDialog.getText(self, "Raw Image", "Geometry (WIDTHxHEIGHTxCHANNELS, channels 1, 3 or 4):", text="1024x768x3")
+                if not ok:
+                    return
+                width, height, channels = (int(v) for v in geometry.lower().split('x'))
+                channel_order = {1: 'L', 3: 'RGB', 4: 'RGBA'}[channels]
+                store = BackingStore.open_raw(file_name, width, height, channel_order)
+            else:
+                store = BackingStore.open(file_name)
+        except (OSError, ValueError, KeyError) as e:
+            QMessageBox.warning(self, "Error", f"Failed to map image: {e}")
+            return
+        if store is None:
+            QMessageBox.warning(self, "Error", "The image is compressed or has an unsupported layout and can't be memory-mapped.")
+            return
+        max_pixels = self.config.getint('Editor', 'proxy_max_pixels', fallback=PROXY_MAX_PIXELS)
+        sub_window = CustomMdiSubWindow(self)
+        editor = sub_window.editor_container.editor
+        editor.openMapped(file_name, max_pixels, store=store)
+        sub_window.base_title = f"{os.path.basename(file_name)} [mapped {store.width()}x{store.height()}]"
+        sub_window.setWindowTitle(sub_window.base_title)
+        sub_window.file_path = None if file_name.lower().endswith('.raw') else file_name
+        self.mdi_area.addSubWindow(sub_window)
+        sub_window.show()
+        QTimer.singleShot(100, editor.fitInViewWithRulers)
+        self.statusBar().showMessage(f"Mapped {file_name}", 2000)
+
     def loadFile(self, file_path):
         sub_window = CustomMdiSubWindow(self)
         if sub_window.editor_container.editor.openImage(file_path):  # Используем openImage через EditorContainer
@@ -599,10 +908,9 @@ class MainWindow(QMainWindow):
                 "PNG Files (*.png);;JPEG Files (*.jpg *.jpeg);;BMP Files (*.bmp);;GIF Files (*.gif);;TIFF Files (*.tiff);;All Files (*)",
                 "PNG Files (*.png)"  # Фильтр по умолчанию
             )
-        print(f"Saving to: {file_name}")  # Отладка
         if file_name:
             try:
-                success = editor.current_image.save(file_name)
+                success = editor.saveImage(file_name)
                 if not success:
                     raise Exception("QImage.save returned False")
                 editor.is_modified = False
@@ -611,7 +919,7 @@ class MainWindow(QMainWindow):
                 self.statusBar().showMessage(f"Saved to {file_name}", 2000)
                 return True
             except Exception as e:
-                print(f"Failed to save file: {e}")  # Отладка
+                instant("save failed", "io", file=file_name, error=e)
                 QMessageBox.critical(self, "Error", f"Failed to save file: {e}")
                 return False
         return False
@@ -626,8 +934,6 @@ class MainWindow(QMainWindow):
         if not editor:
             return False
 
-        editor.applyAllPastedItems()
-
         file_path, selected_filter = QFileDialog.getSaveFileName(self, "Save Image", "",
             "PNG Files (*.png);;JPEG Files (*.jpg *.jpeg);;BMP Files (*.bmp);;TIFF Files (*.tif *.tiff);;All Files (*)",
             "PNG Files (*.png)"  # Фильтр по умолчанию
@@ -637,7 +943,6 @@ class MainWindow(QMainWindow):
             # Проверяем, есть ли расширение в имени файла
             if not os.path.splitext(file_path)[1]:  # Если расширения нет
                 file_path += ".png"  # Добавляем .png по умолчанию
-                print(f"Added .png extension: {file_path}")  # Отладка
 
             if self.saveImageToFile(editor, file_path):
                 image_size = editor.getCurrentImage().size()
@@ -653,7 +958,6 @@ class MainWindow(QMainWindow):
         return False
 
     def toggleRulers(self):
-        print("MainWindow.toggleRulers called")  # Отладка
         sub_window = self.mdi_area.activeSubWindow()
         if sub_window:
             # Переключаем состояние линеек
@@ -663,17 +967,16 @@ class MainWindow(QMainWindow):
 
     def saveImageToFile(self, editor, file_path):
         """Save the image to a file."""
-        image = editor.getCurrentImage()
-        if image:
+        if editor.getCurrentImage():
             try:
-                success = image.save(file_path)
+                success = editor.saveImage(file_path)
                 if success:
                     return True
                 else:
-                    print(f"Failed to save image to {file_path}: QImage.save returned False")  # Отладка
+                    instant("save failed", "io", file=file_path, error="QImage.save returned False")
                     return False
             except Exception as e:
-                print(f"Failed to save image to {file_path}: {e}")  # Отладка
+                instant("save failed", "io", file=file_path, error=e)
                 return False
         return False
 
@@ -745,6 +1048,7 @@ class MainWindow(QMainWindow):
             if qimage.isNull():
                 QMessageBox.critical(self, "Error", "Failed to load scanned image data.")
                 return
+            qimage, _ = self.convertEmbeddedProfile(qimage, embedded_profile(BytesIO(binary_data)))
 
             # Создаем новый редактор
             sub_window = CustomMdiSubWindow(self) # Pass self as main_window
@@ -767,11 +1071,19 @@ class MainWindow(QMainWindow):
         if not editor or not editor.getCurrentImage():
             self.statusBar().showMessage("No active image to rotate.", 2000)
             return
+        if not editor.ensureIdle() or not editor.flattenLayers():
+            return
 
-        dialog = RotationDialog(editor, self) # Pass editor and parent
+        interpolation = self.config.get('Editor', 'rotation_interpolation', fallback=DEFAULT_ROTATION_INTERPOLATION)
+        fill = self.config.get('Editor', 'rotation_fill', fallback=DEFAULT_ROTATION_FILL)
+        dialog = RotationDialog(editor, self, interpolation, fill) # Pass editor and parent
         if dialog.exec_() == QDialog.Accepted:
             angle = dialog.get_angle()
-            editor.apply_rotation(angle) # Use the new method in ImageEditor
+            if not self.config.has_section('Editor'):
+                self.config.add_section('Editor')
+            self.config.set('Editor', 'rotation_interpolation', dialog.get_interpolation())
+            self.config.set('Editor', 'rotation_fill', dialog.get_fill())
+            editor.apply_rotation(angle, dialog.get_interpolation(), dialog.get_fill()) # Use the new method in ImageEditor
             self.statusBar().showMessage(f"Image rotated by {angle} degrees.", 2000)
         else:
             self.statusBar().showMessage("Rotation cancelled.", 2000)
@@ -800,12 +1112,11 @@ class MainWindow(QMainWindow):
             editor = self.currentEditor()
             if not editor:
                 return
-            selection_rect = editor.scene.selection_rect
-            if not selection_rect or not selection_rect.rect().isValid() or selection_rect.rect().isEmpty():
+            image = editor.getSelectedRegion()
+            if image is None:
                 self.statusBar().showMessage("No valid selection to copy", 2000)
                 return
-            image = editor.getCurrentImage().copy(selection_rect.rect().toRect())
-            QApplication.clipboard().setImage(image)
+            set_clipboard_image(image)
             self.statusBar().showMessage("Selection copied to clipboard", 2000)
 
 
@@ -816,6 +1127,23 @@ class MainWindow(QMainWindow):
         	return
     	editor.paste()  # Delegate to ImageEditor
 
+    def editLayerProperties(self):
+        """Edit the opacity and blend mode of the selected pasted layer"""
+        editor = self.currentEditor()
+        if not editor or not editor.ensureIdle():
+            return
+        item = editor.selectedLayerItem()
+        if item is None:
+            self.statusBar().showMessage("Select a pasted layer first", 2000)
+            return
+        LayerPropertiesDialog(editor, item, self).exec_()
+
+    def flattenLayers(self):
+        """Blend the pasted layers into the image"""
+        editor = self.currentEditor()
+        if editor:
+            editor.flattenLayers()
+
     def selectAll(self):
         """Select the entire image"""
         editor = self.currentEditor()
@@ -844,14 +1172,13 @@ class MainWindow(QMainWindow):
             self.statusBar().showMessage("No valid selection to crop", 2000)
             return
 
+        # Layers aren't cropped with the image: flatten them first
+        if not editor.flattenLayers():
+            return
         rect = selection_rect.rect().toRect()
-        command = CropCommand(editor, rect)
+        command = CropCommand(editor, rect, editor.selectionMask())
         editor.executeCommand(command)
-        editor.scene.removeItem(selection_rect)
-        editor.scene.selection_rect = None
-        for handle in editor.scene.handles:
-            editor.scene.removeItem(handle)
-        editor.scene.handles.clear()
+        editor.scene.clearSelection()
         self.statusBar().showMessage(f"Image cropped to {rect.width()}x{rect.height()}", 2000)
 
     def zoomIn(self):
@@ -881,11 +1208,18 @@ class MainWindow(QMainWindow):
         if not editor or not editor.current_image:
             self.statusBar().showMessage("No image to resize", 2000)
             return
+        if not editor.ensureIdle():
+            return
         current_size = editor.current_image.size()
-        dialog = ResizeDialog(current_size.width(), current_size.height(), self)
+        mode = self.config.get('Editor', 'resize_mode', fallback=DEFAULT_RESIZE_MODE)
+        dialog = ResizeDialog(current_size.width(), current_size.height(), self, mode)
         if dialog.exec_():
             width, height, keep_aspect = dialog.getNewSize()
-            editor.resizeImage(width, height, keep_aspect)
+            mode = dialog.getMode()
+            if not self.config.has_section('Editor'):
+                self.config.add_section('Editor')
+            self.config.set('Editor', 'resize_mode', mode)
+            editor.resizeImage(width, height, keep_aspect, mode)
             self.statusBar().showMessage(f"Image resized to {width}x{height}", 2000)
 
     def rotateImage(self, degrees):
@@ -894,6 +1228,12 @@ class MainWindow(QMainWindow):
         if editor:
             editor.rotateImage(degrees)
 
+    def deskew(self):
+        """Straighten the image by its detected skew"""
+        editor = self.currentEditor()
+        if editor:
+            editor.deskew()
+
     def flipImage(self, horizontal):
         """Flip the image horizontally or vertically"""
         editor = self.currentEditor()
@@ -906,15 +1246,81 @@ class MainWindow(QMainWindow):
         if editor:
             editor.convertToGrayscale()
 
+    def showConvertModeDialog(self):
+        """Show the dialog converting the image to a palette, grayscale or 1-bit mode"""
+        editor = self.currentEditor()
+        if not editor or not editor.getCurrentImage():
+            self.statusBar().showMessage("No image to convert", 2000)
+            return
+        if not editor.ensureIdle():
+            return
+        defaults = ModeConversion()
+        conversion = ModeConversion(
+            self.config.get('Editor', 'convert_mode', fallback=defaults.mode),
+            self.config.getint('Editor', 'convert_colours', fallback=defaults.colours),
+            self.config.get('Editor', 'convert_palette', fallback=defaults.palette_method),
+            self.config.get('Editor', 'convert_dither', fallback=defaults.dither),
+            self.config.get('Editor', 'convert_threshold', fallback=defaults.threshold),
+            self.config.getint('Editor', 'convert_block_size', fallback=defaults.block_size),
+            self.config.getint('Editor', 'convert_offset', fallback=defaults.offset))
+        dialog = ConvertModeDialog(conversion, self)
+        if not dialog.exec_():
+            return
+        conversion = dialog.getConversion()
+        if not self.config.has_section('Editor'):
+            self.config.add_section('Editor')
+        for key, value in (('convert_mode', conversion.mode), ('convert_colours', conversion.colours),
+                           ('convert_palette', conversion.palette_method), ('convert_dither', conversion.dither),
+                           ('convert_threshold', conversion.threshold), ('convert_block_size', conversion.block_size),
+                           ('convert_offset', conversion.offset)):
+            self.config.set('Editor', key, str(value))
+        editor.convertMode(conversion)
+
     def showAdjustmentsDialog(self):
         """Show adjustments dialog"""
         editor = self.currentEditor()
-        if editor:
+        if editor and editor.ensureIdle():
             dialog = AdjustmentsDialog(editor, self)
             if dialog.exec_():
                 self.statusBar().showMessage("Adjustments applied", 2000)
 
 
+    def showCurvesDialog(self):
+        """Show the curves and levels dialog"""
+        editor = self.currentEditor()
+        if not editor or not editor.getCurrentImage():
+            self.statusBar().showMessage("No image to adjust", 2000)
+            return
+        if editor.ensureIdle():
+            dialog = CurvesDialog(editor, self)
+            if dialog.exec_():
+                self.statusBar().showMessage("Curves applied", 2000)
+
+    def showColorGradeDialog(self):
+        """Show the colour grading dialog"""
+        editor = self.currentEditor()
+        if not editor or not editor.getCurrentImage():
+            self.statusBar().showMessage("No image to adjust", 2000)
+            return
+        if editor.ensureIdle():
+            dialog = ColorGradeDialog(editor, self)
+            if dialog.exec_():
+                self.statusBar().showMessage("Color grade applied", 2000)
+
+    def showFilterDialog(self, name):
+        """Show the dialog of one of filters.FILTERS"""
+        editor = self.currentEditor()
+        if not editor or not editor.getCurrentImage():
+            self.statusBar().showMessage("No image to filter", 2000)
+            return
+        if not CV2_AVAILABLE:
+            QMessageBox.warning(self, "Error", "OpenCV (cv2) is not installed. Please install it to use filters.")
+            return
+        if editor.ensureIdle():
+            dialog = FilterDialog(editor, name, self)
+            if dialog.exec_():
+                self.statusBar().showMessage(f"{FILTERS[name][0]} applied", 2000)
+
     def about(self):
         """Show the about dialog"""
         QMessageBox.about(self, "About Simple Photo Editor",
@@ -926,11 +1332,24 @@ class MainWindow(QMainWindow):
     def setTool(self, tool_name):
             editor = self.currentEditor()
             if editor:
+                editor.scene.cancelPath()
                 editor.scene.current_tool = tool_name
-                self.statusBar().showMessage("Selection tool active: Click and drag to select an area")
+                self.statusBar().showMessage(TOOL_HINTS.get(tool_name, TOOL_HINTS["selection"]))
                 editor.setDragMode(QGraphicsView.NoDrag)
 
 
+TOOL_HINTS = {
+    "selection": "Selection tool active: Click and drag to select an area",
+    "lasso": "Lasso active: Drag around the area to select",
+    "polygon": "Polygon selection active: Click the corners; click the first one or double-click to close, Esc cancels",
+    "magic_wand": "Magic wand active: Click an area to select it and the connected pixels of a similar colour",
+    "perspective": "Perspective tool active: Click the four corners of the page to straighten it, Esc cancels",
+    "brush": "Brush active: Drag to paint",
+    "eraser": "Eraser active: Drag to erase",
+    "clone": "Clone tool active: Alt+click the source, then drag to paint a copy of it",
+}
+
+
 def resource_path(relative_path):
     """Get the absolute path to a resource, works for development and PyInstaller."""
     if getattr(sys, 'frozen', False):  # If App running as .exe
@@ -0,0 +1,154 @@
+import os
+import sys
+from PyQt5.QtGui import QImage, QPixmap
+from PyQt5.QtWidgets import QGraphicsPixmapItem
+from layers import Layer, LayerStack
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Order in which shared buffers are attributed: a buffer referenced from
+# several places is counted once, in the first category that holds it
+DOCUMENT_CATEGORIES = (
+    "current_image", "original_image", "pixmap", "image_before_preview", "pasted_items", "undo", "redo"
+)
+
+
+def image_bytes(image):
+    """Return the size of the pixel buffer of a QImage or QPixmap."""
+    if isinstance(image, QPixmap):
+        if image.isNull():
+            return 0
+        return image.width() * image.height() * max(1, image.depth() // 8)
+    if image is None or image.isNull():
+        return 0
+    return image.sizeInBytes()
+
+
+def frame_bytes(image):
+    """Return the size of one full frame of image in the 32-bit working format."""
+    return image.width() * image.height() * 4
+
+
+def _images_of(value):
+    """Yield the QImages and QPixmaps held by value (an image, pixmap item, layer, or list of them)."""
+    if isinstance(value, (QImage, QPixmap)):
+        yield value
+    elif isinstance(value, QGraphicsPixmapItem):
+        yield value.pixmap()
+    elif isinstance(value, Layer):
+        yield value.image
+    elif isinstance(getattr(value, 'layer', None), Layer):
+        # A pasted layer's MovableImageItem
+        yield value.layer.image
+    elif isinstance(value, (list, tuple, LayerStack)):
+        for item in value:
+            yield from _images_of(item)
+
+
+def command_images(command):
+    """Yield the images a history command keeps alive."""
+    for name, value in vars(command).items():
+        if name != "editor":
+            yield from _images_of(value)
+
+
+class _Accounting:
+    """Sum buffer sizes per category, counting implicitly shared buffers once."""
+
+    def __init__(self):
+        self.seen = set()
+        self.totals = dict.fromkeys(DOCUMENT_CATEGORIES, 0)
+
+    def add(self, category, images):
+        size = 0
+        for image in images:
+            # QImage and QPixmap number their buffers independently
+            key = (type(image), image.cacheKey())
+            if key in self.seen:
+                continue
+            self.seen.add(key)
+            size += image_bytes(image)
+        self.totals[category] += size
+        return size
+
+
+def format_bytes(size):
+    for unit in ("B", "KB", "MB"):
+        if abs(size) < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.2f} GB"
+
+
+def _document_accounting(editor):
+    accounting = _Accounting()
+    accounting.add("current_image", _images_of(editor.current_image))
+    accounting.add("original_image", _images_of(editor.original_image))
+    accounting.add("pixmap", _images_of([editor.image_item, editor.composite_item]))
+    accounting.add("image_before_preview", _images_of(editor.image_before_preview))
+    accounting.add("pasted_items", _images_of(editor.layers))
+    history = []
+    for stack, commands in (("undo", editor.undo_stack), ("redo", editor.redo_stack)):
+        for index, command in enumerate(commands):
+            size = accounting.add(stack, command_images(command))
+            history.append((stack, index, type(command).__name__, size))
+    return accounting.totals, history
+
+
+def document_memory(editor):
+    """Return the bytes of image data an editor keeps alive, by category."""
+    return _document_accounting(editor)[0]
+
+
+def history_memory(editor):
+    """Return (stack, index, command name, bytes) for every history entry, largest first.
+
+    Bytes are those only the entry keeps alive; buffers shared with the
+    document or an earlier entry are not counted again.
+    """
+    return sorted(_document_accounting(editor)[1], key=lambda entry: entry[3], reverse=True)
+
+
+def _proc_status(field):
+    """Return a /proc/self/status field in bytes, or None where /proc is unavailable."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def current_rss():
+    """Return the resident set size of the process in bytes (0 if unknown)."""
+    rss = _proc_status("VmRSS")
+    if rss is not None:
+        return rss
+    return peak_rss()
+
+
+def peak_rss():
+    """Return the peak resident set size of the process in bytes (0 if unknown)."""
+    rss = _proc_status("VmHWM")
+    if rss is not None:
+        return rss
+    if resource is None:
+        return 0
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def reset_peak_rss():
+    """Reset the peak RSS to the current RSS; return False where that isn't supported."""
+    try:
+        with open(f"/proc/{os.getpid()}/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
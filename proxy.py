@@ -0,0 +1,115 @@
+import os
+from PyQt5.QtGui import QImage, QImageReader, QImageIOHandler
+from PyQt5.QtCore import QSize
+from PIL import Image
+from tracing import span, traced, instant
+
+# Images above this pixel count are opened as a reduced-resolution proxy
+PROXY_MAX_PIXELS = 4000000
+
+
+def proxy_size(full_size, max_pixels=PROXY_MAX_PIXELS):
+    """Return the proxy size for a source of full_size, keeping the aspect ratio."""
+    pixels = full_size.width() * full_size.height()
+    if pixels <= max_pixels:
+        return QSize(full_size)
+    factor = (max_pixels / pixels) ** 0.5
+    return QSize(max(1, int(full_size.width() * factor)), max(1, int(full_size.height() * factor)))
+
+
+def _read_scaled_with_pil(file_name, size):
+    """Decode a reduced image with PIL draft()/reduce() for formats Qt can't scale while decoding."""
+    with Image.open(file_name) as pil_img:
+        # draft() lets the JPEG decoder skip DCT coefficients; a no-op for other formats
+        pil_img.draft("RGB", (size.width(), size.height()))
+        factor = max(1, min(pil_img.width // size.width(), pil_img.height // size.height()))
+        if factor > 1:
+            # reduce() averages levels, which bitonal and palette images don't have
+            if pil_img.mode == "1":
+                pil_img = pil_img.convert("L")
+            elif pil_img.mode == "P":
+                pil_img = pil_img.convert("RGBA")
+            pil_img = pil_img.reduce(factor)
+        pil_img = pil_img.convert("RGBA").resize((size.width(), size.height()), Image.BILINEAR)
+        data = pil_img.tobytes()
+    return QImage(data, size.width(), size.height(), size.width() * 4, QImage.Format_RGBA8888).copy()
+
+
+@traced("read_proxy", "io")
+def read_proxy(file_name, max_pixels=PROXY_MAX_PIXELS):
+    """Decode a reduced-resolution version of an image file.
+
+    Returns (proxy_image, full_size); proxy_image is null on failure.
+    """
+    reader = QImageReader(file_name)
+    full_size = reader.size()
+    if not full_size.isValid():
+        return QImage(), full_size
+    size = proxy_size(full_size, max_pixels)
+    if size == full_size:
+        return reader.read(), full_size
+    if reader.supportsOption(QImageIOHandler.ScaledSize):
+        reader.setScaledSize(size)
+        image = reader.read()
+        if not image.isNull():
+            return image, full_size
+    try:
+        return _read_scaled_with_pil(file_name, size), full_size
+    except (OSError, ValueError) as e:
+        instant("proxy decode failed", "io", file=file_name, error=e)
+        return QImage(), full_size
+
+
+class ProxyDocument:
+    """A document edited on a reduced-resolution proxy of a large source file.
+
+    Edits are applied to the proxy interactively; render() decodes the
+    full-resolution source and replays the editor's commands on it. When the
+    source is memory-mapped (store), save() keeps the replay out of core for as
+    long as the commands can be expressed as views on the map.
+    """
+
+    def __init__(self, source_path, full_size, proxy_image_size, store=None):
+        self.source_path = source_path
+        self.full_size = full_size
+        self.store = store
+        # Factor that maps proxy coordinates to source coordinates
+        self.scale = full_size.width() / max(1, proxy_image_size.width())
+
+    def render(self, commands):
+        """Decode the source at full resolution and replay commands on it."""
+        return self._replay(self._decode(), commands)
+
+    @traced("ProxyDocument.save", "io")
+    def save(self, file_name, commands):
+        """Render the full-resolution result of commands into file_name, which mustn't be the source."""
+        # The next save would replay the same commands on the already edited file
+        if os.path.abspath(file_name) == os.path.abspath(self.source_path):
+            raise IOError("A proxy's source can't be overwritten in place; use Save As")
+        if self.store is None:
+            return self.render(commands).save(file_name)
+        store = self.store
+        for i, command in enumerate(commands):
+            with span(f"{type(command).__name__}.replay_view", "command"):
+                view = command.replay_view(store, self.scale)
+            if view is None:
+                # Not expressible as a view: continue on a heap copy of what we have
+                return self._replay(store.toImage(), commands[i:]).save(file_name)
+            store = view
+        with span("BackingStore.save", "io"):
+            return store.save(file_name)
+
+    @traced("ProxyDocument.decode", "io")
+    def _decode(self):
+        if self.store is not None:
+            return self.store.toImage()
+        image = QImage(self.source_path)
+        if image.isNull():
+            raise IOError(f"Failed to decode source image: {self.source_path}")
+        return image
+
+    def _replay(self, image, commands):
+        for command in commands:
+            with span(f"{type(command).__name__}.replay", "command"):
+                image = command.replay(image, self.scale)
+        return image
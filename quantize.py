@@ -0,0 +1,326 @@
+import math
+import numpy as np
+from PyQt5.QtGui import QImage, QPainter, qRgb
+from PyQt5.QtCore import Qt
+from imaging import image_array, convert_image, grayscale_image, conversion_counts, CV2_AVAILABLE
+from jobs import run_bands
+from tracing import span
+
+if CV2_AVAILABLE:
+    import cv2
+
+# Modes a document can be converted to, by the name the command and the config use
+MODES = {"palette": "8-bit Palette", "grayscale": "8-bit Grayscale", "mono": "1-bit Monochrome"}
+DEFAULT_MODE = "palette"
+
+# How the colours of an 8-bit palette are chosen
+PALETTE_METHODS = {"kmeans": "K-Means", "median_cut": "Median Cut"}
+DEFAULT_PALETTE_METHOD = "kmeans"
+DEFAULT_COLOURS = 256
+
+# Dithering of palette conversions
+DITHERS = {"none": "None", "bayer": "Ordered (Bayer)"}
+DEFAULT_DITHER = "none"
+
+# How grays become black or white in a 1-bit conversion
+THRESHOLDS = {"otsu": "Global (Otsu)", "adaptive": "Adaptive", "bayer": "Ordered Dither (Bayer)"}
+DEFAULT_THRESHOLD = "adaptive"
+
+# Adaptive thresholding compares each pixel with the mean of a block around
+# it, less an offset: text stays black on unevenly lit scans, paper turns white
+DEFAULT_BLOCK_SIZE = 31
+DEFAULT_OFFSET = 10
+
+# The palette is fitted to at most this many pixels, taken on a regular grid
+PALETTE_SAMPLE_PIXELS = 1 << 16
+KMEANS_ITERATIONS = 6
+
+# Pixels are mapped to the palette through a table of the nearest entry for
+# each cell of a grid with this many bits per channel (64³ cells)
+GRID_BITS = 6
+# Grid cells searched per band when the table is built
+GRID_BAND = 16384
+
+# 8x8 Bayer matrix, as thresholds in (0, 1)
+BAYER_MATRIX = (np.array([
+    [0, 32, 8, 40, 2, 34, 10, 42],
+    [48, 16, 56, 24, 50, 18, 58, 26],
+    [12, 44, 4, 36, 14, 46, 6, 38],
+    [60, 28, 52, 20, 62, 30, 54, 22],
+    [3, 35, 11, 43, 1, 33, 9, 41],
+    [51, 19, 59, 27, 49, 17, 57, 25],
+    [15, 47, 7, 39, 13, 45, 5, 37],
+    [63, 31, 55, 23, 61, 29, 53, 21]], dtype=np.float32) + 0.5) / 64
+
+# Colour table of 1-bit images: 0 is black, 1 white
+MONO_TABLE = [qRgb(0, 0, 0), qRgb(255, 255, 255)]
+
+
+class ModeConversion:
+    """Settings of a conversion to one of MODES.
+
+    colours, palette_method and dither apply to "palette"; threshold,
+    block_size (odd, in pixels) and offset (in gray levels) to "mono".
+    """
+
+    def __init__(self, mode=DEFAULT_MODE, colours=DEFAULT_COLOURS, palette_method=DEFAULT_PALETTE_METHOD,
+                 dither=DEFAULT_DITHER, threshold=DEFAULT_THRESHOLD, block_size=DEFAULT_BLOCK_SIZE,
+                 offset=DEFAULT_OFFSET):
+        self.mode = mode
+        self.colours = colours
+        self.palette_method = palette_method
+        self.dither = dither
+        self.threshold = threshold
+        self.block_size = block_size
+        self.offset = offset
+
+    def description(self):
+        if self.mode == "palette":
+            return f"{self.colours}-color palette"
+        return MODES[self.mode].lower()
+
+
+def _opaque(image):
+    """Return image as RGB32; transparent areas become white, as in imaging.restore_format()."""
+    if not image.hasAlphaChannel():
+        return convert_image(image, QImage.Format_RGB32, "quantize")
+    conversion_counts["quantize"] += 1
+    flattened = QImage(image.size(), QImage.Format_RGB32)
+    flattened.fill(Qt.white)
+    painter = QPainter(flattened)
+    painter.drawImage(0, 0, image)
+    painter.end()
+    return flattened
+
+
+def _gray(image):
+    """Return image as Format_Grayscale8."""
+    if image.format() == QImage.Format_Grayscale8:
+        return image
+    # Palette images would keep their indices in grayscale_image()
+    return grayscale_image(_opaque(image))
+
+
+def _sample(pixels, count):
+    """Return up to count pixels of pixels (height, width, channels) on a regular grid, as (n, channels)."""
+    step = max(1, math.ceil(math.sqrt(pixels.shape[0] * pixels.shape[1] / count)))
+    return pixels[::step, ::step].reshape(-1, pixels.shape[2])
+
+
+def median_cut(colours, count):
+    """Return a palette of at most count colours for colours (an (n, 3) array), by median cut.
+
+    The box with the most pixels times its widest channel range is split
+    at its median until there are count boxes; each gives its mean colour.
+    """
+    boxes, scores, channels = [], [], []
+
+    def add(box):
+        ranges = np.ptp(box, axis=0)
+        boxes.append(box)
+        scores.append(len(box) * float(ranges.max()))
+        channels.append(int(ranges.argmax()))
+
+    add(np.asarray(colours, dtype=np.float32))
+    while len(boxes) < count:
+        index = max(range(len(boxes)), key=scores.__getitem__)
+        if scores[index] == 0:
+            break
+        box, channel = boxes.pop(index), channels.pop(index)
+        scores.pop(index)
+        middle = len(box) // 2
+        order = np.argpartition(box[:, channel], middle)
+        add(box[order[:middle]])
+        add(box[order[middle:]])
+    return np.array([box.mean(axis=0) for box in boxes], dtype=np.float32)
+
+
+def nearest(colours, palette):
+    """Return the index of the palette entry nearest to each of colours (float32 (n, 3) arrays)."""
+    # |c - p|² = |c|² - 2 c·p + |p|²; |c|² is the same for every entry
+    weights = -2 * palette.T
+    norms = (palette * palette).sum(axis=1)
+    labels = np.empty(len(colours), dtype=np.intp)
+    # In blocks, so the distances of a block stay small
+    for i in range(0, len(colours), GRID_BAND):
+        distances = colours[i:i + GRID_BAND] @ weights
+        distances += norms
+        labels[i:i + GRID_BAND] = distances.argmin(axis=1)
+    return labels
+
+
+def kmeans(colours, count, iterations=KMEANS_ITERATIONS, token=None):
+    """Return a palette of at most count colours for colours (an (n, 3) array), by k-means.
+
+    Starts from the median cut palette, so few iterations are needed and
+    the result is the same on every run.
+    """
+    colours = np.asarray(colours, dtype=np.float32)
+    palette = median_cut(colours, count)
+    for _ in range(iterations):
+        if token is not None:
+            token.check()
+        labels = nearest(colours, palette)
+        counts = np.bincount(labels, minlength=len(palette))
+        used = counts > 0
+        for channel in range(3):
+            sums = np.bincount(labels, colours[:, channel], minlength=len(palette))
+            # Entries nothing is nearest to keep their colour
+            palette[used, channel] = sums[used] / counts[used]
+    return palette
+
+
+def fit_palette(image, count=DEFAULT_COLOURS, method=DEFAULT_PALETTE_METHOD, token=None):
+    """Return a palette (a float32 (n, 3) R, G, B array, n <= count) for image, fitted to a sample of its pixels."""
+    image = _opaque(image)
+    pixels = image_array(image)
+    # Memory order is B, G, R, A
+    sample = _sample(pixels, PALETTE_SAMPLE_PIXELS)[:, 2::-1]
+    with span("fit palette", "quantize", method=method, colours=count, samples=len(sample)):
+        if method == "median_cut":
+            return median_cut(sample, count)
+        return kmeans(sample, count, token=token)
+
+
+def _grid_table(palette, token=None, progress=None):
+    """Return the nearest palette entry for every cell of the GRID_BITS colour grid, indexed by R, G, B bits."""
+    cells = 1 << (3 * GRID_BITS)
+    levels = 1 << GRID_BITS
+    # Cells are looked up by their centre
+    width = 256 // levels
+    centres = np.arange(levels, dtype=np.float32) * width + (width - 1) / 2
+    table = np.empty(cells, dtype=np.uint8)
+
+    def search(i0, i1):
+        index = np.arange(i0, i1)
+        cell = np.stack([centres[index >> (2 * GRID_BITS)], centres[(index >> GRID_BITS) & (levels - 1)],
+                         centres[index & (levels - 1)]], axis=1)
+        table[i0:i1] = nearest(cell, palette)
+
+    run_bands(search, cells, token, progress, GRID_BAND)
+    return table
+
+
+def _bayer_offsets(y0, y1, width):
+    """Return the Bayer thresholds, centred on 0, for rows y0..y1 of an image width pixels wide."""
+    rows = BAYER_MATRIX[np.arange(y0, y1) % 8]
+    return np.tile(rows, (1, width // 8 + 1))[:, :width] - 0.5
+
+
+def quantize_image(image, palette, dither=DEFAULT_DITHER, token=None, progress=None):
+    """Return image as Format_Indexed8 with the colours of palette (an (n, 3) R, G, B array, n <= 256).
+
+    Each pixel takes the entry nearest to it, looked up band by band in
+    parallel in a grid table. Ordered dithering spreads the pixels by
+    about the spacing of the palette's colours before the look-up.
+    """
+    palette = np.asarray(palette, dtype=np.float32)
+    image = _opaque(image)
+    pixels = image_array(image).view(np.uint32)[..., 0]
+    result = QImage(image.width(), image.height(), QImage.Format_Indexed8)
+    out = image_array(result, writable=True)
+    table = _grid_table(palette, token, progress and (lambda done: progress(done / 2)))
+    shift = 8 - GRID_BITS
+    mask = (1 << GRID_BITS) - 1
+    spread = 255 / len(palette) ** (1 / 3)
+
+    def map_band(y0, y1):
+        band = pixels[y0:y1]
+        if dither == "bayer":
+            offsets = (_bayer_offsets(y0, y1, band.shape[1]) * spread).astype(np.int32)
+            channels = [np.clip(((band >> bits) & 0xFF).astype(np.int32) + offsets, 0, 255) >> shift
+                        for bits in (16, 8, 0)]
+            cell = (channels[0] << (2 * GRID_BITS)) | (channels[1] << GRID_BITS) | channels[2]
+        else:
+            # R, G, B bits straight out of 0xAARRGGBB
+            cell = (((band >> (16 + shift - 2 * GRID_BITS)) & (mask << (2 * GRID_BITS)))
+                    | ((band >> (8 + shift - GRID_BITS)) & (mask << GRID_BITS)) | ((band >> shift) & mask))
+        out[y0:y1] = table[cell]
+
+    with span("map to palette", "quantize", width=image.width(), height=image.height(), dither=dither):
+        run_bands(map_band, image.height(), token, progress and (lambda done: progress(0.5 + done / 2)))
+    result.setColorTable([qRgb(*(int(v) for v in np.rint(np.clip(colour, 0, 255)))) for colour in palette])
+    return result
+
+
+def otsu_threshold(gray):
+    """Return the gray level that best separates the histogram of gray (uint8) into two classes.
+
+    Levels up to and including it form the dark class. Images of a single
+    level can't be split and are divided at mid-gray.
+    """
+    sample = _sample(gray[..., np.newaxis], PALETTE_SAMPLE_PIXELS * 8)
+    histogram = np.bincount(sample.ravel(), minlength=256).astype(np.float64)
+    levels = np.arange(256)
+    weight = np.cumsum(histogram)
+    total = weight[-1]
+    mean = np.cumsum(histogram * levels)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        between = (mean[-1] * weight - mean * total) ** 2 / (weight * (total - weight))
+    if np.isnan(between).all():
+        return 127
+    return int(np.nanargmax(between))
+
+
+def _box_mean(gray, size):
+    """Return the mean of the size x size block around each pixel of gray, edges replicated."""
+    if CV2_AVAILABLE:
+        return cv2.blur(gray, (size, size), borderType=cv2.BORDER_REPLICATE)
+    radius = size // 2
+    padded = np.pad(gray.astype(np.uint32), radius, mode="edge")
+    integral = np.pad(padded.cumsum(0).cumsum(1), ((1, 0), (1, 0)))
+    sums = integral[size:, size:] - integral[:-size, size:] - integral[size:, :-size] + integral[:-size, :-size]
+    return (sums // (size * size)).astype(np.uint8)
+
+
+def threshold_image(image, threshold=DEFAULT_THRESHOLD, block_size=DEFAULT_BLOCK_SIZE, offset=DEFAULT_OFFSET,
+                    token=None, progress=None):
+    """Return image as Format_Mono, band by band in parallel.
+
+    "otsu" splits all pixels at one level, "adaptive" compares each with the
+    mean of the block_size block around it less offset, and "bayer" dithers
+    the grays with the ordered dither matrix.
+    """
+    image = _gray(image)
+    gray = image_array(image)
+    height, width = gray.shape
+    # Rows are padded to 32 bits, as QImage keeps them
+    packed = np.zeros((height, (width + 31) // 32 * 4), dtype=np.uint8)
+    level = otsu_threshold(gray) if threshold == "otsu" else None
+    block_size = max(3, block_size | 1)
+    halo = block_size // 2
+
+    def threshold_band(y0, y1):
+        if threshold == "adaptive":
+            # The blocks reach halo rows into the neighbouring bands
+            top, bottom = max(0, y0 - halo), min(height, y1 + halo)
+            mean = _box_mean(gray[top:bottom], block_size)[y0 - top:y1 - top]
+            white = gray[y0:y1].astype(np.int16) > mean.astype(np.int16) - offset
+        elif threshold == "bayer":
+            white = gray[y0:y1] > (_bayer_offsets(y0, y1, width) + 0.5) * 255
+        else:
+            white = gray[y0:y1] > level
+        bits = np.packbits(white, axis=1)
+        packed[y0:y1, :bits.shape[1]] = bits
+
+    with span("threshold", "quantize", width=width, height=height, threshold=threshold):
+        run_bands(threshold_band, height, token, progress)
+    result = QImage(packed.data, width, height, packed.strides[0], QImage.Format_Mono).copy()
+    result.setColorTable(MONO_TABLE)
+    return result
+
+
+def convert_mode(image, conversion, scale=1.0, token=None, progress=None):
+    """Return image converted as conversion (a ModeConversion) says.
+
+    scale maps proxy coordinates to image's and grows the adaptive
+    threshold's block with it.
+    """
+    if conversion.mode == "grayscale":
+        return _gray(image).copy()
+    if conversion.mode == "mono":
+        return threshold_image(image, conversion.threshold, round(conversion.block_size * scale), conversion.offset,
+                               token, progress)
+    image = _opaque(image)
+    palette = fit_palette(image, conversion.colours, conversion.palette_method, token)
+    return quantize_image(image, palette, conversion.dither, token, progress)
@@ -0,0 +1,145 @@
+import numpy as np
+from PyQt5.QtGui import QImage
+from imaging import image_array, convert_image, is_palette
+from jobs import run_bands, BAND_ROWS
+
+# Side of the square blocks the summed-area tables are built over, in pixels
+BLOCK_SIZE = 16
+
+
+class RegionStatistics:
+    """Per-channel mean, standard deviation, minimum and maximum of image rectangles.
+
+    Sums and squared sums are kept as summed-area tables over BLOCK_SIZE
+    blocks (a full-resolution 64-bit table of a 45 MP scan would take
+    gigabytes), and block minima and maxima as sparse tables along each
+    block row. A rectangle reads its whole blocks from the tables and only
+    the pixels of the partial blocks along its edges, so the cost follows
+    its perimeter, not its area. Results are exact.
+    """
+
+    def __init__(self, image, token=None, progress=None):
+        self.key = image.cacheKey()
+        if is_palette(image):
+            image = convert_image(image, QImage.Format_RGB32, "statistics")
+        # Keeps the pixels alive; QImage sharing makes this free until the document changes
+        self.image = image
+        pixels = image_array(image)
+        if pixels.ndim == 2:
+            self.pixels = pixels[:, :, np.newaxis]
+            self.channels = (("L", 0),)
+        else:
+            # Memory order is BGRA; alpha is left out of the results
+            self.pixels = pixels
+            self.channels = (("R", 2), ("G", 1), ("B", 0))
+        height, width, channels = self.pixels.shape
+        self.blocks_y, self.blocks_x = height // BLOCK_SIZE, width // BLOCK_SIZE
+        shape = (self.blocks_y, self.blocks_x, channels)
+        sums = np.zeros(shape, dtype=np.int64)
+        squares = np.zeros(shape, dtype=np.int64)
+        block_min = np.zeros(shape, dtype=np.uint8)
+        block_max = np.zeros(shape, dtype=np.uint8)
+
+        def reduce_blocks(by0, by1):
+            rows = self.pixels[by0 * BLOCK_SIZE:by1 * BLOCK_SIZE, :self.blocks_x * BLOCK_SIZE]
+            rows = rows.reshape(by1 - by0, BLOCK_SIZE, self.blocks_x * BLOCK_SIZE, channels)
+            values = rows.astype(np.uint32)
+            sums[by0:by1] = _reduce_blocks(values.sum(axis=1), np.sum)
+            values *= values
+            squares[by0:by1] = _reduce_blocks(values.sum(axis=1, dtype=np.int64), np.sum)
+            block_min[by0:by1] = _reduce_blocks(rows.min(axis=1), np.min)
+            block_max[by0:by1] = _reduce_blocks(rows.max(axis=1), np.max)
+        run_bands(reduce_blocks, self.blocks_y, token, progress, band_rows=max(1, BAND_ROWS // BLOCK_SIZE))
+        self.sum_table = _summed_area_table(sums)
+        self.square_table = _summed_area_table(squares)
+        self.min_table = _sparse_table(block_min, np.minimum)
+        self.max_table = _sparse_table(block_max, np.maximum)
+
+    def matches(self, image):
+        return image is not None and image.cacheKey() == self.key
+
+    def rect_statistics(self, rect):
+        """Return [(channel, mean, std, min, max)] for a QRect, or None if it's empty."""
+        height, width, channels = self.pixels.shape
+        x0, y0 = max(0, rect.left()), max(0, rect.top())
+        x1, y1 = min(width, rect.right() + 1), min(height, rect.bottom() + 1)
+        if x1 <= x0 or y1 <= y0:
+            return None
+        count = 0
+        total = np.zeros(channels, dtype=np.int64)
+        squares = np.zeros(channels, dtype=np.int64)
+        low = np.full(channels, 255, dtype=np.uint8)
+        high = np.zeros(channels, dtype=np.uint8)
+        # Whole blocks inside the rectangle
+        bx0, by0 = -(-x0 // BLOCK_SIZE), -(-y0 // BLOCK_SIZE)
+        bx1, by1 = min(x1 // BLOCK_SIZE, self.blocks_x), min(y1 // BLOCK_SIZE, self.blocks_y)
+        if bx1 > bx0 and by1 > by0:
+            total += _table_sum(self.sum_table, bx0, by0, bx1, by1)
+            squares += _table_sum(self.square_table, bx0, by0, bx1, by1)
+            low = np.minimum(low, _table_extreme(self.min_table, np.minimum, bx0, by0, bx1, by1))
+            high = np.maximum(high, _table_extreme(self.max_table, np.maximum, bx0, by0, bx1, by1))
+            count += (bx1 - bx0) * (by1 - by0) * BLOCK_SIZE * BLOCK_SIZE
+            inner_x0, inner_y0 = bx0 * BLOCK_SIZE, by0 * BLOCK_SIZE
+            inner_x1, inner_y1 = bx1 * BLOCK_SIZE, by1 * BLOCK_SIZE
+            strips = ((y0, inner_y0, x0, x1), (inner_y1, y1, x0, x1),
+                      (inner_y0, inner_y1, x0, inner_x0), (inner_y0, inner_y1, inner_x1, x1))
+        else:
+            strips = ((y0, y1, x0, x1),)
+        # Pixels of the partial blocks around them, reduced one axis at a time
+        # since that's much faster than over both at once on a strided view
+        for top, bottom, left, right in strips:
+            if bottom <= top or right <= left:
+                continue
+            strip = self.pixels[top:bottom, left:right]
+            total += strip.sum(axis=0, dtype=np.int64).sum(axis=0)
+            values = strip.astype(np.uint32)
+            values *= values
+            squares += values.sum(axis=0, dtype=np.int64).sum(axis=0)
+            low = np.minimum(low, strip.min(axis=0).min(axis=0))
+            high = np.maximum(high, strip.max(axis=0).max(axis=0))
+            count += (bottom - top) * (right - left)
+        mean = total / count
+        std = np.sqrt(np.maximum(squares / count - mean * mean, 0))
+        return [(name, float(mean[i]), float(std[i]), int(low[i]), int(high[i])) for name, i in self.channels]
+
+
+def _reduce_blocks(columns, reduce):
+    """Reduce (block rows, width, c) column results over the BLOCK_SIZE columns of each block."""
+    block_rows, width, channels = columns.shape
+    return reduce(columns.reshape(block_rows, width // BLOCK_SIZE, BLOCK_SIZE, channels), axis=2)
+
+
+def _summed_area_table(values):
+    """Return the inclusive prefix sums of a (h, w, c) array with a zero row and column in front."""
+    table = np.zeros((values.shape[0] + 1, values.shape[1] + 1, values.shape[2]), dtype=np.int64)
+    np.cumsum(values, axis=0, out=table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+    return table
+
+
+def _table_sum(table, x0, y0, x1, y1):
+    return table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]
+
+
+def _sparse_table(values, combine):
+    """Return levels where level k holds combine() over the 2**k columns starting at each column."""
+    levels = [values]
+    span = 1
+    while 2 * span <= values.shape[1]:
+        previous = levels[-1]
+        levels.append(combine(previous[:, :-span], previous[:, span:]))
+        span *= 2
+    return levels
+
+
+def _table_extreme(levels, combine, x0, y0, x1, y1):
+    """Return combine() over a block range of a sparse table: two overlapping columns per row."""
+    level = (x1 - x0).bit_length() - 1
+    table = levels[level]
+    rows = combine(table[y0:y1, x0], table[y0:y1, x1 - (1 << level)])
+    return combine.reduce(rows, axis=0)
+
+
+def format_statistics(statistics):
+    """Return a short status bar text for rect_statistics() results."""
+    return "  ".join(f"{name} {mean:.1f}±{std:.1f} [{low}–{high}]" for name, mean, std, low, high in statistics)
@@ -0,0 +1,376 @@
+import math
+import numpy as np
+from PIL import Image
+from PyQt5.QtGui import QImage, QPainter, QTransform
+from PyQt5.QtCore import Qt
+from imaging import CV2_AVAILABLE, image_array, working_format, convert_image, restore_format, is_palette
+from jobs import run_bands, BAND_ROWS
+from tracing import span
+
+if CV2_AVAILABLE:
+    import cv2
+
+# Resize modes, in the order the resize dialog lists them
+RESIZE_MODES = {
+    "nearest": "Nearest neighbour (fastest)",
+    "bilinear": "Bilinear",
+    "area": "Area average (best for shrinking)",
+    "lanczos": "Lanczos (sharp)",
+    "pyramid": "Pyramid (fast large reductions)",
+}
+DEFAULT_RESIZE_MODE = "area"
+
+if CV2_AVAILABLE:
+    _INTERPOLATION = {
+        "nearest": cv2.INTER_NEAREST,
+        "bilinear": cv2.INTER_LINEAR,
+        "area": cv2.INTER_AREA,
+    }
+
+# Source rows each interpolation reads beyond the rows a band maps to
+_SUPPORT = {"nearest": 0, "bilinear": 1, "area": 1}
+
+# Pillow modes that resample a pixel array as it is, without converting it
+_PIL_MODES = {1: "L", 4: "RGBa"}
+
+# Columns per band in the vertical pass of a two-pass resize
+BAND_COLUMNS = 256
+
+# Rows of context kept around a band for pyrDown's 5-tap kernel
+_PYRAMID_MARGIN = 4
+
+
+def _steps(fraction_start, fraction_end, progress):
+    """Map the progress of one pass to its share of the whole operation."""
+    if progress is None:
+        return None
+    return lambda fraction: progress(fraction_start + fraction * (fraction_end - fraction_start))
+
+
+def _aligned_step(src_height, dst_height):
+    """Return (source rows, output rows) of the smallest exact vertical step.
+
+    A band that starts and ends on these steps sees exactly the scale and
+    sample positions of the whole image, so resizing it on its own gives the
+    same rows as resizing everything at once.
+    """
+    divisor = math.gcd(src_height, dst_height)
+    return src_height // divisor, dst_height // divisor
+
+
+def _resize_aligned(src, out, mode, token, progress):
+    """Resize in bands of output rows that start on exact source rows."""
+    height, width = out.shape[:2]
+    src_step, dst_step = _aligned_step(src.shape[0], height)
+    interpolation = _INTERPOLATION[mode]
+    # Whole steps of context, so a band's own border handling never shows
+    context = -(-_SUPPORT[mode] // src_step) * dst_step
+
+    def resize_band(y0, y1):
+        top = max(0, y0 - context)
+        bottom = min(height, y1 + context)
+        band = src[top * src_step // dst_step:bottom * src_step // dst_step]
+        resized = cv2.resize(band, (width, bottom - top), interpolation=interpolation)
+        out[y0:y1] = resized[y0 - top:y1 - top].reshape(out[y0:y1].shape)
+    run_bands(resize_band, height, token, progress, band_rows=max(1, BAND_ROWS // dst_step) * dst_step)
+
+
+def _resize_separable(src, out, mode, token, progress):
+    """Resize horizontally in row bands, then vertically in column bands.
+
+    The other axis keeps a scale of exactly 1 in each pass, so banding
+    doesn't change the result.
+    """
+    height, width = out.shape[:2]
+    interpolation = _INTERPOLATION[mode]
+    intermediate = np.empty((src.shape[0], width) + src.shape[2:], dtype=np.uint8)
+
+    def resize_rows(y0, y1):
+        resized = cv2.resize(src[y0:y1], (width, y1 - y0), interpolation=interpolation)
+        intermediate[y0:y1] = resized.reshape(intermediate[y0:y1].shape)
+    run_bands(resize_rows, src.shape[0], token, _steps(0.0, 0.5, progress))
+
+    def resize_columns(x0, x1):
+        band = np.ascontiguousarray(intermediate[:, x0:x1])
+        resized = cv2.resize(band, (x1 - x0, height), interpolation=interpolation)
+        out[:, x0:x1] = resized.reshape(out[:, x0:x1].shape)
+    run_bands(resize_columns, width, token, _steps(0.5, 1.0, progress), band_rows=BAND_COLUMNS)
+
+
+def _resize_lanczos(src, out, token, progress):
+    """Resize with Pillow's Lanczos filter, in bands of output rows.
+
+    Unlike OpenCV's fixed 8-tap Lanczos, Pillow widens the kernel when
+    shrinking, so fine detail averages out instead of aliasing. Each band
+    passes its source rows as a box; Pillow reads the rows around it itself.
+    """
+    height, width = out.shape[:2]
+    src = np.ascontiguousarray(src)
+    src_height, src_width = src.shape[:2]
+    mode = _PIL_MODES[src.shape[2] if src.ndim == 3 else 1]
+    source = Image.frombuffer(mode, (src_width, src_height), src, "raw", mode, 0, 1)
+    scale = src_height / height
+
+    def resize_band(y0, y1):
+        band = source.resize((width, y1 - y0), Image.LANCZOS, box=(0, y0 * scale, src_width, y1 * scale))
+        out[y0:y1] = np.asarray(band).reshape(out[y0:y1].shape)
+    run_bands(resize_band, height, token, progress)
+
+
+def _pyr_down(src, token=None, progress=None):
+    """Halve src with a Gaussian pyramid step, in parallel bands."""
+    height, width = src.shape[:2]
+    out = np.empty(((height + 1) // 2, (width + 1) // 2) + src.shape[2:], dtype=src.dtype)
+
+    def reduce_band(y0, y1):
+        # The margin is even, so the reduced band starts on an output row
+        top = max(0, 2 * y0 - _PYRAMID_MARGIN)
+        bottom = min(height, 2 * y1 + _PYRAMID_MARGIN)
+        reduced = cv2.pyrDown(src[top:bottom]).reshape((-1,) + out.shape[1:])
+        first = (2 * y0 - top) // 2
+        out[y0:y1] = reduced[first:first + y1 - y0]
+    run_bands(reduce_band, out.shape[0], token, progress)
+    return out
+
+
+def resize_pixels(pixels, width, height, mode=DEFAULT_RESIZE_MODE, token=None, progress=None, out=None):
+    """Resize a (h, w) or (h, w, c) uint8 array to width x height, into out if given."""
+    if out is None:
+        out = np.empty((height, width) + pixels.shape[2:], dtype=np.uint8)
+    if mode == "pyramid":
+        # Halve while the image is more than twice too large, then finish with an area average
+        levels = 0
+        h, w = pixels.shape[:2]
+        while h >= 4 * height and w >= 4 * width:
+            h, w = (h + 1) // 2, (w + 1) // 2
+            levels += 1
+        for level in range(levels):
+            pixels = _pyr_down(pixels, token, _steps(level / (levels + 1), (level + 1) / (levels + 1), progress))
+        progress = _steps(levels / (levels + 1), 1.0, progress)
+        mode = "area"
+    if mode == "lanczos":
+        _resize_lanczos(pixels, out, token, progress)
+        return out
+    src_step, dst_step = _aligned_step(pixels.shape[0], height)
+    if dst_step <= BAND_ROWS and height >= 2 * dst_step:
+        _resize_aligned(pixels, out, mode, token, progress)
+    else:
+        _resize_separable(pixels, out, mode, token, progress)
+    return out
+
+
+def resize_image(image, width, height, mode=DEFAULT_RESIZE_MODE, token=None, progress=None):
+    """Return image resized to width x height with the given mode (see RESIZE_MODES).
+
+    Colour images are resampled in the working format, premultiplied when they
+    have alpha; palette images are resampled in 32 bits and converted back.
+    token and progress are checked and updated between bands.
+    """
+    if mode not in RESIZE_MODES:
+        raise ValueError(f"Unknown resize mode: {mode}")
+    with span("resize", "resample", mode=mode, width=width, height=height):
+        if not CV2_AVAILABLE and mode != "lanczos":
+            transformation = Qt.FastTransformation if mode == "nearest" else Qt.SmoothTransformation
+            return restore_format(image.scaled(width, height, Qt.IgnoreAspectRatio, transformation), image)
+        if is_palette(image):
+            source_format = QImage.Format_ARGB32_Premultiplied if image.hasAlphaChannel() else QImage.Format_RGB32
+        else:
+            source_format = working_format(image)
+        source = convert_image(image, source_format, "resize")
+        result = QImage(width, height, source.format())
+        resize_pixels(image_array(source), width, height, mode, token, progress, image_array(result, writable=True))
+        return restore_format(result, image)
+
+
+# Interpolations for arbitrary rotation, in the order the rotation dialog lists them
+ROTATION_INTERPOLATIONS = {
+    "nearest": "Nearest neighbour",
+    "bilinear": "Bilinear",
+    "bicubic": "Bicubic",
+    "lanczos": "Lanczos",
+}
+DEFAULT_ROTATION_INTERPOLATION = "bilinear"
+
+# What fills the corners a rotation uncovers
+ROTATION_FILLS = {
+    "transparent": "Transparent",
+    "white": "White",
+    "black": "Black",
+    "edge": "Extend edges",
+    "crop": "Crop to largest rectangle",
+}
+DEFAULT_ROTATION_FILL = "transparent"
+
+if CV2_AVAILABLE:
+    _WARP_INTERPOLATION = {
+        "nearest": cv2.INTER_NEAREST,
+        "bilinear": cv2.INTER_LINEAR,
+        "bicubic": cv2.INTER_CUBIC,
+        "lanczos": cv2.INTER_LANCZOS4,
+    }
+
+# cv2.remap addresses source pixels with 16-bit coordinates
+_WARP_MAX_SIZE = 32767
+
+
+def rotated_size(width, height, degrees):
+    """Return the size of the bounding box of a width x height image rotated by degrees."""
+    radians = math.radians(degrees)
+    cos, sin = abs(math.cos(radians)), abs(math.sin(radians))
+    # Tolerate rounding so e.g. 90 degrees doesn't grow a pixel
+    return (max(1, math.ceil(width * cos + height * sin - 1e-6)),
+            max(1, math.ceil(width * sin + height * cos - 1e-6)))
+
+
+def largest_valid_rect(width, height, degrees):
+    """Return the size of the largest axis-aligned rectangle inside the rotated image.
+
+    The rectangle is centred on the rotated image and contains no uncovered corners.
+    """
+    radians = math.radians(degrees)
+    cos, sin = abs(math.cos(radians)), abs(math.sin(radians))
+    if sin < 1e-9 or cos < 1e-9:
+        return (width, height) if sin < 1e-9 else (height, width)
+    long_side, short_side = max(width, height), min(width, height)
+    if short_side <= 2 * sin * cos * long_side or abs(sin - cos) < 1e-9:
+        # Two corners of the rectangle touch the long sides of the rotated image
+        half = short_side / 2
+        crop_width, crop_height = (half / sin, half / cos) if width >= height else (half / cos, half / sin)
+    else:
+        cos_2a = cos * cos - sin * sin
+        crop_width = (width * cos - height * sin) / cos_2a
+        crop_height = (height * cos - width * sin) / cos_2a
+    return max(1, math.floor(crop_width + 1e-6)), max(1, math.floor(crop_height + 1e-6))
+
+
+def rotation_matrix(width, height, degrees, out_width, out_height):
+    """Return the 2x3 affine matrix rotating a width x height image clockwise by degrees
+    about its centre into the centre of an out_width x out_height image.
+    """
+    # OpenCV turns counter-clockwise for positive angles; QTransform().rotate() turns clockwise
+    matrix = cv2.getRotationMatrix2D(((width - 1) / 2, (height - 1) / 2), -degrees, 1.0)
+    matrix[0, 2] += (out_width - width) / 2
+    matrix[1, 2] += (out_height - height) / 2
+    return matrix
+
+
+def _rotate_with_qt(image, degrees, fill):
+    """Rotate with QImage.transformed for right angles, or when OpenCV isn't available."""
+    rotated = image.transformed(QTransform().rotate(degrees), Qt.SmoothTransformation)
+    if degrees % 90 == 0:
+        return rotated
+    if fill == "crop":
+        crop_width, crop_height = largest_valid_rect(image.width(), image.height(), degrees)
+        rotated = rotated.copy((rotated.width() - crop_width) // 2, (rotated.height() - crop_height) // 2,
+                               crop_width, crop_height)
+    elif fill in ("white", "black"):
+        background = QImage(rotated.size(), QImage.Format_RGB32)
+        background.fill(Qt.white if fill == "white" else Qt.black)
+        painter = QPainter(background)
+        painter.drawImage(0, 0, rotated)
+        painter.end()
+        rotated = background
+    return restore_format(rotated, image)
+
+
+def rotate_image(image, degrees, interpolation=DEFAULT_ROTATION_INTERPOLATION, fill=DEFAULT_ROTATION_FILL,
+                 token=None, progress=None):
+    """Return image rotated clockwise by degrees (see ROTATION_INTERPOLATIONS and ROTATION_FILLS).
+
+    The result is the bounding box of the rotated image, or the largest
+    rectangle without uncovered corners for the "crop" fill. Right angles are
+    rotated exactly; other angles are warped in parallel bands of output rows.
+    """
+    if interpolation not in ROTATION_INTERPOLATIONS:
+        raise ValueError(f"Unknown rotation interpolation: {interpolation}")
+    if fill not in ROTATION_FILLS:
+        raise ValueError(f"Unknown rotation fill: {fill}")
+    with span("rotate", "resample", degrees=degrees, interpolation=interpolation, fill=fill):
+        if (degrees % 90 == 0 or not CV2_AVAILABLE
+                or max(image.width(), image.height()) > _WARP_MAX_SIZE):
+            return _rotate_with_qt(image, degrees, fill)
+        width, height = image.width(), image.height()
+        if fill == "crop":
+            out_width, out_height = largest_valid_rect(width, height, degrees)
+        else:
+            out_width, out_height = rotated_size(width, height, degrees)
+        matrix = rotation_matrix(width, height, degrees, out_width, out_height)
+        return _warp(image, matrix, out_width, out_height, interpolation, fill, token, progress)
+
+
+def corrected_size(corners):
+    """Return the (width, height) of the rectangle a quadrilateral straightens to.
+
+    corners are its (x, y) top-left, top-right, bottom-right and bottom-left
+    corners; the rectangle takes the longer of each pair of opposite sides.
+    """
+    (x0, y0), (x1, y1), (x2, y2), (x3, y3) = corners
+    width = max(math.hypot(x1 - x0, y1 - y0), math.hypot(x2 - x3, y2 - y3))
+    height = max(math.hypot(x3 - x0, y3 - y0), math.hypot(x2 - x1, y2 - y1))
+    return max(1, round(width)), max(1, round(height))
+
+
+def perspective_image(image, corners, size=None, interpolation=DEFAULT_ROTATION_INTERPOLATION, fill="edge",
+                      token=None, progress=None):
+    """Return the quadrilateral of image with corners (see corrected_size()) mapped onto a rectangle.
+
+    The rectangle is size (width, height), or corrected_size(corners). It
+    is warped in parallel bands of output rows; fill is one of
+    ROTATION_FILLS for what lies outside image.
+    """
+    if interpolation not in ROTATION_INTERPOLATIONS:
+        raise ValueError(f"Unknown interpolation: {interpolation}")
+    if fill not in ROTATION_FILLS:
+        raise ValueError(f"Unknown fill: {fill}")
+    if not CV2_AVAILABLE:
+        raise RuntimeError("Perspective correction requires OpenCV (cv2)")
+    if max(image.width(), image.height()) > _WARP_MAX_SIZE:
+        raise ValueError(f"Images over {_WARP_MAX_SIZE} pixels on a side can't be warped")
+    width, height = size or corrected_size(corners)
+    # Corners are in image coordinates, where pixel (0, 0) spans 0..1; OpenCV puts its centre at 0
+    source = np.array(corners, dtype=np.float32) - 0.5
+    target = np.array([(0, 0), (width, 0), (width, height), (0, height)], dtype=np.float32) - 0.5
+    matrix = cv2.getPerspectiveTransform(source, target)
+    with span("perspective", "resample", width=width, height=height, interpolation=interpolation):
+        return _warp(image, matrix, width, height, interpolation, fill, token, progress)
+
+
+def _warp(image, matrix, out_width, out_height, interpolation, fill, token=None, progress=None):
+    """Warp image into an out_width x out_height image in parallel bands of output rows.
+
+    matrix maps image's pixels to the result's: a 2x3 affine or a 3x3
+    perspective matrix. The result is in image's compact format, if any.
+    """
+    if image.format() == QImage.Format_Grayscale8:
+        # No alpha to fill with: transparent corners become white, as for other compact images
+        source = image
+        out_format = image.format()
+        border_value = 0 if fill == "black" else 255
+    else:
+        if is_palette(image):
+            colour_format = QImage.Format_ARGB32_Premultiplied if image.hasAlphaChannel() else QImage.Format_RGB32
+        else:
+            colour_format = working_format(image)
+        source = convert_image(image, colour_format, "rotate")
+        # RGB32 pixels are already valid premultiplied ARGB, so transparent corners need no conversion
+        out_format = QImage.Format_ARGB32_Premultiplied if fill == "transparent" else source.format()
+        border_value = {"transparent": (0, 0, 0, 0), "black": (0, 0, 0, 255)}.get(fill, (255, 255, 255, 255))
+    border_mode = cv2.BORDER_REPLICATE if fill in ("edge", "crop") else cv2.BORDER_CONSTANT
+    affine = matrix.shape[0] == 2
+    matrix = np.vstack([matrix, (0, 0, 1)]) if affine else np.asarray(matrix, dtype=np.float64)
+    pixels = image_array(source)
+    result = QImage(out_width, out_height, out_format)
+    out = image_array(result, writable=True)
+
+    def warp_band(y0, y1):
+        # Each output pixel is mapped on its own, so moving the output up warps just these rows
+        band_matrix = np.array([[1, 0, 0], [0, 1, -y0], [0, 0, 1]], dtype=np.float64) @ matrix
+        options = dict(flags=_WARP_INTERPOLATION[interpolation], borderMode=border_mode, borderValue=border_value)
+        if affine:
+            warped = cv2.warpAffine(pixels, band_matrix[:2], (out_width, y1 - y0), **options)
+        else:
+            warped = cv2.warpPerspective(pixels, band_matrix, (out_width, y1 - y0), **options)
+        out[y0:y1] = warped.reshape(out[y0:y1].shape)
+    run_bands(warp_band, out_height, token, progress)
+    return restore_format(result, image)
+
@@ -1,7 +1,24 @@
-from PyQt5.QtWidgets import QGraphicsScene, QGraphicsRectItem, QGraphicsPixmapItem
-from PyQt5.QtGui import QColor, QPen, QCursor, QTransform, QPainter
-from PyQt5.QtCore import Qt, QRectF, QSizeF, QPointF, QTimer, pyqtSignal
+from PyQt5.QtWidgets import QGraphicsScene, QGraphicsRectItem, QGraphicsPixmapItem, QGraphicsPathItem, QApplication
+from PyQt5.QtGui import QColor, QPen, QCursor, QTransform, QPainter, QPainterPath, QRegion
+from PyQt5.QtCore import Qt, QRect, QRectF, QSizeF, QPointF, QTimer, pyqtSignal
 from editor import ImageEditor  # Импорт из editor.py
+from imaging import CV2_AVAILABLE
+from selection_mask import SelectionMask, magic_wand, mask_outline, DEFAULT_WAND_TOLERANCE
+from brush import Brush
+import frame_timing
+from tracing import span
+
+# Tools that select an area of any shape; their selections carry a SelectionMask
+MASK_TOOLS = ("lasso", "polygon", "magic_wand")
+
+# Tools that paint strokes into the image; the tool name is the brush.Stroke mode
+PAINT_TOOLS = ("brush", "eraser", "clone")
+
+# How close to the first point, in screen pixels, a click closes a polygon
+CLOSE_DISTANCE = 8
+
+# Corners the perspective tool is clicked around before it straightens them
+PERSPECTIVE_CORNERS = 4
 
 class ImageEditorScene(QGraphicsScene):
     selectionChanged = pyqtSignal(QRectF)
@@ -13,6 +30,13 @@ class ImageEditorScene(QGraphicsScene):
         self.selection_rect = None
         self.start_pos = None
         self.current_tool = "selection"
+        # Points of a lasso, polygon or perspective quadrilateral being drawn, and the item showing them
+        self.path_points = None
+        self.path_item = None
+        # Stroke being painted, and where the clone tool copies from relative to the brush
+        self.stroke = None
+        self.clone_source = None
+        self.clone_offset = None
         self.setBackgroundBrush(QColor(200, 200, 200))
         self.handles = []
         self.active_handle = None
@@ -63,30 +87,163 @@ class ImageEditorScene(QGraphicsScene):
             self.addItem(handle)
             self.handles.append(handle)
 
+    def selectionPen(self):
+        """Return the dashed selection pen, its width based on image size."""
+        editor = self.views()[0]
+        img_size = max(editor.current_image.width(), editor.current_image.height())
+        pen_width = max(2, min(5, img_size // 1000))
+        pen = QPen(Qt.black, pen_width, Qt.DashLine)
+        pen.setDashPattern([4, 4])
+        pen.setDashOffset(self.dash_offset)
+        return pen
+
     def updatePenWidth(self):
         """Adjust the pen width of the selection rectangle based on image size."""
         if not self.selection_rect:
             return
         editor = self.views()[0]
         if editor.current_image:
-            img_size = max(editor.current_image.width(), editor.current_image.height())
-            pen_width = max(2, min(5, img_size // 1000))
-            pen = QPen(Qt.black, pen_width, Qt.DashLine)
-            pen.setDashPattern([4, 4])
-            pen.setDashOffset(self.dash_offset)
-            self.selection_rect.setPen(pen)
+            self.selection_rect.setPen(self.selectionPen())
+
+    def clearSelection(self):
+        """Remove the selection and its handles."""
+        if self.selection_rect:
+            self.removeItem(self.selection_rect)
+            self.selection_rect = None
+        for handle in self.handles:
+            self.removeItem(handle)
+        self.handles.clear()
+
+    def deselectLayers(self):
+        """Deselect the pasted layers; they stay where they are until flattened."""
+        for item in self.selectedItems():
+            item.setSelected(False)
+
+    def setMaskSelection(self, mask):
+        """Replace the selection with a SelectionMask (or none, if mask is None)."""
+        self.clearSelection()
+        if mask is None:
+            self.selectionChanged.emit(QRectF())
+            return
+        self.selection_rect = MaskSelectionItem(mask, mask_outline(mask))
+        self.selection_rect.setZValue(150)
+        self.addItem(self.selection_rect)
+        self.updatePenWidth()
+        self.selectionChanged.emit(QRectF(mask.rect))
+
+    def clampedPos(self, pos):
+        scene_rect = self.sceneRect()
+        return QPointF(max(scene_rect.left(), min(pos.x(), scene_rect.right())),
+                       max(scene_rect.top(), min(pos.y(), scene_rect.bottom())))
+
+    def startPath(self, pos):
+        """Start drawing a lasso or polygon at pos."""
+        self.path_points = [pos]
+        self.path_item = QGraphicsPathItem()
+        self.path_item.setPen(self.selectionPen())
+        self.path_item.setZValue(150)
+        self.addItem(self.path_item)
+
+    def updatePath(self, rubber_band=None):
+        """Show the points drawn so far, plus a rubber band line to the pointer for polygons."""
+        path = QPainterPath(self.path_points[0])
+        for point in self.path_points[1:]:
+            path.lineTo(point)
+        if rubber_band is not None:
+            path.lineTo(rubber_band)
+        self.path_item.setPath(path)
+        self.selectionChanged.emit(path.boundingRect())
+
+    def cancelPath(self):
+        if self.path_item is not None:
+            self.removeItem(self.path_item)
+        self.path_points = None
+        self.path_item = None
+
+    def finishPath(self):
+        """Close the lasso or polygon being drawn and select its inside."""
+        points = self.path_points
+        self.cancelPath()
+        editor = self.views()[0]
+        if len(points) < 3 or not editor.current_image:
+            self.setMaskSelection(None)
+            return
+        with span("polygon selection", "selection", points=len(points)):
+            mask = SelectionMask.from_polygon([(p.x(), p.y()) for p in points], editor.current_image.rect())
+        self.setMaskSelection(mask)
+
+    def addPerspectiveCorner(self, event, editor):
+        """Add a corner of the perspective tool's quadrilateral; the last one straightens it."""
+        pos = self.clampedPos(event.scenePos())
+        if not self.path_points:
+            self.deselectLayers()
+            self.clearSelection()
+            self.startPath(pos)
+            return
+        self.path_points.append(pos)
+        if len(self.path_points) < PERSPECTIVE_CORNERS:
+            self.updatePath(pos)
+            return
+        points = [(p.x(), p.y()) for p in self.path_points]
+        self.cancelPath()
+        self.selectionChanged.emit(QRectF())
+        editor.correctPerspective(points)
+
+    def selectMagicWand(self, editor, pos):
+        """Select the area around pos with the magic wand."""
+        if not CV2_AVAILABLE:
+            editor.window().statusBar().showMessage("The magic wand requires OpenCV (cv2)", 3000)
+            return
+        tolerance = getattr(editor.window(), 'wand_tolerance', DEFAULT_WAND_TOLERANCE)
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        try:
+            mask = magic_wand(editor.current_image, int(pos.x()), int(pos.y()), tolerance)
+        finally:
+            QApplication.restoreOverrideCursor()
+        self.setMaskSelection(mask)
+
+    def startStroke(self, event, editor):
+        """Start painting with the brush, eraser or clone tool; Alt+click sets the clone source."""
+        pos = event.scenePos()
+        offset = (0, 0)
+        if self.current_tool == "clone":
+            if event.modifiers() & Qt.AltModifier:
+                self.clone_source = pos
+                self.clone_offset = None
+                editor.window().statusBar().showMessage("Clone source set", 2000)
+                return
+            if self.clone_source is None:
+                editor.window().statusBar().showMessage("Alt+click to set where the clone tool copies from", 3000)
+                return
+            # Aligned: the first stroke fixes the offset, later ones keep it
+            if self.clone_offset is None:
+                self.clone_offset = (round(self.clone_source.x() - pos.x()), round(self.clone_source.y() - pos.y()))
+            offset = self.clone_offset
+        brush = getattr(editor.window(), 'brush', None) or Brush()
+        self.stroke = editor.beginStroke(brush, self.current_tool, offset)
+        if self.stroke is not None:
+            editor.updateStroke(self.stroke.moveTo(pos.x(), pos.y()))
 
-    def fixMovableItem(self, item, editor):
-        """Fix a movable item onto the image."""
-        if not isinstance(item, MovableImageItem) or not editor.current_image:
+    def mousePressPath(self, event, editor):
+        """Handle a click of the lasso, polygon or magic wand tool."""
+        pos = self.clampedPos(event.scenePos())
+        if self.current_tool == "polygon" and self.path_points:
+            # Clicking near the first point closes the polygon
+            distance = CLOSE_DISTANCE / max(editor.transform().m11(), 1e-6)
+            first = self.path_points[0]
+            if len(self.path_points) >= 3 and abs(pos.x() - first.x()) + abs(pos.y() - first.y()) <= distance:
+                self.finishPath()
+            else:
+                self.path_points.append(pos)
+                self.updatePath(pos)
             return
-        pixmap = item.pixmap()
-        pos = item.pos()
-        painter = QPainter(editor.current_image)
-        painter.drawPixmap(int(pos.x()), int(pos.y()), pixmap)
-        painter.end()
-        editor.setImage(editor.current_image)
-        editor.is_modified = True
+        self.deselectLayers()
+        self.clearSelection()
+        if self.current_tool == "magic_wand":
+            self.selectMagicWand(editor, pos)
+            return
+        self.startPath(pos)
+        self.selecting = self.current_tool == "lasso"
 
     def mousePressEvent(self, event):
         """Handle mouse press events for selection."""
@@ -101,27 +258,49 @@ class ImageEditorScene(QGraphicsScene):
                 return
 
             if not isinstance(item, MovableImageItem):
-                for selected_item in self.selectedItems():
-                    if isinstance(selected_item, MovableImageItem):
-                        self.fixMovableItem(selected_item, editor)
-                        selected_item.setSelected(False)
-                        self.removeItem(selected_item)
-                        editor.pasted_items.remove(selected_item)
-
-                if self.selection_rect:
-                    self.removeItem(self.selection_rect)
-                    self.selection_rect = None
-                for handle in self.handles:
-                    self.removeItem(handle)
-                self.handles.clear()
+                self.clearSelection()
 
                 self.selecting = True
                 self.start_pos = event.scenePos()
                 self.selection_rect = self.addRect(QRectF(self.start_pos, QSizeF(0, 0)))
                 self.updatePenWidth()
                 self.update()
+        elif self.current_tool in PAINT_TOOLS and event.button() == Qt.LeftButton:
+            editor = self.views()[0]
+            if editor.current_image:
+                self.startStroke(event, editor)
+            return
+        elif self.current_tool == "perspective" and event.button() == Qt.LeftButton:
+            editor = self.views()[0]
+            if editor.current_image:
+                self.addPerspectiveCorner(event, editor)
+            return
+        elif self.current_tool in MASK_TOOLS and event.button() == Qt.LeftButton:
+            editor = self.views()[0]
+            if not editor.current_image:
+                return
+            if not isinstance(self.itemAt(event.scenePos(), QTransform()), MovableImageItem):
+                self.mousePressPath(event, editor)
+                return
         super().mousePressEvent(event)
 
+    def mouseDoubleClickEvent(self, event):
+        """Close the polygon being drawn on double-click."""
+        if self.current_tool == "polygon" and self.path_points:
+            self.finishPath()
+            return
+        super().mouseDoubleClickEvent(event)
+
+    def keyPressEvent(self, event):
+        """Cancel the lasso, polygon or perspective quadrilateral being drawn with Escape."""
+        if event.key() == Qt.Key_Escape and self.path_points:
+            self.cancelPath()
+            self.selecting = False
+            self.selectionChanged.emit(QRectF())
+            return
+        super().keyPressEvent(event)
+
+    @frame_timing.timed("ImageEditorScene.mouseMove", input_event=True)
     def mouseMoveEvent(self, event):
         """Handle mouse move events for resizing or creating selections."""
         scene_rect = self.sceneRect()
@@ -173,6 +352,17 @@ class ImageEditorScene(QGraphicsScene):
                 self.selection_rect.setRect(rect)
                 self.updatePenWidth()
                 self.selectionChanged.emit(rect)
+        elif self.stroke is not None:
+            pos = event.scenePos()
+            editor = self.views()[0]
+            editor.updateStroke(self.stroke.lineTo(pos.x(), pos.y()))
+        elif self.path_points and self.current_tool == "lasso" and self.selecting:
+            pos = self.clampedPos(event.scenePos())
+            if pos != self.path_points[-1]:
+                self.path_points.append(pos)
+                self.updatePath()
+        elif self.path_points and self.current_tool in ("polygon", "perspective"):
+            self.updatePath(self.clampedPos(event.scenePos()))
         super().mouseMoveEvent(event)
 
     def mouseReleaseEvent(self, event):
@@ -180,20 +370,80 @@ class ImageEditorScene(QGraphicsScene):
         if self.selecting and self.current_tool == "selection":
             self.selecting = False
             self.createHandles()
+        elif self.selecting and self.current_tool == "lasso":
+            self.selecting = False
+            self.finishPath()
+        elif self.stroke is not None:
+            stroke, self.stroke = self.stroke, None
+            self.views()[0].endStroke(stroke)
         elif self.active_handle:
             self.active_handle = None
         super().mouseReleaseEvent(event)
 
-class MovableImageItem(QGraphicsPixmapItem):
-    def __init__(self, pixmap, parent=None):
+class MaskSelectionItem(QGraphicsRectItem):
+    """A lasso, polygon or magic wand selection.
+
+    rect() is the bounding box of mask, so code written for rectangular
+    selections still finds its extent; the marching ants follow outline.
+    """
+
+    def __init__(self, mask, outline, parent=None):
+        super().__init__(QRectF(mask.rect), parent)
+        self.mask = mask
+        self.outline = outline
+
+    def paint(self, painter, option, widget=None):
+        painter.setPen(self.pen())
+        painter.setBrush(Qt.NoBrush)
+        painter.drawPath(self.outline)
+
+class DocumentItem(QGraphicsPixmapItem):
+    """The document's pixmap; the part under covered, where the editor shows its layer composite, isn't drawn."""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.covered = QRect()
+
+    def paint(self, painter, option, widget=None):
+        if not self.covered.isEmpty():
+            # The composite already holds these pixels, and drawing them twice would show through its alpha
+            visible = QRegion(self.boundingRect().toAlignedRect()).subtracted(QRegion(self.covered))
+            painter.setClipRegion(visible, Qt.IntersectClip)
+        super().paint(painter, option, widget)
+
+
+class MovableImageItem(QGraphicsRectItem):
+    """The handle of a pasted layer: it moves the layer and outlines it when selected.
+
+    The layer itself is drawn as part of the editor's layer composite.
+    """
+
+    def __init__(self, layer, parent=None):
         """Initialize a movable image item."""
-        super().__init__(pixmap, parent)
-        self.setTransformationMode(Qt.SmoothTransformation)
-        self.setFlag(QGraphicsPixmapItem.ItemIsMovable, True)
-        self.setFlag(QGraphicsPixmapItem.ItemIsSelectable, True)
+        super().__init__(QRectF(layer.image.rect()), parent)
+        self.layer = layer
+        self.setPos(QPointF(layer.pos))
+        self.setFlag(QGraphicsRectItem.ItemIsMovable, True)
+        self.setFlag(QGraphicsRectItem.ItemIsSelectable, True)
+        self.setFlag(QGraphicsRectItem.ItemSendsGeometryChanges, True)
         self.setCursor(Qt.SizeAllCursor)
         self.setZValue(100)
 
+    def paint(self, painter, option, widget=None):
+        if self.isSelected():
+            pen = QPen(Qt.black, 0, Qt.DashLine)
+            painter.setPen(pen)
+            painter.setBrush(Qt.NoBrush)
+            painter.drawRect(self.rect())
+
+    def itemChange(self, change, value):
+        if change == QGraphicsRectItem.ItemPositionChange:
+            # Layers sit on whole pixels
+            return QPointF(round(value.x()), round(value.y()))
+        if change == QGraphicsRectItem.ItemPositionHasChanged and self.scene() is not None:
+            self.scene().views()[0].moveLayer(self)
+        return super().itemChange(change, value)
+
     def mouseMoveEvent(self, event):
         """Handle movement of the item, constraining it within the scene."""
         super().mouseMoveEvent(event)
@@ -215,3 +465,11 @@ class MovableImageItem(QGraphicsPixmapItem):
         if event.button() == Qt.LeftButton:
             self.setSelected(True)
         super().mouseReleaseEvent(event)
+
+    def mouseDoubleClickEvent(self, event):
+        """Open the layer's opacity and blend mode on double-click."""
+        window = self.scene().views()[0].window()
+        if hasattr(window, 'editLayerProperties'):
+            window.editLayerProperties()
+            return
+        super().mouseDoubleClickEvent(event)
@@ -0,0 +1,219 @@
+import math
+import numpy as np
+from PyQt5.QtGui import QImage, QPainterPath, QPolygonF
+from PyQt5.QtCore import QRect, QRectF, QPointF
+from imaging import CV2_AVAILABLE, image_array, convert_image, is_palette
+from jobs import run_bands, BAND_ROWS
+from tracing import span
+
+if CV2_AVAILABLE:
+    import cv2
+
+# Largest per-channel difference from the clicked colour the magic wand still selects
+DEFAULT_WAND_TOLERANCE = 32
+
+# The magic wand floods a pyramid level of at most this many pixels and then
+# refines only the edge of the result at full resolution
+WAND_MAX_PIXELS = 1 << 20
+
+
+class SelectionMask:
+    """A selection of any shape, stored as one bit per pixel of its bounding box.
+
+    rect is the bounding box in image coordinates and bits its rows packed
+    with np.packbits, so a 45 MP lasso selection takes under 6 MB and the
+    area outside the bounding box costs nothing.
+    """
+
+    def __init__(self, rect, bits):
+        self.rect = QRect(rect)
+        self.bits = bits
+
+    @classmethod
+    def from_array(cls, selected, x=0, y=0):
+        """Return the mask of a boolean array placed at (x, y), cropped to its selected pixels; None if there are none."""
+        rows = np.flatnonzero(selected.any(axis=1))
+        if not len(rows):
+            return None
+        columns = np.flatnonzero(selected.any(axis=0))
+        top, bottom = int(rows[0]), int(rows[-1]) + 1
+        left, right = int(columns[0]), int(columns[-1]) + 1
+        bits = np.packbits(selected[top:bottom, left:right], axis=1)
+        return cls(QRect(x + left, y + top, right - left, bottom - top), bits)
+
+    @classmethod
+    def from_polygon(cls, points, bounds):
+        """Rasterize a closed polygon of (x, y) points inside the QRect bounds; None if it covers no pixel.
+
+        A pixel is selected if its centre is inside by the even-odd rule. The
+        crossings of every edge with every pixel row are computed at once,
+        then each band of rows is filled from a difference array, so the
+        work follows the polygon's size and the temporaries a band's.
+        """
+        polygon = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        if len(polygon) < 3:
+            return None
+        x0, y0 = polygon[:, 0], polygon[:, 1]
+        x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+        # Rows whose centre lies in [min y, max y) of the edge, so a shared vertex counts once
+        first = np.maximum(np.ceil(np.minimum(y0, y1) - 0.5), bounds.top()).astype(np.int64)
+        last = np.minimum(np.ceil(np.maximum(y0, y1) - 0.5), bounds.bottom() + 1).astype(np.int64)
+        counts = np.maximum(last - first, 0)
+        total = int(counts.sum())
+        if not total:
+            return None
+        edge = np.repeat(np.arange(len(polygon)), counts)
+        row = first[edge] + np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        x = x0[edge] + (row + 0.5 - y0[edge]) * (x1[edge] - x0[edge]) / (y1[edge] - y0[edge])
+        # Every row has an even number of crossings, so after sorting they pair up into spans
+        order = np.lexsort((x, row))
+        row, x = row[order][::2], x[order]
+        starts = np.clip(np.ceil(x[::2] - 0.5), bounds.left(), bounds.right() + 1).astype(np.int64)
+        ends = np.clip(np.ceil(x[1::2] - 0.5), bounds.left(), bounds.right() + 1).astype(np.int64)
+        spans = ends > starts
+        row, starts, ends = row[spans], starts[spans], ends[spans]
+        if not len(row):
+            return None
+        left, right = int(starts.min()), int(ends.max())
+        top, height = int(row[0]), int(row[-1]) + 1 - int(row[0])
+        width = right - left
+        bits = np.zeros((height, (width + 7) // 8), dtype=np.uint8)
+        for band_top in range(0, height, BAND_ROWS):
+            band_rows = min(BAND_ROWS, height - band_top)
+            lo, hi = np.searchsorted(row, [top + band_top, top + band_top + band_rows])
+            band_row = row[lo:hi] - top - band_top
+            steps = np.zeros((band_rows, width + 1), dtype=np.int8)
+            np.add.at(steps, (band_row, starts[lo:hi] - left), 1)
+            np.add.at(steps, (band_row, ends[lo:hi] - left), -1)
+            bits[band_top:band_top + band_rows] = np.packbits(np.cumsum(steps[:, :-1], axis=1, dtype=np.int8) > 0,
+                                                              axis=1)
+        return cls(QRect(left, top, width, height), bits)
+
+    def array(self, rect=None, scale=1.0):
+        """Return the selection over rect as a boolean array.
+
+        rect defaults to the bounding box; it's in the coordinates of an image
+        scale times the size of the one the mask was made on (nearest pixel).
+        """
+        if rect is None:
+            return np.unpackbits(self.bits, axis=1, count=self.rect.width()).view(bool)
+        ys = np.floor((np.arange(rect.top(), rect.top() + rect.height()) + 0.5) / scale).astype(np.int64) - self.rect.y()
+        xs = np.floor((np.arange(rect.left(), rect.left() + rect.width()) + 0.5) / scale).astype(np.int64) - self.rect.x()
+        inside_y = (ys >= 0) & (ys < self.rect.height())
+        inside_x = (xs >= 0) & (xs < self.rect.width())
+        rows = np.unpackbits(self.bits[np.clip(ys, 0, self.rect.height() - 1)], axis=1, count=self.rect.width())
+        selected = rows[:, np.clip(xs, 0, self.rect.width() - 1)].view(bool)
+        selected &= inside_y[:, np.newaxis]
+        selected &= inside_x
+        return selected
+
+
+def magic_wand(image, x, y, tolerance=DEFAULT_WAND_TOLERANCE):
+    """Select the pixels connected to (x, y) whose channels are all within tolerance of its colour.
+
+    cv2.floodFill runs on a pyramid level of at most WAND_MAX_PIXELS. Only
+    the pixels along the edge of the region it finds are then tested at full
+    resolution, so large images cost little more than small ones. Returns a
+    SelectionMask, or None if (x, y) is outside the image.
+    """
+    if not CV2_AVAILABLE:
+        raise RuntimeError("OpenCV (cv2) is required for the magic wand")
+    if not image.rect().contains(x, y):
+        return None
+    with span("magic wand", "selection", width=image.width(), height=image.height()):
+        if is_palette(image):
+            image = convert_image(image, QImage.Format_RGB32, "wand")
+        pixels = image_array(image)
+        height, width = pixels.shape[:2]
+        # Alpha isn't compared; it's dropped after downscaling, so the full image isn't copied
+        seed = pixels[y, x].astype(np.int16) if pixels.ndim == 2 else pixels[y, x, :3].astype(np.int16)
+        factor = 1
+        while (width // factor) * (height // factor) > WAND_MAX_PIXELS:
+            factor *= 2
+        if factor == 1:
+            small = pixels
+        else:
+            small = cv2.resize(pixels, (width // factor, height // factor), interpolation=cv2.INTER_AREA)
+        # floodFill takes its image as an output argument even with FLOODFILL_MASK_ONLY, so it gets a writable copy
+        small = np.array(small if small.ndim == 2 else small[:, :, :3])
+        small_height, small_width = small.shape[:2]
+        scale_y, scale_x = small_height / height, small_width / width
+        flood = np.zeros((small_height + 2, small_width + 2), dtype=np.uint8)
+        difference = (tolerance,) * 3
+        flags = 8 | cv2.FLOODFILL_FIXED_RANGE | cv2.FLOODFILL_MASK_ONLY | (1 << 8)
+        seed_point = (min(int(x * scale_x), small_width - 1), min(int(y * scale_y), small_height - 1))
+        cv2.floodFill(small, flood, seed_point, 0, difference, difference, flags)
+        coarse = flood[1:-1, 1:-1]
+        if factor == 1:
+            return SelectionMask.from_array(coarse.view(bool))
+        # Inside the eroded region everything is taken; the ring up to the dilated region is tested per pixel
+        kernel = np.ones((3, 3), dtype=np.uint8)
+        inner = cv2.erode(coarse, kernel)
+        outer = cv2.dilate(coarse, kernel)
+        rows = np.flatnonzero(outer.any(axis=1))
+        columns = np.flatnonzero(outer.any(axis=0))
+        top, bottom = math.floor(rows[0] / scale_y), min(height, math.ceil((rows[-1] + 1) / scale_y))
+        left, right = math.floor(columns[0] / scale_x), min(width, math.ceil((columns[-1] + 1) / scale_x))
+        ys = np.minimum((np.arange(top, bottom) * scale_y).astype(np.int64), small_height - 1)
+        xs = np.minimum((np.arange(left, right) * scale_x).astype(np.int64), small_width - 1)
+        selected = inner[ys][:, xs].view(bool)
+        edge_y, edge_x = np.nonzero((outer - inner)[ys][:, xs])
+        colours = pixels[edge_y + top, edge_x + left]
+        if colours.ndim == 2:
+            colours = colours[:, :3]
+        within = np.abs(colours.astype(np.int16) - seed) <= tolerance
+        if within.ndim == 2:
+            within = within.all(axis=1)
+        selected[edge_y[within], edge_x[within]] = True
+        return SelectionMask.from_array(selected, left, top)
+
+
+def mask_outline(mask):
+    """Return a QPainterPath along the edges of a SelectionMask, in image coordinates."""
+    path = QPainterPath()
+    if not CV2_AVAILABLE:
+        path.addRect(QRectF(mask.rect))
+        return path
+    contours, _ = cv2.findContours(mask.array().astype(np.uint8), cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+    origin = np.array([mask.rect.x() + 0.5, mask.rect.y() + 0.5])
+    for contour in contours:
+        points = cv2.approxPolyDP(contour, 1.0, True)[:, 0, :] + origin
+        path.addPolygon(QPolygonF([QPointF(px, py) for px, py in points]))
+        path.closeSubpath()
+    return path
+
+
+def _pixels(image, writable=False):
+    """Return image's pixels as a 2D array with one element per pixel."""
+    pixels = image_array(image, writable)
+    return pixels if pixels.ndim == 2 else pixels.view(np.uint32)[:, :, 0]
+
+
+def blend_outside(processed, original, selected):
+    """Return processed with the pixels outside the boolean array selected taken from original.
+
+    Both images cover the same rectangle; processed is converted to original's format.
+    """
+    result = QImage(convert_image(processed, original.format(), "region"))
+    pixels = _pixels(result, writable=True)
+    source = _pixels(original)
+
+    def blend_band(y0, y1):
+        np.copyto(pixels[y0:y1], source[y0:y1], where=~selected[y0:y1])
+    run_bands(blend_band, result.height())
+    return result
+
+
+def clear_outside(image, selected, transparent=True):
+    """Return a copy of image with the pixels outside the boolean array selected cleared.
+
+    They become transparent (the copy is converted to premultiplied ARGB),
+    or white if transparent is False.
+    """
+    if transparent:
+        image = convert_image(image, QImage.Format_ARGB32_Premultiplied, "mask")
+    elif is_palette(image):
+        image = convert_image(image, QImage.Format_RGB32, "mask")
+    result = QImage(image)
+    image_array(result, writable=True)[~selected] = 0 if transparent else 255
+    return result
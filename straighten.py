@@ -0,0 +1,119 @@
+import math
+import numpy as np
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QImage
+from imaging import image_array, convert_image
+from quantize import otsu_threshold
+from resampling import resize_pixels, rotate_image, perspective_image
+from tracing import span
+
+# Skew is measured on a copy of the page this many pixels on its long side:
+# a line of text still spans hundreds of pixels, and the search takes milliseconds
+SKEW_LEVEL_SIZE = 1024
+# Ink pixels the projection profiles are counted over, at most; the coarse search
+# only has to land within a step of the skew, so it counts fewer
+SKEW_SAMPLE_POINTS = 200000
+COARSE_SAMPLE_POINTS = 50000
+# Largest skew looked for either way, and the steps of the coarse and fine searches, in degrees
+MAX_SKEW = 15.0
+COARSE_STEP = 0.5
+FINE_STEP = 0.05
+
+# Quadrilaterals smaller than this many square pixels are taken for stray clicks, not a page
+MIN_QUAD_AREA = 16.0
+
+# Straightening resamples the whole page once, so it's worth the sharper interpolation
+DEFAULT_INTERPOLATION = "bicubic"
+# The corners a deskew uncovers are filled like paper
+DEFAULT_DESKEW_FILL = "white"
+
+
+def _ink(image):
+    """Return the row and column of the dark pixels of a small gray copy of image."""
+    # Every few pixels down to twice the level's size, then averaged 2x2: far cheaper
+    # than averaging the whole page down, and lines of text come through both
+    scale = 2 * SKEW_LEVEL_SIZE / max(image.width(), image.height())
+    if scale < 1:
+        image = image.scaled(max(2, round(image.width() * scale)), max(2, round(image.height() * scale)),
+                             transformMode=Qt.FastTransformation)
+    level = convert_image(image, QImage.Format_Grayscale8, "deskew")
+    gray = image_array(level)
+    if scale < 1:
+        gray = resize_pixels(gray, gray.shape[1] // 2, gray.shape[0] // 2, "area")
+    rows, columns = np.nonzero(gray <= otsu_threshold(gray))
+    step = max(1, len(rows) // SKEW_SAMPLE_POINTS)
+    return rows[::step].astype(np.float32), columns[::step].astype(np.float32)
+
+
+def _profile_sharpness(rows, columns, angles):
+    """Return, for each angle (degrees), how sharply the ink falls into lines sloping down by it.
+
+    The ink is projected across lines at the angle; the sum of the squared
+    counts is largest when text lines fall into as few rows as possible.
+    """
+    scores = np.empty(len(angles))
+    for index, angle in enumerate(angles):
+        radians = math.radians(angle)
+        projected = rows * math.cos(radians) - columns * math.sin(radians)
+        counts = np.bincount((projected - projected.min()).astype(np.intp))
+        scores[index] = np.dot(counts, counts)
+    return scores
+
+
+def estimate_skew(image, max_skew=MAX_SKEW):
+    """Return the clockwise rotation in degrees (as for resampling.rotate_image()) that straightens image.
+
+    Text lines and other dark horizontal structure are found on a small
+    binarized copy of the page: the angle whose projection profile is
+    sharpest is searched for coarsely, then finely around the best step.
+    0.0 is returned for pages without enough ink to tell.
+    """
+    with span("estimate skew", "straighten", width=image.width(), height=image.height()) as estimate:
+        rows, columns = _ink(image)
+        if len(rows) < 100:
+            return 0.0
+        coarse = np.arange(-max_skew, max_skew + COARSE_STEP / 2, COARSE_STEP)
+        step = max(1, len(rows) // COARSE_SAMPLE_POINTS)
+        best = coarse[np.argmax(_profile_sharpness(rows[::step], columns[::step], coarse))]
+        fine = np.arange(best - COARSE_STEP, best + COARSE_STEP + FINE_STEP / 2, FINE_STEP)
+        skew = float(fine[np.argmax(_profile_sharpness(rows, columns, fine))])
+        estimate.set(skew=skew, points=len(rows))
+    # Lines sloping down to the right are straightened by turning the page back, counter-clockwise
+    return round(-skew, 2) + 0.0
+
+
+def deskew_image(image, max_skew=MAX_SKEW, interpolation=DEFAULT_INTERPOLATION, fill=DEFAULT_DESKEW_FILL,
+                 token=None, progress=None):
+    """Return image straightened by estimate_skew() with one rotation at full resolution, and the angle."""
+    degrees = estimate_skew(image, max_skew)
+    if abs(degrees) < FINE_STEP:
+        return image, 0.0
+    return rotate_image(image, degrees, interpolation, fill, token, progress), degrees
+
+
+def order_corners(points):
+    """Return four (x, y) points as top-left, top-right, bottom-right and bottom-left corners.
+
+    The points are sorted clockwise by their angle around the centroid, and
+    the one nearest the image's top left (smallest x + y) starts the list.
+    Raises ValueError unless there are four points enclosing an area of at
+    least MIN_QUAD_AREA.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if points.shape != (4, 2):
+        raise ValueError("Four corners are needed")
+    centre = points.mean(axis=0)
+    # y grows downwards, so increasing angles go clockwise on screen
+    points = points[np.argsort(np.arctan2(points[:, 1] - centre[1], points[:, 0] - centre[0]))]
+    points = np.roll(points, -int(np.argmin(points.sum(axis=1))), axis=0)
+    x, y = points[:, 0], points[:, 1]
+    area = abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1))) / 2
+    if area < MIN_QUAD_AREA:
+        raise ValueError("The corners don't enclose an area")
+    return [(float(x), float(y)) for x, y in points]
+
+
+def straighten_perspective(image, points, interpolation=DEFAULT_INTERPOLATION, token=None, progress=None):
+    """Return the quadrilateral of image with corners points (in any order) mapped onto a rectangle."""
+    return perspective_image(image, order_corners(points), interpolation=interpolation, token=token,
+                             progress=progress)
@@ -0,0 +1,149 @@
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+
+# Set PHOTOED_TRACE=trace.json to record a trace and write it on exit
+TRACE_ENV = "PHOTOED_TRACE"
+
+# Oldest events are dropped beyond this, so a long session can't grow without bound
+MAX_EVENTS = 1000000
+
+_enabled = False
+_events = deque(maxlen=MAX_EVENTS)
+_thread_names = {}
+
+
+class _NullSpan:
+    """The span returned while tracing is disabled; does nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("name", "category", "args", "start")
+
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter_ns()
+        if exc_type is not None:
+            self.args["error"] = repr(exc)
+        _events.append(("X", self.name, self.category, self.start, end - self.start,
+                        threading.get_ident(), self.args))
+        return False
+
+    def set(self, **args):
+        """Attach more arguments to the span, e.g. results only known at the end."""
+        self.args.update(args)
+
+
+def is_enabled():
+    return _enabled
+
+
+def enable():
+    """Start recording spans."""
+    global _enabled
+    _enabled = True
+    _thread_names.setdefault(threading.get_ident(), threading.current_thread().name)
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def clear():
+    _events.clear()
+
+
+def span(name, category="app", **args):
+    """Return a context manager that records the time spent in its block.
+
+    Costs one function call and a global check while tracing is disabled.
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, category, args)
+
+
+def traced(name=None, category="app"):
+    """Decorator that records every call of a function as a span."""
+    def decorator(function):
+        span_name = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with _Span(span_name, category, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def instant(name, category="app", **args):
+    """Record a point event, e.g. a failure."""
+    if _enabled:
+        _events.append(("i", name, category, time.perf_counter_ns(), 0, threading.get_ident(), args))
+
+
+def name_thread(name):
+    """Label the calling thread in the trace viewer."""
+    _thread_names[threading.get_ident()] = name
+
+
+def trace_events():
+    """Return the recorded events in Chrome trace-event format."""
+    pid = os.getpid()
+    events = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+              for tid, name in _thread_names.items()]
+    for phase, name, category, start, duration, tid, args in list(_events):
+        event = {"name": name, "cat": category, "ph": phase, "ts": start / 1000.0, "pid": pid, "tid": tid}
+        if phase == "X":
+            event["dur"] = duration / 1000.0
+        else:
+            event["s"] = "t"
+        if args:
+            event["args"] = {key: value if isinstance(value, (int, float, bool)) else str(value)
+                             for key, value in args.items()}
+        events.append(event)
+    return events
+
+
+def save(file_name):
+    """Write the trace as Chrome trace-event JSON (chrome://tracing, Perfetto)."""
+    with open(file_name, "w") as f:
+        json.dump({"traceEvents": trace_events(), "displayTimeUnit": "ms"}, f)
+
+
+def enable_from_environment():
+    """Enable tracing if PHOTOED_TRACE names an output file, and write it on exit."""
+    file_name = os.environ.get(TRACE_ENV)
+    if not file_name:
+        return False
+    name_thread("GUI")
+    enable()
+    atexit.register(save, file_name)
+    return True
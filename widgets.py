@@ -1,12 +1,25 @@
+import os
 from PyQt5.QtWidgets import (
     QWidget, QDialog, QVBoxLayout, QHBoxLayout, QGridLayout, QLabel,
     QLineEdit, QPushButton, QSlider, QMdiSubWindow, QDialogButtonBox, QCheckBox, 
-    QMessageBox, QSpinBox, QComboBox, QColorDialog
+    QMessageBox, QSpinBox, QComboBox, QColorDialog, QDockWidget, QTreeWidget, QTreeWidgetItem,
+    QProgressBar, QToolButton, QDoubleSpinBox, QFileDialog
 )
-from PyQt5.QtGui import QPainter, QPen, QColor, QFont, QFontMetrics
-from PyQt5.QtCore import Qt, QSize, QRectF
+from PyQt5.QtGui import QPainter, QPen, QColor, QFont, QFontMetrics, QPainterPath, QPolygonF
+from PyQt5.QtCore import Qt, QRectF, QPointF, QTimer, pyqtSignal
 from editor import ImageEditor, EditorContainer
-from commands import AdjustmentsCommand
+from commands import LayerPropertiesCommand
+from layers import BLEND_MODES
+from curves import CHANNELS, IDENTITY_POINTS, Curves, curve_lut
+from grading import SETTINGS as GRADE_SETTINGS, ColorGrade, load_cube
+from filters import FILTERS
+from quantize import MODES, PALETTE_METHODS, DITHERS, THRESHOLDS, ModeConversion
+from resampling import (
+    RESIZE_MODES, DEFAULT_RESIZE_MODE, ROTATION_INTERPOLATIONS, DEFAULT_ROTATION_INTERPOLATION, ROTATION_FILLS,
+    DEFAULT_ROTATION_FILL
+)
+from tracing import traced
+import frame_timing
 
 
 class RulerWidget(QWidget):
@@ -19,6 +32,8 @@ class RulerWidget(QWidget):
         self.tick_color = QColor(50, 50, 50)
         self.label_color = QColor(0, 0, 0)
 
+    @traced("RulerWidget.paint", "paint")
+    @frame_timing.timed("RulerWidget.paint")
     def paintEvent(self, event):
         if not self.editor.current_image:
             return
@@ -138,6 +153,8 @@ class CustomMdiSubWindow(QMdiSubWindow):
 
     def closeEvent(self, event):
         editor = self.editor_container.editor
+        # A job still running for this document is abandoned
+        editor.cancelJob()
         if isinstance(editor, ImageEditor) and editor.is_modified:
             reply = QMessageBox.question(
                 self,
@@ -365,8 +382,567 @@ class AdjustmentsDialog(QDialog):
         self.editor.cancel_preview()
         self.reject()
 
+# Colours the histograms and curves of CHANNELS are drawn in
+CHANNEL_COLORS = {"rgb": QColor(90, 90, 90), "red": QColor(210, 40, 40), "green": QColor(30, 160, 60),
+                  "blue": QColor(40, 80, 220)}
+
+
+def histogram_path(counts, rect):
+    """Return a closed QPainterPath of a 256-bin histogram filling rect.
+
+    The height is scaled to the highest bin other than the first and the
+    last, which clipped images pile up in; those two are cut off at the top.
+    """
+    peak = max(float(max(counts[1:255])), 1.0)
+    step = rect.width() / 256
+    path = QPainterPath(QPointF(rect.left(), rect.bottom()))
+    for level, count in enumerate(counts):
+        y = rect.bottom() - min(count / peak, 1.0) * rect.height()
+        path.lineTo(rect.left() + level * step, y)
+        path.lineTo(rect.left() + (level + 1) * step, y)
+    path.lineTo(rect.right(), rect.bottom())
+    path.closeSubpath()
+    return path
+
+
+class CurveWidget(QWidget):
+    """Edits the control points of a curve over the input histogram of its channel.
+
+    Click to add a point, drag to move one, double-click or right-click to remove it.
+    """
+
+    pointsChanged = pyqtSignal()
+
+    # Space around the 256 x 256 plot and how close a click must be to grab a point, in pixels
+    MARGIN = 6
+    GRAB_DISTANCE = 7
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.points = list(IDENTITY_POINTS)
+        self.counts = None
+        self.color = CHANNEL_COLORS["rgb"]
+        self.drag_index = None
+        self.setMinimumSize(256 + 2 * self.MARGIN, 256 + 2 * self.MARGIN)
+
+    def setPoints(self, points):
+        self.points = list(points)
+        self.drag_index = None
+        self.update()
+
+    def setHistogram(self, counts, color):
+        self.counts = counts
+        self.color = color
+        self.update()
+
+    def plotRect(self):
+        return QRectF(self.rect()).adjusted(self.MARGIN, self.MARGIN, -self.MARGIN, -self.MARGIN)
+
+    def toWidget(self, point):
+        plot = self.plotRect()
+        return QPointF(plot.left() + point[0] / 255 * plot.width(), plot.bottom() - point[1] / 255 * plot.height())
+
+    def fromWidget(self, pos):
+        plot = self.plotRect()
+        x = round((pos.x() - plot.left()) / plot.width() * 255)
+        y = round((plot.bottom() - pos.y()) / plot.height() * 255)
+        return min(max(x, 0), 255), min(max(y, 0), 255)
+
+    def pointAt(self, pos):
+        """Return the index of the point under pos, or None."""
+        for index, point in enumerate(self.points):
+            if (self.toWidget(point) - QPointF(pos)).manhattanLength() <= self.GRAB_DISTANCE:
+                return index
+        return None
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.setRenderHint(QPainter.Antialiasing)
+        plot = self.plotRect()
+        painter.fillRect(plot, Qt.white)
+        if self.counts is not None:
+            fill = QColor(self.color)
+            fill.setAlpha(70)
+            painter.fillPath(histogram_path(self.counts, plot), fill)
+        painter.setPen(QPen(QColor(215, 215, 215), 0))
+        for quarter in (1, 2, 3):
+            x = plot.left() + plot.width() * quarter / 4
+            y = plot.top() + plot.height() * quarter / 4
+            painter.drawLine(QPointF(x, plot.top()), QPointF(x, plot.bottom()))
+            painter.drawLine(QPointF(plot.left(), y), QPointF(plot.right(), y))
+        painter.setPen(QPen(QColor(170, 170, 170), 0, Qt.DashLine))
+        painter.drawLine(plot.bottomLeft(), plot.topRight())
+        painter.setPen(QPen(self.color, 1.5))
+        table = curve_lut(self.points)
+        painter.drawPolyline(QPolygonF([self.toWidget((level, value)) for level, value in enumerate(table)]))
+        painter.setPen(QPen(Qt.black, 1))
+        for index, point in enumerate(self.points):
+            painter.setBrush(Qt.black if index == self.drag_index else Qt.white)
+            centre = self.toWidget(point)
+            painter.drawRect(QRectF(centre.x() - 3, centre.y() - 3, 6, 6))
+        painter.end()
+
+    def mousePressEvent(self, event):
+        index = self.pointAt(event.pos())
+        if event.button() == Qt.RightButton:
+            self.removePoint(index)
+            return
+        if event.button() != Qt.LeftButton:
+            return
+        if index is None:
+            x, y = self.fromWidget(event.pos())
+            if any(px == x for px, _ in self.points):
+                return
+            self.points.append((x, y))
+            self.points.sort()
+            index = self.points.index((x, y))
+            self.pointsChanged.emit()
+        self.drag_index = index
+        self.update()
+
+    @frame_timing.timed("CurveWidget.mouseMove", input_event=True)
+    def mouseMoveEvent(self, event):
+        if self.drag_index is None:
+            return
+        x, y = self.fromWidget(event.pos())
+        # Points keep their order: each stays between its neighbours
+        if self.drag_index > 0:
+            x = max(x, self.points[self.drag_index - 1][0] + 1)
+        if self.drag_index < len(self.points) - 1:
+            x = min(x, self.points[self.drag_index + 1][0] - 1)
+        if (x, y) == self.points[self.drag_index]:
+            return
+        self.points[self.drag_index] = (x, y)
+        self.update()
+        self.pointsChanged.emit()
+
+    def mouseReleaseEvent(self, event):
+        self.drag_index = None
+        self.update()
+
+    def mouseDoubleClickEvent(self, event):
+        self.removePoint(self.pointAt(event.pos()))
+
+    def removePoint(self, index):
+        # A curve needs two points
+        if index is None or len(self.points) <= 2:
+            return
+        del self.points[index]
+        self.drag_index = None
+        self.update()
+        self.pointsChanged.emit()
+
+
+class HistogramWidget(QWidget):
+    """Draws one or more 256-bin histograms over each other, each in its own colour."""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.histograms = []
+        self.setMinimumSize(256, 80)
+
+    def setHistograms(self, histograms):
+        """Show histograms, a list of (counts, QColor)."""
+        self.histograms = histograms
+        self.update()
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.setRenderHint(QPainter.Antialiasing)
+        plot = QRectF(self.rect()).adjusted(CurveWidget.MARGIN, 2, -CurveWidget.MARGIN, -2)
+        painter.fillRect(plot, Qt.white)
+        for counts, color in self.histograms:
+            fill = QColor(color)
+            fill.setAlpha(110 if len(self.histograms) > 1 else 160)
+            painter.fillPath(histogram_path(counts, plot), fill)
+        painter.end()
+
+
+class CurvesDialog(QDialog):
+    def __init__(self, editor, parent=None):
+        """Edit per-channel levels and curves, previewed on the visible part of the image.
+
+        The histogram under the curve is of the channel as it is; the one
+        below shows the result and follows every change.
+        """
+        super().__init__(parent)
+        self.editor = editor
+        self.curves = Curves()
+        self.histograms = None
+        self.setWindowTitle("Curves and Levels")
+        self.layout = QGridLayout(self)
+
+        self.channel_combo = QComboBox(self)
+        for name, label in CHANNELS.items():
+            self.channel_combo.addItem(label, name)
+        self.channel_combo.currentIndexChanged.connect(self.loadChannel)
+
+        self.curve_widget = CurveWidget(self)
+        self.curve_widget.pointsChanged.connect(self.curveChanged)
+        self.result_histogram = HistogramWidget(self)
+
+        self.in_black = QSpinBox(self)
+        self.in_black.setRange(0, 254)
+        self.gamma = QDoubleSpinBox(self)
+        self.gamma.setRange(0.1, 9.99)
+        self.gamma.setSingleStep(0.05)
+        self.gamma.setDecimals(2)
+        self.in_white = QSpinBox(self)
+        self.in_white.setRange(1, 255)
+        self.out_black = QSpinBox(self)
+        self.out_black.setRange(0, 255)
+        self.out_white = QSpinBox(self)
+        self.out_white.setRange(0, 255)
+        for spinbox in (self.in_black, self.gamma, self.in_white, self.out_black, self.out_white):
+            spinbox.valueChanged.connect(self.levelsChanged)
+
+        self.reset_button = QPushButton("Reset", self)
+        self.reset_button.clicked.connect(self.resetCurves)
+        self.buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, self)
+        self.buttons.accepted.connect(self.applyCurves)
+        self.buttons.rejected.connect(self.reject_dialog)
+
+        self.layout.addWidget(QLabel("Channel:", self), 0, 0)
+        self.layout.addWidget(self.channel_combo, 0, 1, 1, 2)
+        self.layout.addWidget(self.reset_button, 0, 3)
+        self.layout.addWidget(self.curve_widget, 1, 0, 1, 4)
+        self.layout.addWidget(QLabel("Input levels:", self), 2, 0)
+        self.layout.addWidget(self.in_black, 2, 1)
+        self.layout.addWidget(self.gamma, 2, 2)
+        self.layout.addWidget(self.in_white, 2, 3)
+        self.layout.addWidget(QLabel("Output levels:", self), 3, 0)
+        self.layout.addWidget(self.out_black, 3, 1)
+        self.layout.addWidget(self.out_white, 3, 3)
+        self.layout.addWidget(QLabel("Result:", self), 4, 0, 1, 4)
+        self.layout.addWidget(self.result_histogram, 5, 0, 1, 4)
+        self.layout.addWidget(self.buttons, 6, 0, 1, 4)
+
+        self.loadChannel()
+        # Counted once per image, in the background for large ones
+        self.editor.channelHistograms(self.setHistograms)
+
+    def channel(self):
+        return self.channel_combo.currentData()
+
+    def loadChannel(self, *args):
+        """Show the settings of the selected channel."""
+        curve = self.curves.channels[self.channel()]
+        spinboxes = (self.in_black, self.gamma, self.in_white, self.out_black, self.out_white)
+        for spinbox in spinboxes:
+            spinbox.blockSignals(True)
+        # Limits left by the previous channel would clamp this one's values
+        self.in_black.setRange(0, 254)
+        self.in_white.setRange(1, 255)
+        self.in_black.setValue(curve.in_black)
+        self.gamma.setValue(curve.gamma)
+        self.in_white.setValue(curve.in_white)
+        self.out_black.setValue(curve.out_black)
+        self.out_white.setValue(curve.out_white)
+        self.in_white.setMinimum(curve.in_black + 1)
+        self.in_black.setMaximum(curve.in_white - 1)
+        for spinbox in spinboxes:
+            spinbox.blockSignals(False)
+        self.curve_widget.setPoints(curve.points)
+        self.updateHistograms()
+
+    def setHistograms(self, histograms):
+        self.histograms = histograms
+        self.updateHistograms()
+
+    def updateHistograms(self):
+        """Redraw the histograms: the result's is remapped from the cached counts, not recounted."""
+        channel = self.channel()
+        color = CHANNEL_COLORS[channel]
+        if self.histograms is None:
+            self.curve_widget.setHistogram(None, color)
+            return
+        names = ("red", "green", "blue")
+        counts = self.histograms.counts
+        self.curve_widget.setHistogram(sum(counts) / 3 if channel == "rgb" else counts[names.index(channel)], color)
+        result = self.histograms.mapped(self.curves.luts())
+        if channel == "rgb":
+            self.result_histogram.setHistograms([(result[i], CHANNEL_COLORS[name]) for i, name in enumerate(names)])
+        else:
+            self.result_histogram.setHistograms([(result[names.index(channel)], color)])
+
+    def curveChanged(self):
+        self.curves.channels[self.channel()].points = list(self.curve_widget.points)
+        self.previewCurves()
+
+    def levelsChanged(self, *args):
+        curve = self.curves.channels[self.channel()]
+        curve.in_black, curve.gamma, curve.in_white = self.in_black.value(), self.gamma.value(), self.in_white.value()
+        curve.out_black, curve.out_white = self.out_black.value(), self.out_white.value()
+        # The input black point stays below the white point
+        self.in_white.setMinimum(curve.in_black + 1)
+        self.in_black.setMaximum(curve.in_white - 1)
+        self.previewCurves()
+
+    def resetCurves(self):
+        self.curves = Curves()
+        self.loadChannel()
+        self.previewCurves()
+
+    def previewCurves(self):
+        """Preview the curves on the visible part of the image and update the result histogram."""
+        self.editor.preview_curves(self.curves)
+        self.updateHistograms()
+
+    def applyCurves(self):
+        """Apply the curves to the image (or the selection) and close the dialog."""
+        if self.curves.isIdentity():
+            self.editor.cancel_filter_preview()
+        else:
+            self.editor.apply_curves(self.curves.copy())
+        self.accept()
+
+    def reject_dialog(self):
+        """Remove the preview and reject the dialog."""
+        self.editor.cancel_filter_preview()
+        self.reject()
+
+
+class ColorGradeDialog(QDialog):
+    def __init__(self, editor, parent=None):
+        """Edit white balance, hue, saturation and vibrance and an imported .cube LUT, previewed on the view."""
+        super().__init__(parent)
+        self.editor = editor
+        self.grade = ColorGrade()
+        self.setWindowTitle("Color Grading")
+        self.layout = QGridLayout(self)
+
+        self.sliders = {}
+        self.value_labels = {}
+        for row, (name, (label, minimum, maximum)) in enumerate(GRADE_SETTINGS.items()):
+            slider = QSlider(Qt.Horizontal, self)
+            slider.setRange(minimum, maximum)
+            slider.valueChanged.connect(self.settingsChanged)
+            self.sliders[name] = slider
+            self.value_labels[name] = QLabel("0", self)
+            self.layout.addWidget(QLabel(f"{label}:", self), row, 0)
+            self.layout.addWidget(slider, row, 1)
+            self.layout.addWidget(self.value_labels[name], row, 2)
+        row = len(GRADE_SETTINGS)
+
+        self.cube_label = QLabel("No LUT", self)
+        self.load_button = QPushButton("Load LUT...", self)
+        self.load_button.clicked.connect(self.loadCube)
+        self.cube_amount = QSlider(Qt.Horizontal, self)
+        self.cube_amount.setRange(0, 100)
+        self.cube_amount.setValue(100)
+        self.cube_amount.setEnabled(False)
+        self.cube_amount.valueChanged.connect(self.settingsChanged)
+        self.cube_amount_label = QLabel("100 %", self)
+
+        self.reset_button = QPushButton("Reset", self)
+        self.reset_button.clicked.connect(self.resetGrade)
+        self.buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, self)
+        self.buttons.accepted.connect(self.applyGrade)
+        self.buttons.rejected.connect(self.reject_dialog)
+
+        self.layout.addWidget(self.load_button, row, 0)
+        self.layout.addWidget(self.cube_label, row, 1, 1, 2)
+        self.layout.addWidget(QLabel("LUT amount:", self), row + 1, 0)
+        self.layout.addWidget(self.cube_amount, row + 1, 1)
+        self.layout.addWidget(self.cube_amount_label, row + 1, 2)
+        self.layout.addWidget(self.reset_button, row + 2, 0)
+        self.layout.addWidget(self.buttons, row + 2, 1, 1, 2)
+
+    def settingsChanged(self, *args):
+        for name, slider in self.sliders.items():
+            setattr(self.grade, name, slider.value())
+            self.value_labels[name].setText(str(slider.value()))
+        self.grade.cube_amount = self.cube_amount.value() / 100
+        self.cube_amount_label.setText(f"{self.cube_amount.value()} %")
+        self.previewGrade()
+
+    def loadCube(self):
+        """Import a .cube LUT; it is applied after the other settings."""
+        file_name, _ = QFileDialog.getOpenFileName(self, "Load LUT", "", "Cube LUTs (*.cube)")
+        if not file_name:
+            return
+        try:
+            cube = load_cube(file_name)
+        except (OSError, ValueError) as e:
+            QMessageBox.warning(self, "Error", f"Failed to load the LUT: {e}")
+            return
+        self.grade.cube = cube
+        self.cube_label.setText(cube.title or os.path.basename(file_name))
+        self.cube_amount.setEnabled(True)
+        self.previewGrade()
+
+    def resetGrade(self):
+        self.grade = ColorGrade()
+        for slider in (*self.sliders.values(), self.cube_amount):
+            slider.blockSignals(True)
+        for slider in self.sliders.values():
+            slider.setValue(0)
+        self.cube_amount.setValue(100)
+        for slider in (*self.sliders.values(), self.cube_amount):
+            slider.blockSignals(False)
+        self.cube_label.setText("No LUT")
+        self.cube_amount.setEnabled(False)
+        self.settingsChanged()
+
+    def previewGrade(self):
+        """Preview the grade on the visible part of the image."""
+        if self.grade.isIdentity():
+            self.editor.cancel_filter_preview()
+        else:
+            self.editor.preview_grade(self.grade)
+
+    def applyGrade(self):
+        """Apply the grade to the image (or the selection) and close the dialog."""
+        if self.grade.isIdentity():
+            self.editor.cancel_filter_preview()
+        else:
+            self.editor.apply_grade(self.grade.copy())
+        self.accept()
+
+    def reject_dialog(self):
+        """Remove the preview and reject the dialog."""
+        self.editor.cancel_filter_preview()
+        self.reject()
+
+
+class LayerPropertiesDialog(QDialog):
+    def __init__(self, editor, item, parent=None):
+        """Edit the opacity and blend mode of a pasted layer, previewed on the document."""
+        super().__init__(parent)
+        self.editor = editor
+        self.item = item
+        self.old_opacity = item.layer.opacity
+        self.old_blend_mode = item.layer.blend_mode
+        self.setWindowTitle("Layer Properties")
+        self.layout = QGridLayout(self)
+
+        self.opacity_slider = QSlider(Qt.Horizontal, self)
+        self.opacity_slider.setRange(0, 100)
+        self.opacity_slider.setValue(round(self.old_opacity * 100))
+        self.opacity_spinbox = QSpinBox(self)
+        self.opacity_spinbox.setRange(0, 100)
+        self.opacity_spinbox.setSuffix(" %")
+        self.opacity_spinbox.setValue(self.opacity_slider.value())
+        self.opacity_slider.valueChanged.connect(self.opacity_spinbox.setValue)
+        self.opacity_spinbox.valueChanged.connect(self.opacity_slider.setValue)
+        self.opacity_slider.valueChanged.connect(self.previewLayer)
+
+        self.mode_combo = QComboBox(self)
+        for name, label in BLEND_MODES.items():
+            self.mode_combo.addItem(label, name)
+        self.mode_combo.setCurrentIndex(max(0, self.mode_combo.findData(self.old_blend_mode)))
+        self.mode_combo.currentIndexChanged.connect(self.previewLayer)
+
+        self.buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, self)
+        self.buttons.accepted.connect(self.applyLayer)
+        self.buttons.rejected.connect(self.reject_dialog)
+
+        self.layout.addWidget(QLabel("Opacity:", self), 0, 0)
+        self.layout.addWidget(self.opacity_slider, 0, 1)
+        self.layout.addWidget(self.opacity_spinbox, 0, 2)
+        self.layout.addWidget(QLabel("Blend mode:", self), 1, 0)
+        self.layout.addWidget(self.mode_combo, 1, 1, 1, 2)
+        self.layout.addWidget(self.buttons, 2, 0, 1, 3)
+
+    def previewLayer(self, *args):
+        """Show the layer with the current values; only the area it covers is recomposited."""
+        self.editor.setLayerProperties(self.item, self.opacity_slider.value() / 100, self.mode_combo.currentData())
+
+    def applyLayer(self):
+        """Record the change as one undo step and close the dialog."""
+        opacity, blend_mode = self.opacity_slider.value() / 100, self.mode_combo.currentData()
+        if (opacity, blend_mode) != (self.old_opacity, self.old_blend_mode):
+            self.editor.executeCommand(LayerPropertiesCommand(self.editor, self.item, opacity, blend_mode,
+                                                              self.old_opacity, self.old_blend_mode))
+        self.accept()
+
+    def reject_dialog(self):
+        """Restore the layer and reject the dialog."""
+        self.editor.setLayerProperties(self.item, self.old_opacity, self.old_blend_mode)
+        self.reject()
+
+class FilterDialog(QDialog):
+    def __init__(self, editor, name, parent=None):
+        """Initialize the dialog for one of filters.FILTERS."""
+        super().__init__(parent)
+        self.editor = editor
+        self.name = name
+        label, amount, max_radius = FILTERS[name]
+        self.setWindowTitle(label)
+        self.layout = QVBoxLayout(self)
+
+        # Radius in tenths of a pixel
+        self.radius_label = QLabel(self)
+        self.radius_slider = QSlider(Qt.Horizontal, self)
+        self.radius_slider.setRange(5, max_radius * 10)
+        self.radius_slider.setValue(20)
+        self.radius_slider.valueChanged.connect(self.updateLabels)
+        self.radius_slider.valueChanged.connect(self.previewFilter)
+        self.layout.addWidget(self.radius_label)
+        self.layout.addWidget(self.radius_slider)
+
+        self.amount_slider = None
+        if amount:
+            self.amount_name, minimum, maximum, default = amount
+            self.amount_label = QLabel(self)
+            self.amount_slider = QSlider(Qt.Horizontal, self)
+            self.amount_slider.setRange(minimum, maximum)
+            self.amount_slider.setValue(default)
+            self.amount_slider.valueChanged.connect(self.updateLabels)
+            self.amount_slider.valueChanged.connect(self.previewFilter)
+            self.layout.addWidget(self.amount_label)
+            self.layout.addWidget(self.amount_slider)
+
+        self.threshold_slider = None
+        if name == "unsharp_mask":
+            self.threshold_label = QLabel(self)
+            self.threshold_slider = QSlider(Qt.Horizontal, self)
+            self.threshold_slider.setRange(0, 255)
+            self.threshold_slider.setValue(0)
+            self.threshold_slider.valueChanged.connect(self.updateLabels)
+            self.threshold_slider.valueChanged.connect(self.previewFilter)
+            self.layout.addWidget(self.threshold_label)
+            self.layout.addWidget(self.threshold_slider)
+
+        self.buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, self)
+        self.buttons.accepted.connect(self.applyFilter)
+        self.buttons.rejected.connect(self.reject_dialog)
+        self.layout.addWidget(self.buttons)
+        self.updateLabels()
+        self.previewFilter()
+
+    def settings(self):
+        """Return (radius, amount, threshold) as set in the dialog."""
+        radius = self.radius_slider.value() / 10
+        amount = self.amount_slider.value() if self.amount_slider else 0
+        threshold = self.threshold_slider.value() if self.threshold_slider else 0
+        return radius, amount, threshold
+
+    def updateLabels(self, *args):
+        radius, amount, threshold = self.settings()
+        self.radius_label.setText(f"Radius: {radius:.1f} px")
+        if self.amount_slider:
+            self.amount_label.setText(f"{self.amount_name}: {amount}")
+        if self.threshold_slider:
+            self.threshold_label.setText(f"Threshold: {threshold}")
+
+    def previewFilter(self, *args):
+        """Preview the filter on the visible part of the image."""
+        self.editor.preview_filter(self.name, *self.settings())
+
+    def applyFilter(self):
+        """Apply the filter to the whole image and close the dialog."""
+        self.editor.apply_filter(self.name, *self.settings())
+        self.accept()
+
+    def reject_dialog(self):
+        """Remove the preview and reject the dialog."""
+        self.editor.cancel_filter_preview()
+        self.reject()
+
+
 class ResizeDialog(QDialog):
-    def __init__(self, current_width, current_height, parent=None):
+    def __init__(self, current_width, current_height, parent=None, mode=DEFAULT_RESIZE_MODE):
         """Initialize the resize dialog."""
         super().__init__(parent)
         self.setWindowTitle("Resize Image")
@@ -382,6 +958,11 @@ class ResizeDialog(QDialog):
         self.percent_edit = QLineEdit("100", self)  # 100% by default
         self.aspect_ratio_checkbox = QCheckBox("Keep Aspect Ratio", self)
         self.aspect_ratio_checkbox.setChecked(True)  # Default On
+        self.mode_label = QLabel("Resampling:", self)
+        self.mode_combo = QComboBox(self)
+        for name, label in RESIZE_MODES.items():
+            self.mode_combo.addItem(label, name)
+        self.mode_combo.setCurrentIndex(max(0, self.mode_combo.findData(mode)))
 
         self.buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, self)
         self.buttons.accepted.connect(self.accept)
@@ -401,7 +982,9 @@ class ResizeDialog(QDialog):
         self.layout.addWidget(self.percent_label, 2, 0)
         self.layout.addWidget(self.percent_edit, 2, 1)
         self.layout.addWidget(self.aspect_ratio_checkbox, 3, 0, 1, 2)
-        self.layout.addWidget(self.buttons, 4, 0, 1, 2)
+        self.layout.addWidget(self.mode_label, 4, 0)
+        self.layout.addWidget(self.mode_combo, 4, 1)
+        self.layout.addWidget(self.buttons, 5, 0, 1, 2)
 
         # Init ratio
         self.aspect_ratio = current_width / current_height if current_height != 0 else 1
@@ -460,9 +1043,13 @@ class ResizeDialog(QDialog):
         keep_aspect = self.aspect_ratio_checkbox.isChecked()
         return width, height, keep_aspect
 
+    def getMode(self):
+        """Return the selected resize mode (a key of RESIZE_MODES)."""
+        return self.mode_combo.currentData()
+
 
 class RotationDialog(QDialog):
-    def __init__(self, editor, parent=None):
+    def __init__(self, editor, parent=None, interpolation=DEFAULT_ROTATION_INTERPOLATION, fill=DEFAULT_ROTATION_FILL):
         super().__init__(parent)
         self.editor = editor
         self.setWindowTitle("Precise Rotation")
@@ -489,6 +1076,24 @@ class RotationDialog(QDialog):
         self.angle_slider.sliderMoved.connect(self.live_preview_rotation)
         main_layout.addWidget(self.angle_slider)
 
+        # Resampling options
+        options_layout = QGridLayout()
+        self.interpolation_combo = QComboBox(self)
+        for name, label in ROTATION_INTERPOLATIONS.items():
+            self.interpolation_combo.addItem(label, name)
+        self.interpolation_combo.setCurrentIndex(max(0, self.interpolation_combo.findData(interpolation)))
+        self.fill_combo = QComboBox(self)
+        for name, label in ROTATION_FILLS.items():
+            self.fill_combo.addItem(label, name)
+        self.fill_combo.setCurrentIndex(max(0, self.fill_combo.findData(fill)))
+        self.interpolation_combo.currentIndexChanged.connect(self.refresh_preview)
+        self.fill_combo.currentIndexChanged.connect(self.refresh_preview)
+        options_layout.addWidget(QLabel("Interpolation:", self), 0, 0)
+        options_layout.addWidget(self.interpolation_combo, 0, 1)
+        options_layout.addWidget(QLabel("Corners:", self), 1, 0)
+        options_layout.addWidget(self.fill_combo, 1, 1)
+        main_layout.addLayout(options_layout)
+
         # Buttons
         self.buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, self)
         self.buttons.accepted.connect(self.accept)
@@ -504,11 +1109,273 @@ class RotationDialog(QDialog):
         self.angle_spinbox.setValue(value)
 
     def live_preview_rotation(self, angle):
-        self.editor.preview_rotation(angle)
+        self.editor.preview_rotation(angle, self.get_interpolation(), self.get_fill())
+
+    def refresh_preview(self, *args):
+        self.live_preview_rotation(self.get_angle())
 
     def get_angle(self):
         return self.angle_spinbox.value()
 
+    def get_interpolation(self):
+        return self.interpolation_combo.currentData()
+
+    def get_fill(self):
+        return self.fill_combo.currentData()
+
     def reject_dialog(self):
         self.editor.cancel_preview()
         self.reject()
+
+
+class ConvertModeDialog(QDialog):
+    """Choose the mode to convert a document to and how."""
+
+    def __init__(self, conversion, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Convert Mode")
+        layout = QGridLayout(self)
+
+        self.mode_combo = QComboBox(self)
+        for name, label in MODES.items():
+            self.mode_combo.addItem(label, name)
+        self.colours_spin = QSpinBox(self)
+        self.colours_spin.setRange(2, 256)
+        self.colours_spin.setValue(conversion.colours)
+        self.palette_combo = QComboBox(self)
+        for name, label in PALETTE_METHODS.items():
+            self.palette_combo.addItem(label, name)
+        self.dither_combo = QComboBox(self)
+        for name, label in DITHERS.items():
+            self.dither_combo.addItem(label, name)
+        self.threshold_combo = QComboBox(self)
+        for name, label in THRESHOLDS.items():
+            self.threshold_combo.addItem(label, name)
+        self.block_spin = QSpinBox(self)
+        self.block_spin.setRange(3, 255)
+        self.block_spin.setSingleStep(2)
+        self.block_spin.setValue(conversion.block_size)
+        self.block_spin.setToolTip("Side of the area each pixel is compared with, in pixels (odd)")
+        self.offset_spin = QSpinBox(self)
+        self.offset_spin.setRange(-128, 128)
+        self.offset_spin.setValue(conversion.offset)
+        self.offset_spin.setToolTip("How much darker than its surroundings a pixel must be to turn black")
+        for combo, value in ((self.mode_combo, conversion.mode), (self.palette_combo, conversion.palette_method),
+                             (self.dither_combo, conversion.dither), (self.threshold_combo, conversion.threshold)):
+            combo.setCurrentIndex(max(0, combo.findData(value)))
+
+        # Rows shown for each mode
+        self.rows = {"palette": [], "mono": []}
+        for row, (mode, label, widget) in enumerate((
+                (None, "Mode:", self.mode_combo),
+                ("palette", "Colors:", self.colours_spin),
+                ("palette", "Palette:", self.palette_combo),
+                ("palette", "Dither:", self.dither_combo),
+                ("mono", "Threshold:", self.threshold_combo),
+                ("mono", "Block size:", self.block_spin),
+                ("mono", "Offset:", self.offset_spin))):
+            label = QLabel(label, self)
+            layout.addWidget(label, row, 0)
+            layout.addWidget(widget, row, 1)
+            if mode:
+                self.rows[mode] += [label, widget]
+
+        self.buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, self)
+        self.buttons.accepted.connect(self.accept)
+        self.buttons.rejected.connect(self.reject)
+        layout.addWidget(self.buttons, 7, 0, 1, 2)
+
+        self.mode_combo.currentIndexChanged.connect(self.updateRows)
+        self.threshold_combo.currentIndexChanged.connect(self.updateRows)
+        self.updateRows()
+
+    def updateRows(self, *args):
+        mode = self.mode_combo.currentData()
+        for name, widgets in self.rows.items():
+            for widget in widgets:
+                widget.setVisible(name == mode)
+        adaptive = self.threshold_combo.currentData() == "adaptive"
+        self.block_spin.setEnabled(adaptive)
+        self.offset_spin.setEnabled(adaptive)
+        self.adjustSize()
+
+    def getConversion(self):
+        return ModeConversion(self.mode_combo.currentData(), self.colours_spin.value(), self.palette_combo.currentData(),
+                              self.dither_combo.currentData(), self.threshold_combo.currentData(),
+                              self.block_spin.value() | 1, self.offset_spin.value())
+
+
+class JobProgressWidget(QWidget):
+    """Status bar widget with the progress of the running background job and a Cancel button."""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.job = None
+        layout = QHBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        self.label = QLabel(self)
+        self.progress_bar = QProgressBar(self)
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.setFixedWidth(160)
+        self.cancel_button = QToolButton(self)
+        self.cancel_button.setText("Cancel")
+        self.cancel_button.clicked.connect(self.cancelJob)
+        layout.addWidget(self.label)
+        layout.addWidget(self.progress_bar)
+        layout.addWidget(self.cancel_button)
+        self.hide()
+
+    def track(self, job):
+        """Show the progress of job until it finishes, fails or is cancelled."""
+        self.job = job
+        self.label.setText(job.title)
+        self.progress_bar.setValue(0)
+        self.cancel_button.setEnabled(True)
+        job.signals.progress.connect(lambda fraction: self.updateProgress(job, fraction))
+        job.signals.finished.connect(lambda result: self.clear(job))
+        job.signals.cancelled.connect(lambda: self.clear(job))
+        job.signals.failed.connect(lambda error: self.clear(job))
+        self.show()
+
+    def updateProgress(self, job, fraction):
+        if job is self.job:
+            self.progress_bar.setValue(int(fraction * 100))
+
+    def cancelJob(self):
+        if self.job is not None:
+            self.job.cancel()
+            self.label.setText(f"Cancelling {self.job.title}...")
+            self.cancel_button.setEnabled(False)
+
+    def clear(self, job):
+        if job is self.job:
+            self.job = None
+            self.hide()
+
+
+class MemoryInspectorDock(QDockWidget):
+    """Dock that shows how much image memory each open document keeps alive."""
+
+    REFRESH_INTERVAL = 1000  # ms
+
+    def __init__(self, main_window):
+        super().__init__("Memory Inspector", main_window)
+        self.setObjectName("MemoryInspectorDock")
+        self.main_window = main_window
+        self.documents = []  # Sub-windows in tree order
+
+        widget = QWidget(self)
+        layout = QVBoxLayout(widget)
+        layout.setContentsMargins(4, 4, 4, 4)
+        self.total_label = QLabel(widget)
+        self.tree = QTreeWidget(widget)
+        self.tree.setColumnCount(2)
+        self.tree.setHeaderLabels(["Document / category", "Size"])
+        self.tree.setColumnWidth(0, 220)
+
+        buttons = QHBoxLayout()
+        self.refresh_button = QPushButton("Refresh", widget)
+        self.refresh_button.clicked.connect(self.refresh)
+        self.purge_redo_button = QPushButton("Purge Redo", widget)
+        self.purge_redo_button.setToolTip("Discard the redo history of the selected document")
+        self.purge_redo_button.clicked.connect(self.purgeRedo)
+        self.drop_pixmaps_button = QPushButton("Drop Pixmaps", widget)
+        self.drop_pixmaps_button.setToolTip("Release the display pixmap of the selected document until it is shown again")
+        self.drop_pixmaps_button.clicked.connect(self.dropPixmaps)
+        buttons.addWidget(self.refresh_button)
+        buttons.addWidget(self.purge_redo_button)
+        buttons.addWidget(self.drop_pixmaps_button)
+
+        layout.addWidget(self.total_label)
+        layout.addWidget(self.tree)
+        layout.addLayout(buttons)
+        self.setWidget(widget)
+
+        # Refresh only while the dock is visible
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.visibilityChanged.connect(self.updateTimer)
+
+    def updateTimer(self, visible):
+        if visible:
+            self.refresh()
+            self.timer.start(self.REFRESH_INTERVAL)
+        else:
+            self.timer.stop()
+
+    def refresh(self):
+        """Rebuild the tree from the open documents, keeping the selection and expanded items."""
+        from memory_usage import document_memory, history_memory, current_rss, format_bytes
+        selected = self.selectedSubWindow()
+        expanded = self.expandedPaths()
+        self.tree.clear()
+        self.documents = []
+        grand_total = 0
+        for sub_window in self.main_window.mdi_area.subWindowList():
+            editor = sub_window.editor_container.editor
+            categories = document_memory(editor)
+            total = sum(categories.values())
+            grand_total += total
+            document_item = QTreeWidgetItem(self.tree, [sub_window.windowTitle(), format_bytes(total)])
+            for category, size in categories.items():
+                if size:
+                    QTreeWidgetItem(document_item, [category, format_bytes(size)])
+            entries = history_memory(editor)
+            if entries:
+                history_item = QTreeWidgetItem(document_item, [f"History ({len(entries)} entries)", ""])
+                for stack, index, name, size in entries:
+                    QTreeWidgetItem(history_item, [f"{stack} #{index + 1}: {name}", format_bytes(size)])
+            self.documents.append(sub_window)
+            if sub_window is selected:
+                self.tree.setCurrentItem(document_item)
+        self.restoreExpanded(expanded)
+        self.total_label.setText(f"Documents: {format_bytes(grand_total)}    Process RSS: {format_bytes(current_rss())}")
+
+    def expandedPaths(self, item=None, path=()):
+        """Return the labels leading to every expanded item."""
+        item = item or self.tree.invisibleRootItem()
+        paths = set()
+        for i in range(item.childCount()):
+            child = item.child(i)
+            if child.isExpanded():
+                child_path = path + (child.text(0),)
+                paths.add(child_path)
+                paths |= self.expandedPaths(child, child_path)
+        return paths
+
+    def restoreExpanded(self, paths, item=None, path=()):
+        item = item or self.tree.invisibleRootItem()
+        for i in range(item.childCount()):
+            child = item.child(i)
+            child_path = path + (child.text(0),)
+            if child_path in paths:
+                child.setExpanded(True)
+                self.restoreExpanded(paths, child, child_path)
+
+    def selectedSubWindow(self):
+        """Return the sub-window selected in the tree, or the active one."""
+        item = self.tree.currentItem()
+        while item is not None and item.parent() is not None:
+            item = item.parent()
+        if item is not None:
+            index = self.tree.indexOfTopLevelItem(item)
+            if 0 <= index < len(self.documents) and self.documents[index] in self.main_window.mdi_area.subWindowList():
+                return self.documents[index]
+        return self.main_window.mdi_area.activeSubWindow()
+
+    def purgeRedo(self):
+        sub_window = self.selectedSubWindow()
+        if not sub_window:
+            return
+        count = sub_window.editor_container.editor.purgeRedoHistory()
+        self.main_window.statusBar().showMessage(f"Purged {count} redo entries", 2000)
+        self.refresh()
+
+    def dropPixmaps(self):
+        from memory_usage import format_bytes
+        sub_window = self.selectedSubWindow()
+        if not sub_window:
+            return
+        freed = sub_window.editor_container.editor.dropCachedPixmaps()
+        self.main_window.statusBar().showMessage(f"Released {format_bytes(freed)} of pixmaps", 2000)
+        self.refresh()